@@ -3,11 +3,29 @@ from slicer.ScriptedLoadableModule import (ScriptedLoadableModule,
                                            ScriptedLoadableModuleLogic,
                                            ScriptedLoadableModuleWidget,
                                            ScriptedLoadableModuleTest)
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from collections.abc import Iterator, MutableMapping
+import argparse
+import concurrent.futures
 import csv
+import fnmatch
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
+import numpy as np
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
 from slicer.util import VTKObservationMixin
+from vtk.util import numpy_support
 
 #
 # DataImporter
@@ -26,12 +44,473 @@ class DataImporter(ScriptedLoadableModule):
     self.parent.contributors = ["Mateo Lopez (UNC), Pablo Hernandez (Kitware Inc,), Hina Shah (Kitware Inc.)"]
     self.parent.helpText = """
     This module import label images and segmentations from files and folders and compute the topology number of each segment.
-    topologyNumber = cleanData.GetNumberOfPoints() - edges.GetNumberOfLines() + cleanData.GetNumberOfPolys()
+    topologyNumber = points - edges + polys of the largest connected component of the cleaned surface.
     """
     self.parent.acknowledgementText = """
     This project is funded by NIBIB R01EB021391
     """ # replace with organization, grant and thanks.
 
+#
+# DataImporterResultStore
+#
+
+class DataImporterResultStore(object):
+  """
+  SQLite store of the topology results computed by DataImporterLogic, usually located next to the cohort.
+  Results are keyed by the SHA-256 of the file content, the segment name and the parameters
+  used to compute them, so results of unchanged files are found again after re-opening the cohort.
+  The hash of a file is cached by path, modification time and size.
+  """
+  DEFAULT_FILE_NAME = '.DataImporterResults.sqlite'
+  # The store is a cache: tables are re-created when the schema changes
+  SCHEMA_VERSION = 2
+
+  def __init__(self, path):
+    self.path = path
+    self.connection = sqlite3.connect(path)
+    with self.connection:
+      if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+        self.connection.execute('DROP TABLE IF EXISTS results')
+        self.connection.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+      self.connection.execute('CREATE TABLE IF NOT EXISTS files '
+                              '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                              '(sha256 TEXT, segmentName TEXT, parameters TEXT, topology INTEGER, properties TEXT, '
+                              'closedSurface TEXT, cleanSurface TEXT, '
+                              'PRIMARY KEY (sha256, segmentName, parameters))')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS expectedTopologies '
+                              '(segmentName TEXT PRIMARY KEY, topology INTEGER)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS labelValues '
+                              '(sha256 TEXT PRIMARY KEY, labelValues TEXT)')
+
+  def close(self):
+    self.connection.close()
+
+  @staticmethod
+  def computeFileHash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+  def fileHash(self, path):
+    """
+    Return the SHA-256 of the content of path, computing it only if the file changed since last call.
+    """
+    stat = os.stat(path)
+    row = self.connection.execute('SELECT sha256 FROM files WHERE path=? AND mtime=? AND size=?',
+                                  (path, stat.st_mtime, stat.st_size)).fetchone()
+    if row is not None:
+      return row[0]
+    fileHash = self.computeFileHash(path)
+    with self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              (path, stat.st_mtime, stat.st_size, fileHash))
+    return fileHash
+
+  def setFileHash(self, path, fileHash):
+    """
+    Record fileHash, for example the checksum of a CSV manifest, as the SHA-256 of the current content of path,
+    so that fileHash does not read the file. A hash already computed for the current content is kept.
+    """
+    stat = os.stat(path)
+    row = self.connection.execute('SELECT sha256 FROM files WHERE path=? AND mtime=? AND size=?',
+                                  (path, stat.st_mtime, stat.st_size)).fetchone()
+    if row is None:
+      with self.connection:
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                (path, stat.st_mtime, stat.st_size, fileHash))
+    elif row[0] != fileHash:
+      logging.warning('Checksum of [{}] does not match its content, the checksum is ignored.'.format(path))
+
+  def getResults(self, fileHash, parameters):
+    """
+    Return dict {segmentName: {'topology': int, 'properties': dict, 'closedSurface': str, 'cleanSurface': str}}.
+    Surfaces are serialized, use stringToPolyData. They are None if they were not stored.
+    """
+    rows = self.connection.execute('SELECT segmentName, topology, properties, closedSurface, cleanSurface FROM results '
+                                   'WHERE sha256=? AND parameters=?', (fileHash, parameters))
+    return {segmentName: {'topology': topology, 'properties': json.loads(properties),
+                          'closedSurface': closedSurface, 'cleanSurface': cleanSurface}
+            for segmentName, topology, properties, closedSurface, cleanSurface in rows}
+
+  def setResults(self, fileHash, parameters, results):
+    """
+    Store results: dict {segmentName: (topology, properties, closedSurface, cleanSurface)}, surfaces can be None.
+    """
+    rows = [(fileHash, segmentName, parameters, int(topology), json.dumps(properties),
+             self.polyDataToString(closedSurface), self.polyDataToString(cleanSurface))
+            for segmentName, (topology, properties, closedSurface, cleanSurface) in results.items()]
+    with self.connection:
+      self.connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+  def hasResults(self, fileHash, topologyAlgorithm):
+    """
+    Return True if results computed with topologyAlgorithm are stored for the file with fileHash.
+    """
+    row = self.connection.execute('SELECT 1 FROM results WHERE sha256=? AND parameters LIKE ? LIMIT 1',
+                                  (fileHash, '%;topology=' + topologyAlgorithm)).fetchone()
+    return row is not None
+
+  def getExpectedTopologies(self):
+    return dict(self.connection.execute('SELECT segmentName, topology FROM expectedTopologies'))
+
+  def setExpectedTopologies(self, expectedTopologiesBySegment):
+    with self.connection:
+      self.connection.executemany('INSERT OR REPLACE INTO expectedTopologies VALUES (?, ?)',
+                                  [(name, int(topology)) for name, topology in expectedTopologiesBySegment.items()])
+
+  def getLabelValues(self, fileHash):
+    """
+    Return the list of label values found in the file with fileHash by the label census, None if unknown.
+    """
+    row = self.connection.execute('SELECT labelValues FROM labelValues WHERE sha256=?', (fileHash,)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+  def setLabelValues(self, fileHash, labelValues):
+    with self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO labelValues VALUES (?, ?)', (fileHash, json.dumps(list(labelValues))))
+
+  @staticmethod
+  def polyDataToString(polydata):
+    if polydata is None:
+      return None
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(polydata)
+    writer.SetDataModeToBinary()
+    writer.SetCompressorTypeToZLib()
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    return writer.GetOutputString()
+
+  @staticmethod
+  def stringToPolyData(string):
+    if not string:
+      return None
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetInputString(string)
+    reader.Update()
+    polydata = vtk.vtkPolyData()
+    polydata.DeepCopy(reader.GetOutput())
+    return polydata
+
+#
+# DataImporterNodeDict
+#
+
+class DataImporterNodeDict(MutableMapping):
+  """
+  Ordered dict by subject name used by DataImporterLogic for nodes and polydata.
+  The value of a subject spilled to disk is None: accessing it calls accessCallback(name), which is
+  expected to reload it. Membership tests, iteration and peek do not reload anything.
+  """
+  def __init__(self, accessCallback=None):
+    self._values = OrderedDict()
+    self.accessCallback = accessCallback
+
+  def __getitem__(self, name):
+    value = self._values[name]
+    if self.accessCallback is not None:
+      self.accessCallback(name)
+      value = self._values[name]
+    return value
+
+  def __setitem__(self, name, value):
+    self._values[name] = value
+
+  def __delitem__(self, name):
+    del self._values[name]
+
+  def __contains__(self, name):
+    return name in self._values
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __repr__(self):
+    return repr(dict(self._values))
+
+  def pop(self, name, *default):
+    """ Remove name without reloading it, the returned value is None if it was spilled. """
+    return self._values.pop(name, *default)
+
+  def peek(self, name):
+    """ Return the value of name without reloading it, None if spilled. """
+    return self._values[name]
+
+  def residentItems(self):
+    return [(name, value) for name, value in self._values.items() if value is not None]
+
+#
+# DataImporterCompactPolyDataDict
+#
+
+class DataImporterCompactPolyDataDict(MutableMapping):
+  """
+  Dict {segmentName: vtkPolyData} keeping only the triangles of each polydata, as contiguous float32 points
+  and int32 point ids. Normals, other cells and attribute arrays are dropped.
+  The vtkPolyData is rebuilt on access, sharing these arrays when VTK supports 32 bit cell arrays.
+  """
+  def __init__(self, polyDatas=None):
+    self._surfaces = OrderedDict()
+    if polyDatas:
+      self.update(polyDatas)
+
+  def __getitem__(self, segmentName):
+    surface = self._surfaces[segmentName]
+    return None if surface is None else self.arraysToPolyData(*surface)
+
+  def __setitem__(self, segmentName, polydata):
+    if polydata is None:
+      self._surfaces[segmentName] = None
+      return
+    points, triangles = DataImporterLogic._polyDataToArrays(polydata)
+    # Copied so that the arrays of polydata are not kept alive
+    self._surfaces[segmentName] = (np.array(points, dtype=np.float32, order='C'),
+                                   np.array(triangles, dtype=np.int32, order='C'))
+
+  def __delitem__(self, segmentName):
+    del self._surfaces[segmentName]
+
+  def __iter__(self):
+    return iter(self._surfaces)
+
+  def __len__(self):
+    return len(self._surfaces)
+
+  def __repr__(self):
+    return repr({segmentName: 'points: {}, triangles: {}'.format(len(surface[0]), len(surface[1]))
+                 for segmentName, surface in self._surfaces.items() if surface is not None})
+
+  def memorySize(self):
+    """ Return the size in bytes of the arrays. """
+    return sum(points.nbytes + triangles.nbytes for points, triangles in filter(None, self._surfaces.values()))
+
+  @staticmethod
+  def _int32Array(array):
+    """
+    Return a vtkTypeInt32Array sharing the memory of the contiguous int32 array, which it keeps alive.
+    """
+    vtkArray = vtk.vtkTypeInt32Array()
+    vtkArray.SetVoidArray(array, array.size, 1)
+    vtkArray._numpy_reference = array
+    return vtkArray
+
+  @classmethod
+  def arraysToPolyData(cls, points, triangles):
+    """
+    Return a vtkPolyData with the float32 points and int32 triangles.
+    The points are shared, and the triangles too unless VTK only has legacy cell arrays.
+    """
+    polydata = vtk.vtkPolyData()
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=False))
+    polydata.SetPoints(vtkPoints)
+    cellArray = vtk.vtkCellArray()
+    if hasattr(cellArray, 'GetConnectivityArray'):
+      offsets = np.arange(0, 3 * len(triangles) + 1, 3, dtype=np.int32)
+      cellArray.SetData(cls._int32Array(offsets), cls._int32Array(triangles.ravel()))
+    else:
+      legacyCells = np.empty((len(triangles), 4), dtype=numpy_support.ID_TYPE_CODE)
+      legacyCells[:, 0] = 3
+      legacyCells[:, 1:] = triangles
+      cellArray.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(legacyCells.ravel(), deep=True))
+    polydata.SetPolys(cellArray)
+    return polydata
+
+#
+# DataImporterTopologyMatrix
+#
+
+class DataImporterTopologyMatrix(MutableMapping):
+  """
+  Topologies of the cohort used by DataImporterLogic as topologyDict, stored in a subjects x segments integer matrix.
+  It behaves as an ordered dict of dicts {nodeName: {segmentName: topologyType}}: the value of a subject is a
+  view of its row, and writing into it writes into the matrix. Segments missing in a subject hold MISSING.
+  Columns are allocated to segments in the order they are first seen, see segmentNames.
+  Modes, expectations and consistency of all the segments are computed with NumPy, see computeModes,
+  templateTopologies and inconsistencyMask.
+  """
+  MISSING = np.iinfo(np.int32).min
+
+  def __init__(self, topologies=None):
+    self.matrix = np.full((16, 8), self.MISSING, dtype=np.int32)
+    self.rowOfNode = OrderedDict()
+    self.columnOfSegment = OrderedDict()
+    self._freeRows = []
+    if topologies:
+      self.update(topologies)
+
+  def __getitem__(self, nodeName):
+    if nodeName not in self.rowOfNode:
+      raise KeyError(nodeName)
+    return DataImporterTopologyRow(self, nodeName)
+
+  def __setitem__(self, nodeName, topologies):
+    row = self.rowOfNode.get(nodeName)
+    if row is None:
+      if self._freeRows:
+        row = self._freeRows.pop()
+      else:
+        row = len(self.rowOfNode)
+        if row == self.matrix.shape[0]:
+          self._resize(2 * row, self.matrix.shape[1])
+      self.rowOfNode[nodeName] = row
+    topologies = dict(topologies)
+    self.matrix[row] = self.MISSING
+    for segmentName, topologyType in topologies.items():
+      self.setTopology(nodeName, segmentName, topologyType)
+
+  def __delitem__(self, nodeName):
+    row = self.rowOfNode.pop(nodeName)
+    self.matrix[row] = self.MISSING
+    self._freeRows.append(row)
+
+  def __contains__(self, nodeName):
+    return nodeName in self.rowOfNode
+
+  def __iter__(self):
+    return iter(self.rowOfNode)
+
+  def __len__(self):
+    return len(self.rowOfNode)
+
+  def __repr__(self):
+    return repr({nodeName: dict(self[nodeName]) for nodeName in self.rowOfNode})
+
+  def _resize(self, numberOfRows, numberOfColumns):
+    matrix = np.full((numberOfRows, numberOfColumns), self.MISSING, dtype=np.int32)
+    matrix[:self.matrix.shape[0], :self.matrix.shape[1]] = self.matrix
+    self.matrix = matrix
+
+  def segmentNames(self):
+    return list(self.columnOfSegment)
+
+  def presentSegmentsMask(self):
+    """
+    Return the boolean array of the segments that at least one subject has.
+    """
+    return (self.toArray() != self.MISSING).any(axis=0)
+
+  def setTopology(self, nodeName, segmentName, topologyType):
+    column = self.columnOfSegment.get(segmentName)
+    if column is None:
+      column = len(self.columnOfSegment)
+      if column == self.matrix.shape[1]:
+        self._resize(self.matrix.shape[0], 2 * column)
+      self.columnOfSegment[segmentName] = column
+    self.matrix[self.rowOfNode[nodeName], column] = topologyType
+
+  def toArray(self, nodeNames=None, segmentNames=None):
+    """
+    Return the matrix of the subjects nodeNames and of the segments segmentNames, all of them by default, in order.
+    """
+    rows = [self.rowOfNode[nodeName] for nodeName in (self.rowOfNode if nodeNames is None else nodeNames)]
+    matrix = self.matrix[np.array(rows, dtype=np.intp)]
+    if segmentNames is None:
+      return matrix[:, :len(self.columnOfSegment)]
+    return matrix[:, [self.columnOfSegment[segmentName] for segmentName in segmentNames]]
+
+  def computeModes(self):
+    """
+    Return the array of the mode of each segment among the subjects having it, MISSING if no subject has it.
+    Ties go to the topology type found first in subject order.
+    """
+    numberOfColumns = len(self.columnOfSegment)
+    modes = np.full(numberOfColumns, self.MISSING, dtype=np.int32)
+    # Column major, so that the first occurrence of a value is in subject order
+    values = self.toArray().T.ravel()
+    present = np.flatnonzero(values != self.MISSING)
+    if not len(present):
+      return modes
+    columns = present // len(self.rowOfNode)
+    values = values[present].astype(np.int64)
+    minimumValue = values.min()
+    keys = columns * (values.max() - minimumValue + 1) + (values - minimumValue)
+    uniqueKeys, firstIndexes, counts = np.unique(keys, return_index=True, return_counts=True)
+    uniqueColumns = columns[firstIndexes]
+    order = np.lexsort((firstIndexes, -counts, uniqueColumns))
+    modeColumns, firstOfColumn = np.unique(uniqueColumns[order], return_index=True)
+    modes[modeColumns] = values[firstIndexes[order[firstOfColumn]]]
+    return modes
+
+  def templateTopologies(self, templateName):
+    """
+    Return the array of the topology of each segment in subject templateName, MISSING for the segments it does not have.
+    """
+    return self.matrix[self.rowOfNode[templateName], :len(self.columnOfSegment)].copy()
+
+  def expectedArray(self, expectedTopologiesBySegment):
+    """
+    Return the array of the expected topology of each segment from dict expectedTopologiesBySegment, MISSING if unknown.
+    """
+    return np.array([expectedTopologiesBySegment.get(segmentName, self.MISSING) for segmentName in self.columnOfSegment],
+                    dtype=np.int32)
+
+  def inconsistencyMask(self, expected, nodeNames=None, segmentNames=None):
+    """
+    Return the boolean matrix of the subjects nodeNames and segments segmentNames (all of them by default)
+    whose topology is not the expected array of these segments. Missing segments are consistent.
+    """
+    values = self.toArray(nodeNames, segmentNames)
+    return (values != self.MISSING) & (values != expected[np.newaxis, :])
+
+  def inconsistencies(self, expected, nodeNames=None):
+    """
+    Return dict of dicts {nodeName: {segmentName: topologyType}} of the inconsistent segments, see inconsistencyMask.
+    """
+    nodeNames = list(self.rowOfNode) if nodeNames is None else list(nodeNames)
+    values = self.toArray(nodeNames)
+    segmentNames = self.segmentNames()
+    inconsistentSegments = {}
+    for row, column in zip(*np.nonzero(self.inconsistencyMask(expected, nodeNames))):
+      inconsistentSegments.setdefault(nodeNames[row], {})[segmentNames[column]] = int(values[row, column])
+    return inconsistentSegments
+
+
+class DataImporterTopologyRow(MutableMapping):
+  """
+  Topologies of one subject of a DataImporterTopologyMatrix, dict {segmentName: topologyType} in segment order.
+  """
+  def __init__(self, topologyMatrix, nodeName):
+    self.topologyMatrix = topologyMatrix
+    self.nodeName = nodeName
+
+  def _values(self):
+    topologyMatrix = self.topologyMatrix
+    return topologyMatrix.matrix[topologyMatrix.rowOfNode[self.nodeName]]
+
+  def __getitem__(self, segmentName):
+    column = self.topologyMatrix.columnOfSegment.get(segmentName)
+    if column is None or self._values()[column] == self.topologyMatrix.MISSING:
+      raise KeyError(segmentName)
+    return int(self._values()[column])
+
+  def __setitem__(self, segmentName, topologyType):
+    self.topologyMatrix.setTopology(self.nodeName, segmentName, topologyType)
+
+  def __delitem__(self, segmentName):
+    column = self.topologyMatrix.columnOfSegment.get(segmentName)
+    if column is None or self._values()[column] == self.topologyMatrix.MISSING:
+      raise KeyError(segmentName)
+    self._values()[column] = self.topologyMatrix.MISSING
+
+  def __iter__(self):
+    values = self._values()
+    return iter([segmentName for segmentName, column in self.topologyMatrix.columnOfSegment.items()
+                 if values[column] != self.topologyMatrix.MISSING])
+
+  def __len__(self):
+    return int(np.count_nonzero(self._values()[:len(self.topologyMatrix.columnOfSegment)] != self.topologyMatrix.MISSING))
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
 #
 # DataImporterLogic
 #
@@ -51,17 +530,74 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     TOPOLOGY_TRIPLE_TORUS_TYPE : 'Triple Torus',
     TOPOLOGY_MULTIPLE_HOLES_TYPE : 'Multiple Holes',
   }
+  # Identifies how topologyNumber is computed in the keys of DataImporterResultStore
+  TOPOLOGY_ALGORITHM = 'largestComponentEulerSurfaceMetricsCentroidNumPy'
+  # Columns of the cohort metrics table, see getMetricsTable
+  QC_METRICS = ('volume', 'area', 'components', 'nonManifoldEdges',
+                'sizeX', 'sizeY', 'sizeZ', 'centroidX', 'centroidY', 'centroidZ')
+  # Metrics depending on the position of the subjects, not flagged by computeMetricOutliers
+  QC_POSITION_METRICS = ('centroidX', 'centroidY', 'centroidZ')
+  # Modified z-score above which a metric is an outlier, and number of subjects needed to flag a segment
+  QC_OUTLIER_THRESHOLD = 3.5
+  QC_MINIMUM_SUBJECTS = 5
+  # Topology of label maps can be computed from their closed surface or directly from their voxels
+  TOPOLOGY_BACKEND_SURFACE = 'surface'
+  TOPOLOGY_BACKEND_VOXEL = 'voxel'
+  # Manifest of generateShapeAnlaysisStructure, in the shape analysis folder
+  SHAPE_ANALYSIS_MANIFEST_FILE_NAME = 'DataImporterManifest.json'
+  SHAPE_ANALYSIS_MANIFEST_VERSION = 2
+  # FreeSurfer MGH volumes: header size and data types, see readMGHArray
+  MGH_HEADER_SIZE = 284
+  MGH_DATA_TYPES = {0: '>u1', 1: '>i4', 3: '>f4', 4: '>i2'}
+  # File types decided from the extension of the files, longest extensions first, see fileTypeOf
+  FILE_TYPES_BY_EXTENSION = [
+    ('.seg.nrrd', 'SegmentationFile'), ('.seg.vtm', 'SegmentationFile'),
+    ('.nii.gz', 'VolumeFile'), ('.nrrd', 'VolumeFile'), ('.nhdr', 'VolumeFile'), ('.nii', 'VolumeFile'),
+    ('.mha', 'VolumeFile'), ('.mhd', 'VolumeFile'), ('.mgz', 'VolumeFile'), ('.mgh', 'VolumeFile'),
+    ('.vtp', 'ModelFile'), ('.stl', 'ModelFile'), ('.ply', 'ModelFile'), ('.obj', 'ModelFile'),
+  ]
+  # Extensions of sidecar files, never imported
+  IGNORED_EXTENSIONS = {'.json', '.txt', '.csv', '.tsv', '.log', '.md', '.xml', '.html', '.pdf', '.py', '.sh',
+                        '.mat', '.bval', '.bvec', '.lta', '.stats', '.ctab', '.dat', '.touch', '.done', '.sqlite'}
+  # File types of the other extensions, given by the IO manager
+  _fileTypesByExtension = {}
+  # Column names of the file paths and of their SHA-256 in CSV manifests, in lower case, see iterCSVManifest
+  MANIFEST_PATH_COLUMNS = ('path', 'filepath', 'file_path', 'file', 'filename')
+  MANIFEST_CHECKSUM_COLUMNS = ('sha256', 'checksum')
+  # Index of the files of the FreeSurfer subjects directories, see updateFreeSurferSubjectsIndex
+  SUBJECTS_INDEX_VERSION = 1
+  # Scanning is bound by file system latency, not by the number of cores
+  SUBJECTS_SCAN_WORKERS = 16
+  # Formats of the models of the shape analysis structure: binary legacy VTK or compressed XML VTK
+  MODEL_FORMAT_VTK = 'vtk'
+  MODEL_FORMAT_VTP = 'vtp'
 
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
 
+    # Memory budget in bytes (0 is unlimited), see setMemoryBudget
+    self.memoryBudget = 0
+    # Subjects in memory in least recently used order, with their size in bytes
+    self.residentSubjects = OrderedDict()
+    # Files of the subjects spilled to disk: {nodeName: {'segmentation': path, 'polyData': path}}
+    self.spilledSubjects = {}
+    self.spillDirectory = ''
+    # Subjects that are never spilled, like the ones being displayed
+    self.pinnedNodeNames = set()
+
     self.saveCleanData = False
-    self.labelMapDict = {}
-    self.modelDict = {}
-    self.segmentationDict = {}
+    self.labelMapDict = DataImporterNodeDict(self._accessSubject)
+    self.modelDict = DataImporterNodeDict(self._accessSubject)
+    self.segmentationDict = DataImporterNodeDict(self._accessSubject)
     self.labelRangeInCohort = (-1, -1)
-    self.topologyDict = {}
-    self.polyDataDict = {}
+    # Label range of each subject, and whether subjects with another label range than the cohort are rejected
+    self.labelRangeDict = {}
+    self.checkLabelRange = True
+    # Dict of dicts {nodeName: {segmentName: topologyType}} backed by a matrix
+    self.topologyDict = DataImporterTopologyMatrix()
+    # Euler number, genus, boundary loops and components of each segment, see computeSurfaceTopology
+    self.topologyPropertiesDict = {}
+    self.polyDataDict = DataImporterNodeDict(self._accessSubject)
     # help variable to map continuous indices to TOPOLOGY_TYPES. Used in comboBoxes
     self.topologyTypeToIndex = {
       self.TOPOLOGY_STRIP_TYPE : 0,
@@ -74,6 +610,8 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     self.indexToTopologyType = {index: topologyType for topologyType, index in self.topologyTypeToIndex.items()}
     self.expectedTopologiesBySegment = {}
     self.inconsistentTopologyDict = {}
+    # Metrics of QC_METRICS far from the cohort: {nodeName: {segmentName: {metricName: zScore}}}, see computeMetricOutliers
+    self.outlierMetricsDict = {}
 
     self.numberOfDifferentSegments = 0
     self.dictSegmentNamesWithIntegers = dict()
@@ -86,41 +624,324 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     self.expected_file_type = 'VolumeFile'
     self.color_table_id = 'None'
 
+    # Number of worker processes used by importFiles to create the closed surfaces and compute topologies.
+    self.numberOfWorkers = 1
+    self.sourcePathDict = {}
+    # Modification time, size and content hash (None until needed) of the imported files, see updateImportedFiles
+    self.sourceSignatures = {}
+    # Checksums and metadata columns of the files of the last CSV manifest, see filePathsFromCSVFile
+    self.sourceChecksums = {}
+    self.sourceMetadata = {}
+    self.importErrors = {}
+
+    # Optional DataImporterResultStore, see setResultStorePath
+    self.resultStore = None
+
+    self.topologyBackend = self.TOPOLOGY_BACKEND_SURFACE
+    self.voxelConnectivity = 26
+
+    # If True, closed surfaces are only kept while displayed or exported, see setLazyClosedSurfaces
+    self.lazyClosedSurfaces = False
+    # Decimated surfaces shown while browsing the cohort: {nodeName: {segmentName: vtkMRMLModelNode}},
+    # see getPreviewModelNodes
+    self.previewModelNodes = {}
+    self.previewNumberOfTriangles = 20000
+    # If True, previews are created with the topology, while the closed surfaces exist, see setCreatePreviews
+    self.createPreviews = False
+    # If True, the clean data of polyDataDict is kept as DataImporterCompactPolyDataDict, see setCompactPolyData
+    self.compactPolyData = False
+
+    # Format of the models written by generateShapeAnlaysisStructure, see setModelFormat
+    self.modelFormat = self.MODEL_FORMAT_VTK
+
+    # Label values of the files read by the label census: {path: (mtime, size, labelValues)}
+    self.labelValuesCache = {}
+    # Source hashes computed by the last dry run of generateShapeAnlaysisStructure: {'savePath', 'sources'}
+    self.shapeAnalysisPlan = None
+
   def setSaveCleanData(self, save):
     self.saveCleanData = save
 
+  def setLazyClosedSurfaces(self, lazy):
+    """
+    If lazy, the closed surfaces are not created on import. populateTopologyDictionary only creates them
+    for segments missing in the resultStore, and releases them once the topology is computed.
+    polyDataDict is not populated, use getPolyData, createClosedSurface and releaseClosedSurface instead.
+    """
+    self.lazyClosedSurfaces = lazy
+
+  def setCompactPolyData(self, compact):
+    """
+    If compact, the clean data of the subjects imported afterwards is stored in polyDataDict as
+    DataImporterCompactPolyDataDict: float32 points and int32 triangles only, rebuilt as vtkPolyData on access.
+    Without saveCleanData, polyDataDict holds the closed surfaces of the segmentations and is not compacted.
+    """
+    self.compactPolyData = compact
+
+  def _newPolyDatas(self, polyDatas=None):
+    """
+    Return the dict {segmentName: vtkPolyData} of a subject of polyDataDict, compact if compactPolyData.
+    """
+    if self.compactPolyData and self.saveCleanData:
+      return DataImporterCompactPolyDataDict(polyDatas)
+    return dict(polyDatas or {})
+
+  def setCreatePreviews(self, create):
+    """
+    If create, the previews (see getPreviewModelNodes) of the subjects imported afterwards are created
+    when their topology is computed, so that their closed surfaces are not created again to browse them.
+    """
+    self.createPreviews = create
+
+  def setPreviewNumberOfTriangles(self, numberOfTriangles):
+    """
+    Surfaces with more triangles than numberOfTriangles are decimated to about numberOfTriangles
+    in their previews, see getPreviewModelNodes. The existing previews are removed.
+    """
+    if numberOfTriangles != self.previewNumberOfTriangles:
+      self.removePreviewModelNodes()
+    self.previewNumberOfTriangles = numberOfTriangles
+
+  def setTopologyBackend(self, backend, voxelConnectivity=26):
+    """
+    backend is TOPOLOGY_BACKEND_SURFACE or TOPOLOGY_BACKEND_VOXEL.
+    With TOPOLOGY_BACKEND_VOXEL, the topology of label maps is computed on their voxels with
+    voxelConnectivity (6 or 26) and their closed surfaces are not created on import.
+    Models and segmentations always use their closed surface.
+    """
+    if backend not in [self.TOPOLOGY_BACKEND_SURFACE, self.TOPOLOGY_BACKEND_VOXEL]:
+      raise ValueError('Unknown topology backend {}'.format(backend))
+    if voxelConnectivity not in [6, 26]:
+      raise ValueError('Voxel connectivity must be 6 or 26, not {}'.format(voxelConnectivity))
+    self.topologyBackend = backend
+    self.voxelConnectivity = voxelConnectivity
+
+  def setResultStorePath(self, path):
+    """
+    Open (or create) the result store at path. An empty path disables the store.
+    """
+    if self.resultStore is not None:
+      if self.resultStore.path == path:
+        return
+      self.resultStore.close()
+      self.resultStore = None
+    if path:
+      self.resultStore = DataImporterResultStore(path)
+
+  def setModelFormat(self, modelFormat):
+    """
+    modelFormat is MODEL_FORMAT_VTK or MODEL_FORMAT_VTP, the format of the models written by generateShapeAnlaysisStructure.
+    """
+    if modelFormat not in [self.MODEL_FORMAT_VTK, self.MODEL_FORMAT_VTP]:
+      raise ValueError('Unknown model format {}'.format(modelFormat))
+    self.modelFormat = modelFormat
+
+  def setCheckLabelRange(self, check):
+    """
+    If check is False, subjects with a label range different from the one of the cohort are imported anyway,
+    for example by the shards of a cohort: mergeTopologyReports then rejects them, see labelRangeDict.
+    """
+    self.checkLabelRange = check
+
+  def setNumberOfWorkers(self, numberOfWorkers):
+    self.numberOfWorkers = max(1, int(numberOfWorkers))
+
+  def setMemoryBudget(self, megabytes):
+    """
+    Keep the nodes and polydata of the cohort under megabytes (0 is unlimited): the least recently used subjects
+    are spilled to disk, and reloaded when accessed through labelMapDict, modelDict, segmentationDict or polyDataDict.
+    """
+    self.memoryBudget = max(0, int(megabytes)) * 1024 * 1024
+    self.enforceMemoryBudget()
+
+  def getResidentMemorySize(self):
+    """ Return the size in bytes of the subjects in memory, as last measured. """
+    return sum(self.residentSubjects.values())
+
+  def _subjectMemorySize(self, nodeName):
+    """
+    Return the size in bytes of the nodes and polydata of the resident subject nodeName.
+    """
+    dataObjects = set()
+    if nodeName in self.labelMapDict:
+      dataObjects.add(self.labelMapDict.peek(nodeName).GetImageData())
+    if nodeName in self.modelDict:
+      dataObjects.add(self.modelDict.peek(nodeName).GetPolyData())
+    if nodeName in self.segmentationDict:
+      segmentation = self.segmentationDict.peek(nodeName).GetSegmentation()
+      representationNames = [slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName(),
+                             slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()]
+      for segmentIndex in range(segmentation.GetNumberOfSegments()):
+        segment = segmentation.GetNthSegment(segmentIndex)
+        for representationName in representationNames:
+          dataObjects.add(segment.GetRepresentation(representationName))
+    compactSize = 0
+    polyDatas = self.polyDataDict.peek(nodeName) if nodeName in self.polyDataDict else None
+    if isinstance(polyDatas, DataImporterCompactPolyDataDict):
+      compactSize = polyDatas.memorySize()
+    elif polyDatas:
+      dataObjects.update(polyDatas.values())
+    # Shared representations are counted once, GetActualMemorySize is in kibibytes
+    return sum(dataObject.GetActualMemorySize() for dataObject in dataObjects if dataObject is not None) * 1024 + compactSize
+
+  def updateSubjectMemorySize(self, nodeName):
+    """
+    Measure the size of the resident subject nodeName, mark it as most recently used and enforce the memory budget.
+    """
+    if nodeName not in self.segmentationDict or nodeName in self.spilledSubjects:
+      return
+    self.residentSubjects[nodeName] = self._subjectMemorySize(nodeName)
+    self.residentSubjects.move_to_end(nodeName)
+    self.enforceMemoryBudget()
+
+  def enforceMemoryBudget(self):
+    """
+    Spill the least recently used subjects until the resident size is under memoryBudget.
+    The most recently used subject and pinnedNodeNames are never spilled.
+    """
+    if self.memoryBudget <= 0:
+      return
+    residentSize = self.getResidentMemorySize()
+    for nodeName in list(self.residentSubjects)[:-1]:
+      if residentSize <= self.memoryBudget:
+        break
+      if nodeName in self.pinnedNodeNames:
+        continue
+      subjectSize = self.residentSubjects[nodeName]
+      if self._spillSubject(nodeName):
+        residentSize -= subjectSize
+
+  def _accessSubject(self, nodeName):
+    """
+    Access callback of the DataImporterNodeDicts: reload nodeName if spilled, and mark it as most recently used.
+    """
+    if nodeName in self.spilledSubjects:
+      self._reloadSubject(nodeName)
+      self.updateSubjectMemorySize(nodeName)
+    elif nodeName in self.residentSubjects:
+      self.residentSubjects.move_to_end(nodeName)
+
+  def _spillSubject(self, nodeName):
+    """
+    Save the segmentation and polydata of nodeName in spillDirectory and remove its nodes from the scene.
+    Label maps and models are reloaded from their source file.
+    Return False if the subject could not be spilled.
+    """
+    if nodeName not in self.sourcePathDict:
+      return False
+    if not self.spillDirectory:
+      self.spillDirectory = tempfile.mkdtemp(prefix='DataImporterSpill', dir=slicer.app.temporaryPath)
+    fileName = hashlib.sha1(nodeName.encode('utf-8')).hexdigest()
+
+    segmentationNode = self.segmentationDict.peek(nodeName)
+    segmentation = segmentationNode.GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    extension = '.seg.vtm' if segmentation.GetMasterRepresentationName() == closedSurfaceName else '.seg.nrrd'
+    segmentationPath = os.path.join(self.spillDirectory, fileName + extension)
+    if not slicer.util.saveNode(segmentationNode, segmentationPath):
+      logging.warning('Failed to spill {} to {}, keeping it in memory.'.format(nodeName, segmentationPath))
+      return False
+
+    polyDataPath = ''
+    polyDatas = self.polyDataDict.peek(nodeName) if nodeName in self.polyDataDict else None
+    if polyDatas:
+      polyDataPath = os.path.join(self.spillDirectory, fileName + '.polydata.json')
+      with open(polyDataPath, 'w') as f:
+        json.dump({segmentName: DataImporterResultStore.polyDataToString(polydata)
+                   for segmentName, polydata in polyDatas.items()}, f)
+    if nodeName in self.polyDataDict:
+      self.polyDataDict[nodeName] = None
+
+    self.spilledSubjects[nodeName] = {'segmentation': segmentationPath, 'polyData': polyDataPath,
+                                      'nodeName': segmentationNode.GetName()}
+    for nodeDict in [self.labelMapDict, self.modelDict, self.segmentationDict]:
+      if nodeName in nodeDict:
+        slicer.mrmlScene.RemoveNode(nodeDict.peek(nodeName))
+        nodeDict[nodeName] = None
+    self.residentSubjects.pop(nodeName, None)
+    return True
+
+  def _reloadSubject(self, nodeName):
+    """
+    Reload the nodes and polydata of the spilled subject nodeName, see _spillSubject.
+    """
+    spilledFiles = self.spilledSubjects.pop(nodeName)
+    sourcePath = self.sourcePathDict[nodeName]
+    if nodeName in self.labelMapDict:
+      labelMapNode = slicer.util.loadLabelVolume(sourcePath, returnNode=True)[1]
+      labelMapNode.SetDisplayVisibility(False)
+      if self.freesurfer_import:
+        self._keepFreeSurferWantedLabels(labelMapNode)
+      self.labelMapDict[nodeName] = labelMapNode
+    if nodeName in self.modelDict:
+      modelNode = slicer.util.loadModel(sourcePath, returnNode=True)[1]
+      modelNode.SetDisplayVisibility(False)
+      self.modelDict[nodeName] = modelNode
+
+    segmentationNode = slicer.util.loadSegmentation(spilledFiles['segmentation'], returnNode=True)[1]
+    segmentationNode.SetName(spilledFiles['nodeName'])
+    segmentationNode.SetDisplayVisibility(False)
+    segmentationNode.GetDisplayNode().SetAllSegmentsVisibility(False)
+    self.segmentationDict[nodeName] = segmentationNode
+    os.remove(spilledFiles['segmentation'])
+
+    if nodeName in self.polyDataDict:
+      polyDatas = {}
+      if spilledFiles['polyData']:
+        with open(spilledFiles['polyData']) as f:
+          polyDatas = {segmentName: DataImporterResultStore.stringToPolyData(string)
+                       for segmentName, string in json.load(f).items()}
+        os.remove(spilledFiles['polyData'])
+      self.polyDataDict[nodeName] = self._newPolyDatas(polyDatas)
+
   #
   # Reset all the data for data import
   #
   def cleanup(self):
     logging.debug('Deleting nodes')
+    # Spilled subjects are not reloaded to be deleted
     if self.labelMapDict is not None:
-      for nodeName in self.labelMapDict:
+      for nodeName, node in self.labelMapDict.residentItems():
         logging.debug('Deleting label map node: ' + nodeName)
-        slicer.mrmlScene.RemoveNode(self.labelMapDict[nodeName])
+        slicer.mrmlScene.RemoveNode(node)
 
     if self.modelDict is not None:
-      for nodeName in self.modelDict:
+      for nodeName, node in self.modelDict.residentItems():
         logging.debug('Deleting model node: ' + nodeName)
-        slicer.mrmlScene.RemoveNode(self.modelDict[nodeName])
+        slicer.mrmlScene.RemoveNode(node)
 
     if self.segmentationDict is not None:
-      for nodeName in self.segmentationDict:
+      for nodeName, node in self.segmentationDict.residentItems():
         logging.debug('Deleting segmentation node: ' + nodeName)
-        slicer.mrmlScene.RemoveNode(self.segmentationDict[nodeName])
+        slicer.mrmlScene.RemoveNode(node)
+
+    self.removePreviewModelNodes()
 
-    self.labelMapDict = {}
-    self.modelDict = {}
-    self.segmentationDict = {}
+    if self.spillDirectory:
+      shutil.rmtree(self.spillDirectory, ignore_errors=True)
+    self.spillDirectory = ''
+    self.spilledSubjects = {}
+    self.residentSubjects = OrderedDict()
+    self.pinnedNodeNames = set()
+
+    self.labelMapDict = DataImporterNodeDict(self._accessSubject)
+    self.modelDict = DataImporterNodeDict(self._accessSubject)
+    self.segmentationDict = DataImporterNodeDict(self._accessSubject)
     self.labelRangeInCohort = (-1, -1)
-    self.topologyDict = {}
-    self.polyDataDict = {}
+    self.labelRangeDict = {}
+    self.topologyDict = DataImporterTopologyMatrix()
+    self.topologyPropertiesDict = {}
+    self.polyDataDict = DataImporterNodeDict(self._accessSubject)
     self.expectedTopologiesBySegment = {}
     self.inconsistentTopologyDict = {}
+    self.outlierMetricsDict = {}
 
     self.TemplateName = ''
     self.numberOfDifferentSegments = 0
     self.dictSegmentNamesWithIntegers = dict()
+    self.sourcePathDict = {}
+    self.sourceSignatures = {}
+    self.importErrors = {}
 
   def __del__(self):
     self.cleanup()
@@ -131,23 +952,29 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     Return tuple [boolean, labelRange].
     boolean is false if not consistent with current self.labelRangeInCohort. True otherwise.
     labelRange is (0, inputNumberOfSegments)
+    Always consistent if checkLabelRange is False, see setCheckLabelRange.
     """
     labelRange = (0, inputNumberOfSegments)
-    if self.labelRangeInCohort != (-1, -1) and labelRange != self.labelRangeInCohort:
+    if self.checkLabelRange and self.labelRangeInCohort != (-1, -1) and labelRange != self.labelRangeInCohort:
       logging.error('Label range {} does not match with the existing label range in cohort {}.'.format(labelRange, self.labelRangeInCohort))
       return False, labelRange
 
     return True, labelRange
 
-  def importLabelMap(self, path):
+  def importLabelMap(self, path, createClosedSurface=True, labelMapVolume=None):
     """
     Populate labelMapDict, segmentationDict, labelRangeInCohort
     Fails if number of labels is different than pre-existing value for labelRangeInCohort
     Returns false if errors, and no class variable is modified.
+    If createClosedSurface is False, the closed surface representation is left to the caller.
+    labelMapVolume is the tuple (voxels, ijkToRAS) of path if already read, see readLabelMapVolume.
     """
     directory, fileName = os.path.split(path)
 
-    labelMapNode = slicer.util.loadLabelVolume(path, returnNode=True)[1]
+    if labelMapVolume is not None:
+      labelMapNode = self._labelMapNodeFromArray(self._nodeNameOfFile(fileName), *labelMapVolume)
+    else:
+      labelMapNode = slicer.util.loadLabelVolume(path, returnNode=True)[1]
     if labelMapNode is None:
       logging.error('Failed to load ' + fileName + 'as a labelmap')
       # make sure each one is a labelmap
@@ -155,6 +982,8 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
 
     file_name = os.path.splitext(fileName)[0]
     if self.freesurfer_import == True:
+      # Only the wanted labels are imported and converted
+      self._keepFreeSurferWantedLabels(labelMapNode)
       subject_name = os.path.split(os.path.split(directory)[0])[1]
       segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", subject_name+' '+file_name)
     else:
@@ -226,10 +1055,13 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
         segment.SetName(segment_name)
         segment.SetColor(color[:3])
 
-    closedSurface = segmentationNode.CreateClosedSurfaceRepresentation()
-    if closedSurface is False:
-      logging.error('Failed to create closed surface representation for filename: {}.'.format(path))
-      return False
+    createClosedSurface = (createClosedSurface and not self.lazyClosedSurfaces
+                           and self.topologyBackend != self.TOPOLOGY_BACKEND_VOXEL)
+    if createClosedSurface and not self._restoreCachedClosedSurfaces(path, segmentationNode):
+      closedSurface = segmentationNode.CreateClosedSurfaceRepresentation()
+      if closedSurface is False:
+        logging.error('Failed to create closed surface representation for filename: {}.'.format(path))
+        return False
 
     labelRangeConsistent, labelRange = self.checkLabelRangeConsistency(segmentationNode.GetSegmentation().GetNumberOfSegments())
     if not labelRangeConsistent:
@@ -244,20 +1076,84 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
 
       self.labelMapDict[name] = labelMapNode
       self.segmentationDict[name] = segmentationNode
+      self.sourcePathDict[name] = path
+      self.labelRangeDict[name] = labelRange
       self.labelRangeInCohort = labelRange
     else:
       self.labelMapDict[fileName] = labelMapNode
       self.segmentationDict[fileName] = segmentationNode
+      self.sourcePathDict[fileName] = path
+      self.labelRangeDict[fileName] = labelRange
       self.labelRangeInCohort = labelRange
 
     return True
 
-  def importModel(self, path):
+  @staticmethod
+  def _nodeNameOfFile(fileName):
+    """
+    Return the name given by slicer.util.loadLabelVolume to the node of fileName, without its extension.
+    """
+    name, extension = os.path.splitext(fileName)
+    if extension.lower() == '.gz':
+      name = os.path.splitext(name)[0]
+    return name
+
+  @staticmethod
+  def _labelMapNodeFromArray(name, voxels, ijkToRAS):
+    """
+    Return a new label map node named name with the KJI voxels array and the 4x4 ijkToRAS numpy matrix.
+    """
+    labelMapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', name)
+    slicer.util.updateVolumeFromArray(labelMapNode, voxels)
+    labelMapNode.SetIJKToRASMatrix(DataImporterLogic._vtkMatrixFromArray(ijkToRAS))
+    labelMapNode.CreateDefaultDisplayNodes()
+    return labelMapNode
+
+  @staticmethod
+  def _vtkMatrixFromArray(array):
+    """
+    Return the vtkMatrix4x4 of the 4x4 numpy matrix array.
+    """
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, array[row, column])
+    return matrix
+
+  def _keepFreeSurferWantedLabels(self, labelMapNode):
+    """
+    Set to background the voxels of labelMapNode whose label is not in freesurfer_wanted_segments,
+    so that the other segments are never created nor converted to closed surfaces.
+    """
+    self._maskUnwantedLabels(slicer.util.arrayFromVolume(labelMapNode), self._freeSurferWantedLabelValues())
+    slicer.util.arrayFromVolumeModified(labelMapNode)
+
+  def _freeSurferWantedLabelValues(self):
+    return [int(segmentId.split('_')[-1]) for segmentId in self.freesurfer_wanted_segments]
+
+  @staticmethod
+  def _maskUnwantedLabels(labelArray, wantedLabelValues):
+    """
+    Set to background, in place, the voxels of labelArray whose label is not in wantedLabelValues.
+    """
+    if labelArray.size == 0:
+      return
+    if np.issubdtype(labelArray.dtype, np.integer) and labelArray.min() >= 0:
+      # Lookup table mapping unwanted labels to 0, faster than np.isin
+      lookupTable = np.zeros(int(labelArray.max()) + 1, dtype=labelArray.dtype)
+      wantedInRange = [labelValue for labelValue in wantedLabelValues if labelValue < len(lookupTable)]
+      lookupTable[wantedInRange] = wantedInRange
+      labelArray[...] = lookupTable[labelArray]
+    else:
+      labelArray[~np.isin(labelArray, wantedLabelValues)] = 0
+
+  def importModel(self, path, createClosedSurface=True):
     """
     Create segmentation from a model (with only one shape). The labelRangeInCohort would be (0,1), just one segment.
     If your model is a model hierarchy (containing different shapes in the same file), use
     importModelHierarchy (not implemented).
     Populate segmentationDict and set labelRangeInCohort to (0,1)
+    If createClosedSurface is False, the closed surface representation is left to the caller.
     """
     directory, fileName = os.path.split(path)
     modelNode = slicer.util.loadModel(path, returnNode=True)[1]
@@ -276,12 +1172,13 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     # XXX Better option would be to use terminologies, see: https://discourse.slicer.org/t/finding-corresponding-segments-in-segmentations/4055/4
     file_name = os.path.splitext(fileName)[0]
     segmentationNode.GetSegmentation().GetSegment(modelNode.GetName()).SetName(file_name + ' 1')
-    closedSurface = segmentationNode.CreateClosedSurfaceRepresentation()
     segmentationNode.SetDisplayVisibility(False)
     # segmentationNode.GetDisplayNode().SetAllSegmentsVisibility(False)
-    if closedSurface is False:
-      logging.error('Failed to create closed surface representation for filename: {}.'.format(path))
-      return False
+    if createClosedSurface and not self.lazyClosedSurfaces:
+      closedSurface = segmentationNode.CreateClosedSurfaceRepresentation()
+      if closedSurface is False:
+        logging.error('Failed to create closed surface representation for filename: {}.'.format(path))
+        return False
 
     labelRangeConsistent, labelRange = self.checkLabelRangeConsistency(segmentationNode.GetSegmentation().GetNumberOfSegments())
     if not labelRangeConsistent:
@@ -291,6 +1188,8 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     # Add to the dicts only if succesful
     self.modelDict[fileName] = modelNode
     self.segmentationDict[fileName] = segmentationNode
+    self.sourcePathDict[fileName] = path
+    self.labelRangeDict[fileName] = labelRange
     self.labelRangeInCohort = labelRange
     return True
 
@@ -316,61 +1215,320 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
 
     # Add to the dicts only if succesful
     self.segmentationDict[fileName] = segmentationNode
+    self.sourcePathDict[fileName] = path
+    self.labelRangeDict[fileName] = labelRange
     self.labelRangeInCohort = labelRange
     return True
 
   def filePathsFromCSVFile(self, csvFileName):
     """
-    Return filePaths from CSV.
-    It assumes that csvFileName contains one filepath per row.
+    Return filePaths from CSV, see iterCSVManifest.
+    Checksums and metadata of the files are kept in sourceChecksums and sourceMetadata.
     """
+    self.sourceChecksums = {}
+    self.sourceMetadata = {}
     filePaths = []
-    with open(csvFileName, 'r') as csvfile:
-      has_header = csv.Sniffer().has_header(csvfile.read(1024))
+    for path, checksum, metadata in self.iterCSVManifest(csvFileName):
+      filePaths.append(path)
+      if checksum:
+        self.sourceChecksums[path] = checksum.lower()
+      if metadata:
+        self.sourceMetadata[path] = metadata
+    return filePaths
+
+  @classmethod
+  def iterCSVManifest(cls, csvFileName):
+    """
+    Generator reading csvFileName row by row and yielding tuples (path, checksum, metadata).
+    The file path is in the column named as one of MANIFEST_PATH_COLUMNS, or in the first column.
+    checksum is the SHA-256 of the file in the column named as one of MANIFEST_CHECKSUM_COLUMNS, None otherwise.
+    metadata is an OrderedDict of the other columns by name, for example subject ID, group or site.
+    Without header, each row is just a file path.
+    """
+    with open(csvFileName, 'r', newline='') as csvfile:
+      sample = csvfile.read(1024)
       csvfile.seek(0) # Rewind
       reader = csv.reader(csvfile)
-      # ignore the header
-      if has_header:
-        next(reader, None)
-      # assuming that each row is just a file path.
+      header = next(reader, None)
+      if header is None:
+        return
+      columnNames = [name.strip().lower() for name in header]
+      namedPathColumns = [name for name in cls.MANIFEST_PATH_COLUMNS if name in columnNames]
+      namedChecksumColumns = [name for name in cls.MANIFEST_CHECKSUM_COLUMNS if name in columnNames]
+      hasHeader = bool(namedPathColumns or namedChecksumColumns)
+      if not hasHeader:
+        try:
+          hasHeader = csv.Sniffer().has_header(sample)
+        except csv.Error:
+          pass
+      if not hasHeader:
+        reader = itertools.chain([header], reader)
+        header = []
+      pathColumn = columnNames.index(namedPathColumns[0]) if namedPathColumns else 0
+      checksumColumn = columnNames.index(namedChecksumColumns[0]) if namedChecksumColumns else None
+      metadataColumns = [(column, name.strip()) for column, name in enumerate(header)
+                         if column not in (pathColumn, checksumColumn)]
+
       for row in reader:
-        if len(row) > 0:
-          filePaths.append(row[0])
+        if len(row) <= pathColumn or not row[pathColumn]:
+          continue
+        checksum = row[checksumColumn].strip() if checksumColumn is not None and checksumColumn < len(row) else None
+        metadata = OrderedDict((name, row[column]) for column, name in metadataColumns if column < len(row))
+        yield row[pathColumn], checksum or None, metadata
 
+  @staticmethod
+  def filterFilePaths(filePaths):
+    """
+    Return filtered filePaths of files that are readable by this module.
+    """
+    filteredFilePaths = list()
+    for filePath in filePaths:
+      fileType = DataImporterLogic.fileTypeOf(filePath)
+      if fileType == 'VolumeFile' or fileType == 'SegmentationFile' or fileType == 'ModelFile':
+        filteredFilePaths.append(filePath)
+    return filteredFilePaths
+
+  @classmethod
+  def fileTypeOf(cls, filePath):
+    """
+    Return the Slicer file type of filePath, for example 'VolumeFile', or 'NoFile'. It is decided from the extension
+    (FILE_TYPES_BY_EXTENSION, IGNORED_EXTENSIONS) when possible, otherwise by the IO manager once per extension.
+    """
+    fileName = os.path.basename(filePath).lower()
+    for extension, fileType in cls.FILE_TYPES_BY_EXTENSION:
+      if fileName.endswith(extension):
+        return fileType
+    root, extension = os.path.splitext(fileName)
+    if extension in cls.IGNORED_EXTENSIONS:
+      return 'NoFile'
+    if extension == '.gz':
+      extension = os.path.splitext(root)[1] + extension
+    if extension not in cls._fileTypesByExtension:
+      cls._fileTypesByExtension[extension] = slicer.app.ioManager().fileType(filePath)
+    return cls._fileTypesByExtension[extension]
+
+  def filePathsFromDirectory(self, directoryPath, recursive=False, includePatterns=(), excludePatterns=()):
+    """
+    Return the sorted paths of the files in directoryPath readable by this module, and in its subdirectories if recursive.
+    Files are kept if their path relative to directoryPath, or their name, matches one of includePatterns (if any)
+    and none of excludePatterns (glob patterns, for example '*.nrrd'). Excluded subdirectories are not walked.
+    """
+    def matches(relativePath, patterns):
+      name = os.path.basename(relativePath)
+      return any(fnmatch.fnmatch(relativePath, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    relativePaths = []
+    for root, directoryNames, fileNames in os.walk(directoryPath):
+      relativeRoot = os.path.relpath(root, directoryPath)
+      relativeRoot = '' if relativeRoot == os.curdir else relativeRoot
+      if recursive:
+        directoryNames[:] = [name for name in directoryNames if not matches(os.path.join(relativeRoot, name), excludePatterns)]
+      else:
+        directoryNames[:] = []
+      for fileName in fileNames:
+        relativePath = os.path.join(relativeRoot, fileName)
+        if includePatterns and not matches(relativePath, includePatterns):
+          continue
+        if not matches(relativePath, excludePatterns):
+          relativePaths.append(relativePath)
+
+    filePaths = self.filterFilePaths([os.path.join(directoryPath, relativePath) for relativePath in sorted(relativePaths)])
+    duplicateFileNames = [name for name, count in Counter(os.path.basename(path) for path in filePaths).items() if count > 1]
+    if duplicateFileNames:
+      logging.warning('{} file names are in several directories, subjects are named after their file name: {}'.format(
+        len(duplicateFileNames), ', '.join(sorted(duplicateFileNames)[:10])))
     return filePaths
 
-        # Depending on the mode fill the structures table.
-        # TODO: add directory parsing based on mode
-    # else:
-    #   logging.error("Importing from directory is not yet supported")
+  def filePathsFromFreeSurferSubjectsDirectory(self, subjectsPath, relativeFilePath):
+    """
+    Return the sorted paths of relativeFilePath (for example mri/aseg.mgz) in the subjects of subjectsPath.
+    """
+    index = self.loadFreeSurferSubjectsIndex(subjectsPath)
+    self.updateFreeSurferSubjectsIndex(index, [relativeFilePath])
+    self.saveFreeSurferSubjectsIndex(index)
+    return [filePath for subjectName, filePath in self.filePathsFromFreeSurferSubjectsIndex(index, relativeFilePath)]
+
+  @staticmethod
+  def freeSurferSubjectsIndexPath(subjectsPath):
+    subjectsPathHash = hashlib.sha1(os.path.abspath(subjectsPath).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(slicer.app.cachePath, 'DataImporter', 'SubjectsIndex-{}.json'.format(subjectsPathHash))
+
+  def loadFreeSurferSubjectsIndex(self, subjectsPath):
+    """
+    Return the index of subjectsPath saved by saveFreeSurferSubjectsIndex, or an empty index.
+    See updateFreeSurferSubjectsIndex.
+    """
+    index = {'version': self.SUBJECTS_INDEX_VERSION, 'subjectsPath': os.path.abspath(subjectsPath),
+             'relativeFilePaths': [], 'subjects': {}}
+    indexPath = self.freeSurferSubjectsIndexPath(subjectsPath)
+    if os.path.isfile(indexPath):
+      try:
+        with open(indexPath) as f:
+          savedIndex = json.load(f)
+        if savedIndex.get('version') == self.SUBJECTS_INDEX_VERSION and savedIndex.get('subjectsPath') == index['subjectsPath']:
+          index = savedIndex
+      except ValueError as e:
+        logging.warning('Ignoring invalid subjects index {}: {}'.format(indexPath, e))
+    return index
+
+  def saveFreeSurferSubjectsIndex(self, index):
+    indexPath = self.freeSurferSubjectsIndexPath(index['subjectsPath'])
+    try:
+      if not os.path.isdir(os.path.dirname(indexPath)):
+        os.makedirs(os.path.dirname(indexPath))
+      # Replaced at once, several processes may share the index
+      temporaryPath = '{}.{}.tmp'.format(indexPath, os.getpid())
+      with open(temporaryPath, 'w') as f:
+        json.dump(index, f)
+      os.replace(temporaryPath, indexPath)
+    except OSError as e:
+      logging.warning('Unable to save subjects index {}: {}'.format(indexPath, e))
+
+  def updateFreeSurferSubjectsIndex(self, index, relativeFilePaths):
+    """
+    Update index {'subjectsPath', 'relativeFilePaths', 'subjects': {subjectName: {'directories': {relativeDirectory: mtime},
+    'files': {relativeFilePath: mtime}}}} with the files of relativeFilePaths present in each subject.
+    Subjects are listed with os.scandir and checked in SUBJECTS_SCAN_WORKERS threads. The files of a subject are only
+    checked again if the modification time of one of their directories changed.
+    Return the sorted names of the subjects added, removed or changed.
+    """
+    subjectsPath = index['subjectsPath']
+    relativeFilePaths = sorted(set(relativeFilePaths) | set(index['relativeFilePaths']))
+    if relativeFilePaths != index['relativeFilePaths']:
+      # New files of interest, every subject has to be checked
+      index['subjects'] = {}
+      index['relativeFilePaths'] = relativeFilePaths
+    relativeDirectories = sorted(set(os.path.dirname(relativeFilePath) for relativeFilePath in relativeFilePaths))
+
+    with os.scandir(subjectsPath) as entries:
+      subjectNames = [entry.name for entry in entries if entry.is_dir()]
+
+    def scanSubject(subjectName):
+      subjectPath = os.path.join(subjectsPath, subjectName)
+      directories = {}
+      for relativeDirectory in relativeDirectories:
+        try:
+          directories[relativeDirectory] = os.stat(os.path.join(subjectPath, relativeDirectory)).st_mtime
+        except OSError:
+          directories[relativeDirectory] = None
+      previous = index['subjects'].get(subjectName)
+      if previous is not None and previous['directories'] == directories:
+        return None
+      files = {}
+      for relativeFilePath in relativeFilePaths:
+        try:
+          files[relativeFilePath] = os.stat(os.path.join(subjectPath, relativeFilePath)).st_mtime
+        except OSError:
+          pass
+      return {'directories': directories, 'files': files}
+
+    changedSubjectNames = set(index['subjects']) - set(subjectNames)
+    for subjectName in changedSubjectNames:
+      del index['subjects'][subjectName]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.SUBJECTS_SCAN_WORKERS) as executor:
+      for subjectName, subject in zip(subjectNames, executor.map(scanSubject, subjectNames)):
+        if subject is not None:
+          if index['subjects'].get(subjectName, {}).get('files') != subject['files']:
+            changedSubjectNames.add(subjectName)
+          index['subjects'][subjectName] = subject
+    return sorted(changedSubjectNames)
+
+  @staticmethod
+  def filePathsFromFreeSurferSubjectsIndex(index, relativeFilePath):
+    """
+    Return the sorted list of tuples (subjectName, path) of the subjects of index having relativeFilePath.
+    """
+    return [(subjectName, os.path.join(index['subjectsPath'], subjectName, relativeFilePath))
+            for subjectName, subject in sorted(index['subjects'].items()) if relativeFilePath in subject['files']]
 
   def importFiles(self, filePaths):
     """
     Call the appropiate import function from a heteregeneous list of file paths.
     Raises TypeError if not existent file or unhandled filetype by this module.
+    If filePaths is an iterator, the files are validated as they are consumed instead:
+    not existent files or unhandled filetypes are recorded in importErrors.
     Files with a different number of labels/segments than the first one loaded are ignored with a warning.
+    If numberOfWorkers is greater than one, the closed surfaces and topologies of label maps are computed
+    in worker processes (see _importFilesInParallel) and topologyDict is populated for them.
     Return true if success, raise error otherwise.
     """
+    if isinstance(filePaths, Iterator):
+      pathsAndFileTypes = [(path, fileType) for path, fileType in self._classifyFilePathsLazily(filePaths) if fileType]
+    else:
+      pathsAndFileTypes = self._classifyFilePaths(filePaths)
+
+    if self.numberOfWorkers > 1:
+      return self._importFilesInParallel(pathsAndFileTypes)
+
+    for path, fileType in pathsAndFileTypes:
+      self._importFile(path, fileType)
+
+    return True
+
+  def importFilesIncrementally(self, filePaths):
+    """
+    Streaming version of importFiles followed by populateTopologyDictionary.
+    Raises TypeError like importFiles before importing anything, unless filePaths is an iterator:
+    files are then validated batch by batch, see importFiles.
+    Return a generator importing the files in batches of numberOfWorkers files. After each batch it yields
+    tuple (numberOfProcessedFiles, nodeNames), nodeNames being the nodes imported in the batch, with their
+    topology computed. Closing the generator stops the import after the current batch, keeping what is done.
+    """
+    if isinstance(filePaths, Iterator):
+      return self._importIncrementally(self._classifyFilePathsLazily(filePaths))
+    return self._importIncrementally(self._classifyFilePaths(filePaths))
+
+  def _importIncrementally(self, pathsAndFileTypes):
+    batchSize = self.numberOfWorkers
+    pathsAndFileTypes = iter(pathsAndFileTypes)
+    numberOfProcessedFiles = 0
+    while True:
+      batch = list(itertools.islice(pathsAndFileTypes, batchSize))
+      if not batch:
+        return
+      numberOfProcessedFiles += len(batch)
+      batch = [(path, fileType) for path, fileType in batch if fileType]
+      numberOfImportedNodes = len(self.segmentationDict)
+      if self.numberOfWorkers > 1:
+        self._importFilesInParallel(batch)
+      else:
+        for path, fileType in batch:
+          self._importFile(path, fileType)
+      nodeNames = list(itertools.islice(self.segmentationDict, numberOfImportedNodes, None))
+      self.populateTopologyDictionary(nodeNames)
+      yield numberOfProcessedFiles, nodeNames
+
+  def _classifyFilePathsLazily(self, filePaths):
+    """
+    Generator version of _classifyFilePaths, yielding a tuple (path, fileType) for each path of filePaths when
+    it is consumed. fileType is None for the files that are not imported, errors are recorded in importErrors.
+    """
+    for path in filePaths:
+      try:
+        pathsAndFileTypes = self._classifyFilePaths([path])
+      except TypeError as e:
+        logging.warning(e)
+        self.importErrors[path] = str(e)
+        pathsAndFileTypes = []
+      yield pathsAndFileTypes[0] if pathsAndFileTypes else (path, None)
+
+  def _classifyFilePaths(self, filePaths):
+    """
+    Return list of tuples (path, fileType) of the filePaths that have the expected file type.
+    Raises TypeError if not existent file or unhandled filetype by this module.
+    """
     self.found_segments = []
+    pathsAndFileTypes = []
     for path in filePaths:
-      fileType = slicer.app.ioManager().fileType(path)
+      fileType = self.fileTypeOf(path) if os.path.isfile(path) else 'NoFile'
       logging.debug("Path [{}] has file type [{}]".format(path, fileType))
 
-      if fileType == 'VolumeFile':
-        if self.expected_file_type == 'None' or self.expected_file_type == fileType:
-          self.importLabelMap(path)
-        else:
-          logging.debug("Path [{}] ignored, expected file type is [{}]".format(path, self.expected_file_type))
-
-      elif fileType == 'SegmentationFile':
-        if self.expected_file_type == 'None' or self.expected_file_type == fileType:
-          self.importSegmentation(path)
-        else:
-          logging.debug("Path [{}] ignored, expected file type is [{}]".format(path, self.expected_file_type))
-
-      elif fileType == 'ModelFile':
+      if fileType == 'VolumeFile' or fileType == 'SegmentationFile' or fileType == 'ModelFile':
         if self.expected_file_type == 'None' or self.expected_file_type == fileType:
-          self.importModel(path)
+          pathsAndFileTypes.append((path, fileType))
+          if self.resultStore is not None and path in self.sourceChecksums:
+            self.resultStore.setFileHash(path, self.sourceChecksums[path])
+          self.sourceSignatures[path] = self._sourceSignature(path)
         else:
           logging.debug("Path [{}] ignored, expected file type is [{}]".format(path, self.expected_file_type))
 
@@ -379,8 +1537,287 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
       else:
         raise TypeError("Path [{}] has file type [{}], but this module does not handle it".format(path, fileType))
 
+    return pathsAndFileTypes
+
+  def _importFile(self, path, fileType, createClosedSurface=True, labelMapVolume=None):
+    """
+    Dispatch path to importLabelMap, importSegmentation or importModel depending on fileType.
+    Files failing to import, for example with another label range than the cohort, are recorded in importErrors.
+    """
+    if fileType == 'VolumeFile':
+      imported = self.importLabelMap(path, createClosedSurface, labelMapVolume)
+    elif fileType == 'ModelFile':
+      imported = self.importModel(path, createClosedSurface)
+    else:
+      imported = self.importSegmentation(path)
+    if not imported:
+      self.importErrors[path] = 'Failed to import file'
+    return imported
+
+  def _importFilesInParallel(self, pathsAndFileTypes):
+    """
+    Import the files with a pool of numberOfWorkers processes: each worker reads a label map, creates the
+    closed surfaces of its labels and computes their topology (see computeLabelMapFileTopology), then the
+    main thread creates the nodes from the returned arrays and merges the results in the input order, since
+    only the main thread accesses the MRML scene. Only 2 * numberOfWorkers files are in flight.
+    Models, segmentations, label maps using the voxel backend and label maps with results in the resultStore
+    are imported on the main thread, populateTopologyDictionary computes their topology.
+    A file failing in a worker is stored in importErrors and no node is created for it,
+    the rest of the cohort is still imported.
+    Workers are forked from the application: without fork (Windows), the files are imported on the main thread.
+    Return True.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+      logging.warning('Worker processes are not supported on this platform, importing on the main thread.')
+      for path, fileType in pathsAndFileTypes:
+        self._importFile(path, fileType)
+      return True
+
+    wantedLabelValues = self._freeSurferWantedLabelValues() if self.freesurfer_import else None
+    keepClosedSurfaces = not self.lazyClosedSurfaces or self.resultStore is not None or self.createPreviews
+    pathsAndFileTypes = iter(pathsAndFileTypes)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+      jobs = deque()
+
+      def submitJobs():
+        for path, fileType in itertools.islice(pathsAndFileTypes, 2 * self.numberOfWorkers - len(jobs)):
+          future = None
+          if self._needsWorkerProcess(path, fileType):
+            future = executor.submit(importLabelMapInWorkerProcess, path, wantedLabelValues,
+                                     self.saveCleanData, keepClosedSurfaces)
+          jobs.append((path, fileType, future))
+
+      submitJobs()
+      while jobs:
+        path, fileType, future = jobs.popleft()
+        submitJobs()
+        if future is None:
+          self._importFile(path, fileType)
+          continue
+        try:
+          result = future.result()
+        except Exception as e:
+          logging.error('Failed to import {} in a worker process. {}'.format(path, e))
+          self.importErrors[path] = str(e)
+          continue
+        numberOfImportedNodes = len(self.segmentationDict)
+        if not self._importFile(path, fileType, createClosedSurface=False,
+                                labelMapVolume=(result['voxels'], result['ijkToRAS'])):
+          continue
+        for name in list(itertools.islice(self.segmentationDict, numberOfImportedNodes, None)):
+          if not self._mergeLabelMapFileTopology(name, result):
+            logging.warning('Segments of {} do not match the worker results, computing them again.'.format(name))
+
     return True
 
+  def _needsWorkerProcess(self, path, fileType):
+    """
+    Return False for the files imported on the main thread by _importFilesInParallel.
+    """
+    if fileType != 'VolumeFile' or self.topologyBackend == self.TOPOLOGY_BACKEND_VOXEL:
+      return False
+    return (self.resultStore is None
+            or not self.resultStore.hasResults(self._sourceFileHash(path), self.TOPOLOGY_ALGORITHM))
+
+  def _mergeLabelMapFileTopology(self, name, result):
+    """
+    Add the closed surfaces and topologies of result, see computeLabelMapFileTopology, to the subject name
+    imported from the same file, and store them in the resultStore.
+    Return False, without modifying anything, if the segments of name do not match result.
+    """
+    segmentationNode = self.segmentationDict[name]
+    segmentation = segmentationNode.GetSegmentation()
+    if segmentation.SerializeAllConversionParameters() != result['conversionParameters']:
+      return False
+    segmentIds = [segmentation.GetNthSegmentID(index) for index in range(segmentation.GetNumberOfSegments())]
+    labelValues = {segmentId: self._labelValueFromSegmentId(segmentId) for segmentId in segmentIds}
+    if any(labelValue not in result['segments'] for labelValue in labelValues.values()):
+      return False
+
+    topologies = {}
+    properties = {}
+    polyDatas = {}
+    closedSurfaces = {}
+    results = {}
+    for segmentId in segmentIds:
+      segmentProperties, closedSurface, cleanArrays = result['segments'][labelValues[segmentId]]
+      closedSurface = DataImporterResultStore.stringToPolyData(closedSurface)
+      if closedSurface is not None:
+        closedSurfaces[segmentId] = closedSurface
+      segmentName = segmentation.GetSegment(segmentId).GetName()
+      # 0 label is assumed to be the background.
+      if segmentName == "0":
+        continue
+      cleanData = self._arraysToPolyData(*cleanArrays) if cleanArrays is not None else None
+      topologies[segmentName] = segmentProperties['euler']
+      properties[segmentName] = segmentProperties
+      polyDatas[segmentName] = cleanData if self.saveCleanData else closedSurface
+      results[segmentName] = (segmentProperties['euler'], segmentProperties, closedSurface, cleanData)
+
+    if not self.lazyClosedSurfaces:
+      closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+      for segmentId, closedSurface in closedSurfaces.items():
+        segmentation.GetSegment(segmentId).AddRepresentation(closedSurfaceName, closedSurface)
+    self.topologyDict[name] = topologies
+    self.topologyPropertiesDict[name] = properties
+    self.polyDataDict[name] = self._newPolyDatas() if self.lazyClosedSurfaces else self._newPolyDatas(polyDatas)
+    if self.createPreviews:
+      self._createPreviewModelNodes(name, closedSurfaces)
+    if self.resultStore is not None and results:
+      self.resultStore.setResults(self._sourceFileHash(self.sourcePathDict[name]),
+                                  self._resultStoreParameters(segmentation), results)
+    self.updateSubjectMemorySize(name)
+    return True
+
+  @classmethod
+  def computeLabelMapFileTopology(cls, path, wantedLabelValues=None, createCleanData=False, keepClosedSurfaces=True):
+    """
+    Read the label map in path, create the closed surface of each label and compute its topology without
+    accessing the scene, so that it can run in worker processes (see importLabelMapInWorkerProcess).
+    If wantedLabelValues is not None, the other labels are set to background first.
+    Return dict {'voxels': KJI array, 'ijkToRAS': 4x4 matrix, see readLabelMapVolume,
+    'conversionParameters': serialized conversion parameters of the closed surfaces,
+    'segments': {labelValue: (properties, closedSurface, cleanArrays)}}, where properties is
+    computed by computeTopologyFromArrays, closedSurface is serialized with polyDataToString if keepClosedSurfaces
+    (None otherwise), and cleanArrays is tuple (cleanPoints, cleanTriangles) if createCleanData (None otherwise).
+    Raises ValueError if the file cannot be read, RuntimeError if the closed surfaces cannot be created.
+    """
+    voxels, ijkToRAS = cls.readLabelMapVolume(path)
+    if wantedLabelValues is not None:
+      cls._maskUnwantedLabels(voxels, wantedLabelValues)
+    segmentation = cls._segmentationFromLabelArray(voxels, ijkToRAS)
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    if segmentation.GetNumberOfSegments() and not segmentation.CreateRepresentation(closedSurfaceName):
+      raise RuntimeError('Failed to create closed surface representation')
+
+    segments = {}
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      segmentId = segmentation.GetNthSegmentID(segmentIndex)
+      polydata = segmentation.GetSegment(segmentId).GetRepresentation(closedSurfaceName)
+      if polydata is None:
+        continue
+      properties, cleanPoints, cleanTriangles = cls.computeTopologyFromArrays(*cls._polyDataToArrays(polydata))
+      segments[cls._labelValueFromSegmentId(segmentId)] = (
+        properties,
+        DataImporterResultStore.polyDataToString(polydata) if keepClosedSurfaces else None,
+        (cleanPoints, cleanTriangles) if createCleanData else None)
+    return {'voxels': voxels, 'ijkToRAS': ijkToRAS,
+            'conversionParameters': segmentation.SerializeAllConversionParameters(), 'segments': segments}
+
+  @classmethod
+  def _segmentationFromLabelArray(cls, voxels, ijkToRAS):
+    """
+    Return a standalone vtkSegmentation with a binary labelmap segment 'Label_<value>' for each non zero label
+    of the KJI voxels array, cropped to the voxels of the label. Labels stored as floats are truncated.
+    """
+    if voxels.dtype.kind == 'f':
+      voxels = voxels.astype(np.int64)
+    binaryLabelmapName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+    imageToWorld = cls._vtkMatrixFromArray(ijkToRAS)
+    segmentation = slicer.vtkSegmentation()
+    segmentation.SetMasterRepresentationName(binaryLabelmapName)
+    for labelValue in cls._labelValuesOfArray(voxels):
+      if labelValue == 0:
+        continue
+      mask = voxels == labelValue
+      # Extent [iMin, iMax, jMin, jMax, kMin, kMax] of the label
+      extent = []
+      for axis in [2, 1, 0]:
+        indices = np.flatnonzero(mask.any(axis=tuple(otherAxis for otherAxis in range(3) if otherAxis != axis)))
+        extent += [int(indices[0]), int(indices[-1])]
+      image = slicer.vtkOrientedImageData()
+      image.SetExtent(extent)
+      image.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+      image.SetImageToWorldMatrix(imageToWorld)
+      numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())[:] = \
+        mask[extent[4]:extent[5] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1].ravel()
+      segment = slicer.vtkSegment()
+      segment.SetName(str(labelValue))
+      segment.AddRepresentation(binaryLabelmapName, image)
+      segmentation.AddSegment(segment, 'Label_{}'.format(labelValue))
+    return segmentation
+
+  def _sourceFileHash(self, path):
+    """
+    Return the SHA-256 of the file in path, from the resultStore if any. The hash of an imported file is kept
+    in sourceSignatures until the file changes, so that it is computed at most once.
+    """
+    stat = os.stat(path)
+    signature = self.sourceSignatures.get(path)
+    unchanged = signature is not None and signature['mtime'] == stat.st_mtime and signature['size'] == stat.st_size
+    if unchanged and signature['sha256'] is not None:
+      return signature['sha256']
+    fileHash = self.resultStore.fileHash(path) if self.resultStore is not None else DataImporterResultStore.computeFileHash(path)
+    if unchanged:
+      signature['sha256'] = fileHash
+    return fileHash
+
+  def _sourceSignature(self, path):
+    """
+    Return dict {'mtime', 'size', 'sha256'} of the file in path. The content is not read: sha256 is the checksum
+    of the CSV manifest if there is one, otherwise None until _sourceFileHash computes it.
+    """
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': self.sourceChecksums.get(path)}
+
+  def _sourceChanged(self, path):
+    """
+    Return True if the file in path changed since it was imported. Files with a new modification time
+    but the same size and content hash are not considered changed. The content is only hashed in that case,
+    and only if the hash on import is known (CSV checksum, resultStore or shape analysis manifest).
+    """
+    previous = self.sourceSignatures.get(path)
+    if previous is None or not os.path.isfile(path):
+      return True
+    stat = os.stat(path)
+    if stat.st_mtime == previous['mtime'] and stat.st_size == previous['size']:
+      return False
+    if (stat.st_size == previous['size'] and previous['sha256'] is not None
+        and self._sourceFileHash(path) == previous['sha256']):
+      previous['mtime'] = stat.st_mtime
+      return False
+    return True
+
+  def updateImportedFiles(self, filePaths):
+    """
+    Prepare the update of the current import to filePaths, instead of importing everything again:
+    the subjects whose file is not in filePaths anymore, or changed, are removed.
+    Return tuple (removedNodeNames, filePathsToImport), filePathsToImport being the new and changed files in the order
+    of filePaths. Import them with importFiles or importFilesIncrementally, then update the consistency with
+    populateInconsistentTopologyDict. Expected topologies are kept.
+    """
+    nodeNamesByPath = {path: nodeName for nodeName, path in self.sourcePathDict.items()}
+    filePathSet = set(filePaths)
+    removedNodeNames = [nodeName for path, nodeName in nodeNamesByPath.items()
+                        if path not in filePathSet or self._sourceChanged(path)]
+    for nodeName in removedNodeNames:
+      self.sourceSignatures.pop(self.sourcePathDict[nodeName], None)
+      self.removeImportedNode(nodeName)
+    if self.TemplateName in removedNodeNames:
+      self.TemplateName = ''
+    filePathsToImport = [path for path in filePaths if path not in nodeNamesByPath or nodeNamesByPath[path] in removedNodeNames]
+    for path in filePathsToImport:
+      self.importErrors.pop(path, None)
+    return removedNodeNames, filePathsToImport
+
+  def removeImportedNode(self, nodeName):
+    """
+    Remove from the scene and from all the dictionaries the nodes imported with name nodeName.
+    """
+    for nodeDict in [self.labelMapDict, self.modelDict, self.segmentationDict]:
+      if nodeName in nodeDict:
+        node = nodeDict.pop(nodeName)
+        if node is not None:
+          slicer.mrmlScene.RemoveNode(node)
+    for resultDict in [self.topologyDict, self.topologyPropertiesDict, self.polyDataDict, self.inconsistentTopologyDict,
+                       self.outlierMetricsDict, self.sourcePathDict, self.labelRangeDict, self.residentSubjects]:
+      resultDict.pop(nodeName, None)
+    self.removePreviewModelNodes(nodeName)
+    spilledFiles = self.spilledSubjects.pop(nodeName, {})
+    for path in [spilledFiles.get('segmentation'), spilledFiles.get('polyData')]:
+      if path and os.path.exists(path):
+        os.remove(path)
+
   def _computeModeOfSegment(self, inputTopologyDict, inputSegmentName):
     """
     Compute the mode of the segmentName among the population
@@ -416,68 +1853,582 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     # dev: in most_common elements with equal counts are ordered arbitrarily
     return Counter(segmentTopologies).most_common(1)[0][0]
 
+  @staticmethod
+  def _topologyMatrix(inputTopologyDictionary):
+    if isinstance(inputTopologyDictionary, DataImporterTopologyMatrix):
+      return inputTopologyDictionary
+    return DataImporterTopologyMatrix(inputTopologyDictionary)
+
+  def _setExpectedTopologies(self, topologyMatrix, expected):
+    """
+    Populate expectedTopologiesBySegment from the array expected of the segments of topologyMatrix.
+    Segments no subject has are skipped. Missing or unknown topology types are replaced by multiple holes.
+    """
+    present = topologyMatrix.presentSegmentsMask()
+    expected = np.where(expected == topologyMatrix.MISSING, self.TOPOLOGY_MULTIPLE_HOLES_TYPE, expected)
+    invalid = present & ~np.isin(expected, list(self.TOPOLOGY_TYPES))
+    segmentNames = topologyMatrix.segmentNames()
+    for column in np.flatnonzero(invalid):
+      logging.warning("Topology: [{}] for segmentName: '{}', shows multiple holes. Use a key from {}".format(expected[column], segmentNames[column], self.TOPOLOGY_TYPES))
+    expected[invalid] = self.TOPOLOGY_MULTIPLE_HOLES_TYPE
+    self.expectedTopologiesBySegment = {segmentNames[column]: int(expected[column]) for column in np.flatnonzero(present)}
+
   def initExpectedTopologyBySegmentWithModes(self, inputTopologyDictionary):
     """
     Compute the mode of each segment, populating the dict:
     Example::
     {'segmentName0' : 2, 'segmentName1': 0'}
     Where the integers correspond to the enum TOPOLOGY_TYPES
+    Modes of all the segments are computed at once, see DataImporterTopologyMatrix.computeModes.
+    """
+    topologyMatrix = self._topologyMatrix(inputTopologyDictionary)
+    self._setExpectedTopologies(topologyMatrix, topologyMatrix.computeModes())
+
+  def initExpectedTopologyBySubjectTemplate(self, inputTopologyDictionary, templateName):
+    """
+    Populate the dict from the selected template subject:
+    Example::
+    {'segmentName0' : 2, 'segmentName1': 0'}
+    Where the integers correspond to the enum TOPOLOGY_TYPES
+    """
+    topologyMatrix = self._topologyMatrix(inputTopologyDictionary)
+    self._setExpectedTopologies(topologyMatrix, topologyMatrix.templateTopologies(templateName))
+
+  def setExpectedTopology(self, segmentName, topologyType):
+    """
+    Set the expected topology of segmentName, and keep it in the resultStore if any.
+    """
+    self.expectedTopologiesBySegment[segmentName] = topologyType
+    if self.resultStore is not None:
+      self.resultStore.setExpectedTopologies({segmentName: topologyType})
+
+  def setTemplateName(self, templateName):
+    """
+    Use the subject templateName as template: expected topologies become its topologies, and are kept in the
+    resultStore if any. Return the names of the segments whose expected topology changed,
+    see updateInconsistentTopologyDictForSegments.
+    """
+    previousExpectedTopologies = dict(self.expectedTopologiesBySegment)
+    self.TemplateName = templateName
+    self.initExpectedTopologyBySubjectTemplate(self.topologyDict, templateName)
+    self.saveExpectedTopologies()
+    return [segmentName for segmentName, topologyType in self.expectedTopologiesBySegment.items()
+            if previousExpectedTopologies.get(segmentName) != topologyType]
+
+  def saveExpectedTopologies(self):
+    """
+    Keep all the expectedTopologiesBySegment in the resultStore if any.
+    """
+    if self.resultStore is not None:
+      self.resultStore.setExpectedTopologies(self.expectedTopologiesBySegment)
+
+  def setFreeSurferimport(self, bool):
+    self.freesurfer_import = bool
+
+  def setExpectedFileType(self, filetype):
+    self.expected_file_type = filetype
+
+  def setColorTableId(self, id):
+    self.color_table_id = id
+
+  #
+  # Function to estimate topology of segmentations, and check for consistencies.
+  #
+  @staticmethod
+  def _polyDataToArrays(polydata):
+    """
+    Return tuple (points, triangles) as NumPy views of the polydata arrays when possible.
+    Polygons that are not triangles are triangulated first, this does not change the Euler number.
+    """
+    if polydata.GetNumberOfPoints() == 0 or polydata.GetNumberOfPolys() == 0:
+      return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    polys = polydata.GetPolys()
+    if hasattr(polys, 'GetConnectivityArray'):
+      offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+      if np.all(np.diff(offsets) == 3):
+        return points, numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    else:
+      legacyCells = numpy_support.vtk_to_numpy(polys.GetData())
+      if len(legacyCells) % 4 == 0 and np.all(legacyCells[::4] == 3):
+        return points, legacyCells.reshape(-1, 4)[:, 1:]
+
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.SetInputData(polydata)
+    triangleFilter.Update()
+    return DataImporterLogic._polyDataToArrays(triangleFilter.GetOutput())
+
+  @staticmethod
+  def _arraysToPolyData(points, triangles):
+    """
+    Return a vtkPolyData with the given points and triangles.
+    """
+    polydata = vtk.vtkPolyData()
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+    polydata.SetPoints(vtkPoints)
+    legacyCells = np.empty((len(triangles), 4), dtype=numpy_support.ID_TYPE_CODE)
+    legacyCells[:, 0] = 3
+    legacyCells[:, 1:] = triangles
+    cellArray = vtk.vtkCellArray()
+    cellArray.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(legacyCells.ravel(), deep=True))
+    polydata.SetPolys(cellArray)
+    return polydata
+
+  @staticmethod
+  def _labelConnectedComponents(numberOfVertices, edgesA, edgesB):
+    """
+    Union-find over the graph of numberOfVertices vertices and edges (edgesA[i], edgesB[i]),
+    vectorised by hooking each root to the smallest neighbouring root, followed by pointer jumping.
+    Return array with the smallest vertex id of the component of each vertex.
+    """
+    labels = np.arange(numberOfVertices)
+    while True:
+      rootsA = labels[edgesA]
+      rootsB = labels[edgesB]
+      unmerged = rootsA != rootsB
+      if not np.any(unmerged):
+        return labels
+      rootsA = rootsA[unmerged]
+      rootsB = rootsB[unmerged]
+      minRoots = np.minimum(rootsA, rootsB)
+      np.minimum.at(labels, rootsA, minRoots)
+      np.minimum.at(labels, rootsB, minRoots)
+      while True:
+        jumpedLabels = labels[labels]
+        if np.array_equal(jumpedLabels, labels):
+          break
+        labels = jumpedLabels
+
+  @staticmethod
+  def computeTopologyFromArrays(points, triangles):
+    """
+    Equivalent of vtkCleanPolyData -> largest region of vtkPolyDataConnectivityFilter -> vtkCleanPolyData
+    -> vtkExtractEdges on NumPy arrays:
+    coincident points are merged by hashing their coordinates, components are labelled with
+    union-find, and unique edges are counted by sorting packed vertex pairs.
+    Return tuple (properties, cleanPoints, cleanTriangles), where cleanPoints and cleanTriangles
+    describe the largest component, and properties is the dict:
+    {'euler': V - E + F of the largest component,
+     'genus': (2 - euler - boundaryLoops) / 2, half-integers denote non-orientable or non-manifold surfaces,
+     'boundaryLoops': number of boundary loops of the largest component,
+     'components': number of connected components of the whole surface,
+     'nonManifoldEdges': number of edges shared by more than two triangles,
+     'volume', 'area': enclosed volume and area of the whole surface,
+     'bounds': [xMin, xMax, yMin, yMax, zMin, zMax] of the whole surface,
+     'centroid': [x, y, z] area weighted, of the whole surface}
+    The edges of all the components are sorted once, the geometric properties are used by getMetricsTable.
+    """
+    # Adding 0.0 turns -0.0 into 0.0, so both get the same hash
+    points = np.ascontiguousarray(points + 0.0)
+    pointKeys = points.view(np.dtype((np.void, points.dtype.itemsize * 3))).ravel()
+    _, firstPointIds, mergedPointIds = np.unique(pointKeys, return_index=True, return_inverse=True)
+    points = points[firstPointIds]
+    triangles = mergedPointIds.ravel()[triangles]
+    nonDegenerate = ((triangles[:, 0] != triangles[:, 1]) &
+                     (triangles[:, 1] != triangles[:, 2]) &
+                     (triangles[:, 0] != triangles[:, 2]))
+    triangles = triangles[nonDegenerate]
+
+    properties = {'euler': 0, 'genus': 0.0, 'boundaryLoops': 0, 'components': 0, 'nonManifoldEdges': 0,
+                  'volume': 0.0, 'area': 0.0, 'bounds': None, 'centroid': None}
+    if not len(triangles):
+      return properties, points[:0], triangles
+
+    # Divergence theorem: the volume is the sum of the signed volumes of the tetrahedra (origin, triangle)
+    trianglePoints = points[triangles].astype(np.float64, copy=False)
+    crossProducts = np.cross(trianglePoints[:, 1] - trianglePoints[:, 0], trianglePoints[:, 2] - trianglePoints[:, 0])
+    doubleAreas = np.sqrt(np.einsum('ij,ij->i', crossProducts, crossProducts))
+    volume = np.einsum('ij,ij->i', trianglePoints[:, 0], crossProducts).sum() / 6.0
+    if doubleAreas.sum() > 0:
+      centroid = doubleAreas.dot(trianglePoints.sum(axis=1)) / (3.0 * doubleAreas.sum())
+    else:
+      centroid = trianglePoints.reshape(-1, 3).mean(axis=0)
+    trianglePoints = trianglePoints.reshape(-1, 3)
+    bounds = np.column_stack([trianglePoints.min(axis=0), trianglePoints.max(axis=0)]).ravel()
+
+    # Largest component by number of cells, ties go to the component found first
+    vertexLabels = DataImporterLogic._labelConnectedComponents(
+      len(points),
+      np.concatenate([triangles[:, 0], triangles[:, 1]]),
+      np.concatenate([triangles[:, 1], triangles[:, 2]]))
+    triangleLabels = vertexLabels[triangles[:, 0]]
+    componentLabels, firstTriangleIds, triangleCounts = np.unique(triangleLabels, return_index=True, return_counts=True)
+    largestComponents = np.flatnonzero(triangleCounts == triangleCounts.max())
+    largestLabel = componentLabels[largestComponents[np.argmin(firstTriangleIds[largestComponents])]]
+
+    # Edges of all the components, the edges of a component have the label of their vertices
+    numberOfPoints = len(points)
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    edges.sort(axis=1)
+    packedEdges = edges[:, 0].astype(np.int64) * numberOfPoints + edges[:, 1]
+    uniqueEdges, edgeCounts = np.unique(packedEdges, return_counts=True)
+    nonManifoldEdges = np.count_nonzero(edgeCounts > 2)
+    inLargestComponent = vertexLabels[uniqueEdges // numberOfPoints] == largestLabel
+    uniqueEdges = uniqueEdges[inLargestComponent]
+    edgeCounts = edgeCounts[inLargestComponent]
+
+    # Drop the other components and the unused points
+    triangles = triangles[triangleLabels == largestLabel]
+    usedPointIds, triangles = np.unique(triangles, return_inverse=True)
+    triangles = triangles.reshape(-1, 3)
+    euler = len(usedPointIds) - len(uniqueEdges) + len(triangles)
+
+    boundaryLoops = 0
+    boundaryEdges = uniqueEdges[edgeCounts == 1]
+    if len(boundaryEdges):
+      boundaryA = boundaryEdges // numberOfPoints
+      boundaryB = boundaryEdges % numberOfPoints
+      boundaryLabels = DataImporterLogic._labelConnectedComponents(numberOfPoints, boundaryA, boundaryB)
+      boundaryLoops = len(np.unique(boundaryLabels[boundaryA]))
+
+    properties['euler'] = int(euler)
+    properties['genus'] = (2 - euler - boundaryLoops) / 2.0
+    properties['boundaryLoops'] = int(boundaryLoops)
+    properties['components'] = len(componentLabels)
+    properties['nonManifoldEdges'] = int(nonManifoldEdges)
+    properties['volume'] = float(abs(volume))
+    properties['area'] = float(doubleAreas.sum() / 2.0)
+    properties['bounds'] = [float(bound) for bound in bounds]
+    properties['centroid'] = [float(coordinate) for coordinate in centroid]
+    return properties, points[usedPointIds], triangles
+
+  @staticmethod
+  def _denseLabelArray(labelArray):
+    """
+    Return tuple (labelValues, denseArray), where labelValues are the sorted non zero labels of labelArray
+    and denseArray holds, for each voxel, the index of its label in labelValues plus one (0 for background).
+    """
+    labelArray = np.asarray(labelArray)
+    useLookupTable = (labelArray.dtype.kind in 'ui' and labelArray.size > 0
+                      and labelArray.min() >= 0 and labelArray.max() < 2 ** 24)
+    if useLookupTable:
+      labelValues = np.flatnonzero(np.bincount(labelArray.ravel()))
+    else:
+      labelValues = np.unique(labelArray)
+    labelValues = labelValues[labelValues != 0]
+    denseType = np.uint16 if len(labelValues) < np.iinfo(np.uint16).max else np.int32
+    if useLookupTable:
+      lookupTable = np.zeros(labelArray.max() + 1, dtype=denseType)
+      lookupTable[labelValues] = np.arange(1, len(labelValues) + 1)
+      return labelValues, lookupTable[labelArray]
+    denseArray = (np.searchsorted(labelValues, labelArray) + 1).astype(denseType)
+    denseArray[labelArray == 0] = 0
+    return labelValues, denseArray
+
+  @staticmethod
+  def computeVoxelEulerCharacteristics(denseArray, numberOfLabels, connectivity=26):
+    """
+    Euler characteristic of every label of denseArray at once, counting the cells of its cubical complex:
+    for each cell type (vertices, edges, faces and cubes), the voxels adjacent to every cell are stacked
+    and sorted, so each cell is counted once per label around it.
+    With connectivity 26, voxels are closed cubes: chi = V - E + F - C, where a cell belongs to
+    every label among its adjacent voxels.
+    With connectivity 6, voxels are open cubes: chi = C - F + E - V, where a cell belongs to
+    a label only if all its adjacent voxels have that label.
+    denseArray must have a background border, see _denseLabelArray.
+    Return array of size numberOfLabels + 1 indexed by the dense label, index 0 is unused.
+    """
+    eulerCharacteristics = np.zeros(numberOfLabels + 1, dtype=np.int64)
+    for numberOfFreeAxes in range(4):
+      for freeAxes in itertools.combinations(range(3), numberOfFreeAxes):
+        adjacentVoxels = []
+        for offsets in itertools.product((0, 1), repeat=numberOfFreeAxes):
+          slices = [slice(None)] * 3
+          for axis, offset in zip(freeAxes, offsets):
+            slices[axis] = slice(offset, denseArray.shape[axis] - 1 + offset)
+          adjacentVoxels.append(denseArray[tuple(slices)].ravel())
+        adjacentVoxels = np.sort(np.stack(adjacentVoxels, axis=1), axis=1)
+        if connectivity == 26:
+          distinct = np.ones(adjacentVoxels.shape, dtype=bool)
+          distinct[:, 1:] = adjacentVoxels[:, 1:] != adjacentVoxels[:, :-1]
+          counts = np.bincount(adjacentVoxels[distinct], minlength=numberOfLabels + 1)
+          sign = 1 if numberOfFreeAxes % 2 else -1
+        else:
+          uniform = adjacentVoxels[:, 0] == adjacentVoxels[:, -1]
+          counts = np.bincount(adjacentVoxels[uniform, 0], minlength=numberOfLabels + 1)
+          sign = -1 if numberOfFreeAxes % 2 else 1
+        eulerCharacteristics += sign * counts
+    eulerCharacteristics[0] = 0
+    return eulerCharacteristics
+
+  @staticmethod
+  def computeVoxelTopology(labelArray, connectivity=26):
+    """
+    Compute the topology of every label of labelArray from its voxels, without creating any surface.
+    The Euler characteristic of all labels is computed at once, then components and cavities
+    (background components enclosed by the label, using the complementary connectivity) are counted
+    within the bounding box of each label.
+    The topology number is the Euler number of the outer surface of the largest component,
+    2 * (chi - cavities), so it matches TOPOLOGY_TYPES (2: Sphere, 0: Torus, -2: Double Torus...).
+    Return dict {labelValue: properties}, with the keys of computeTopologyFromArrays plus
+    'cavities' and 'eulerCharacteristic' (of all the voxels of the label).
+    """
+    from scipy import ndimage
+
+    labelValues, denseArray = DataImporterLogic._denseLabelArray(labelArray)
+    if not len(labelValues):
+      return {}
+    # Crop to the labels and add a background border
+    nonZeroSlices = []
+    for axis in range(3):
+      otherAxes = tuple(otherAxis for otherAxis in range(3) if otherAxis != axis)
+      indices = np.flatnonzero(np.any(denseArray, axis=otherAxes))
+      nonZeroSlices.append(slice(indices[0], indices[-1] + 1))
+    denseArray = np.pad(denseArray[tuple(nonZeroSlices)], 1, mode='constant')
+
+    numberOfLabels = len(labelValues)
+    eulerCharacteristics = DataImporterLogic.computeVoxelEulerCharacteristics(denseArray, numberOfLabels, connectivity)
+    foregroundStructure = ndimage.generate_binary_structure(3, 3 if connectivity == 26 else 1)
+    backgroundStructure = ndimage.generate_binary_structure(3, 1 if connectivity == 26 else 3)
+
+    topologies = {}
+    for labelIndex, boundingBox in enumerate(ndimage.find_objects(denseArray)):
+      if boundingBox is None:
+        continue
+      # The border of denseArray is background, so the enlarged box stays within it
+      boundingBox = tuple(slice(box.start - 1, box.stop + 1) for box in boundingBox)
+      mask = denseArray[boundingBox] == labelIndex + 1
+      components, numberOfComponents = ndimage.label(mask, foregroundStructure)
+      eulerCharacteristic = int(eulerCharacteristics[labelIndex + 1])
+      largestEulerCharacteristic = eulerCharacteristic
+      if numberOfComponents > 1:
+        componentSizes = np.bincount(components.ravel())
+        componentSizes[0] = 0
+        mask = components == np.argmax(componentSizes)
+        largestEulerCharacteristic = int(DataImporterLogic.computeVoxelEulerCharacteristics(
+          mask.astype(np.uint8), 1, connectivity)[1])
+      _, numberOfBackgroundComponents = ndimage.label(~mask, backgroundStructure)
+      cavities = numberOfBackgroundComponents - 1
+      topologies[int(labelValues[labelIndex])] = {
+        'euler': 2 * (largestEulerCharacteristic - cavities),
+        'genus': float(1 - largestEulerCharacteristic + cavities),
+        'boundaryLoops': 0,
+        'components': int(numberOfComponents),
+        'cavities': int(cavities),
+        'eulerCharacteristic': eulerCharacteristic,
+      }
+    return topologies
+
+  @staticmethod
+  def _labelValueFromSegmentId(segmentId):
+    """
+    Return the label value of a segment imported from a label map (id 'Label_<value>'), None if unknown.
+    """
+    try:
+      return int(segmentId.split('_')[-1])
+    except ValueError:
+      return None
+
+  def _segmentLabelValues(self, segmentationNode):
+    """
+    Return dict {segmentName: labelValue} of the segments of segmentationNode, except the background,
+    or None if the label value of a segment is unknown.
+    """
+    labelValues = {}
+    segmentation = segmentationNode.GetSegmentation()
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      segmentId = segmentation.GetNthSegmentID(segmentIndex)
+      segmentName = segmentation.GetSegment(segmentId).GetName()
+      if segmentName == "0":
+        continue
+      labelValue = self._labelValueFromSegmentId(segmentId)
+      if labelValue is None:
+        return None
+      labelValues[segmentName] = labelValue
+    return labelValues
+
+  def _populateVoxelTopologies(self, nodeNames):
+    """
+    Populate topologyDict and topologyPropertiesDict of the label maps in nodeNames with computeVoxelTopology,
+    using numberOfWorkers threads. polyDataDict is left empty, no closed surface is created.
+    Return the list of nodeNames whose segments could not be matched to label values.
+    """
+    unmatchedNames = []
+    toCompute = []
+    for nodeName in nodeNames:
+      segmentLabelValues = self._segmentLabelValues(self.segmentationDict[nodeName])
+      if segmentLabelValues is None:
+        unmatchedNames.append(nodeName)
+        continue
+      fileHash, parameters, cachedResults = self._getCachedResults(nodeName)
+      self.topologyDict[nodeName] = {}
+      self.topologyPropertiesDict[nodeName] = {}
+      self.polyDataDict[nodeName] = self._newPolyDatas()
+      if all(segmentName in cachedResults for segmentName in segmentLabelValues):
+        for segmentName in segmentLabelValues:
+          self.topologyDict[nodeName][segmentName] = cachedResults[segmentName]['topology']
+          self.topologyPropertiesDict[nodeName][segmentName] = cachedResults[segmentName]['properties']
+        continue
+      labelArray = slicer.util.arrayFromVolume(self.labelMapDict[nodeName])
+      toCompute.append((nodeName, segmentLabelValues, fileHash, parameters, labelArray))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+      futures = [executor.submit(self.computeVoxelTopology, labelArray, self.voxelConnectivity)
+                 for _, _, _, _, labelArray in toCompute]
+      for (nodeName, segmentLabelValues, fileHash, parameters, _), future in zip(toCompute, futures):
+        labelTopologies = future.result()
+        newResults = {}
+        for segmentName, labelValue in segmentLabelValues.items():
+          if labelValue not in labelTopologies:
+            logging.warning('Ignoring segment id ' + segmentName + ' for case: ' + nodeName)
+            continue
+          properties = labelTopologies[labelValue]
+          self.topologyDict[nodeName][segmentName] = properties['euler']
+          self.topologyPropertiesDict[nodeName][segmentName] = properties
+          newResults[segmentName] = (properties['euler'], properties, None, None)
+        if newResults and self.resultStore is not None:
+          self.resultStore.setResults(fileHash, parameters, newResults)
+
+    return unmatchedNames
+
+  def hasClosedSurface(self, nodeName):
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    return self.segmentationDict[nodeName].GetSegmentation().ContainsRepresentation(closedSurfaceName)
+
+  def createClosedSurface(self, nodeName):
+    """
+    Create the closed surface representation of the segmentation nodeName if it does not exist,
+    restoring it from the resultStore if possible.
+    Return False if it cannot be created.
+    """
+    if self.hasClosedSurface(nodeName):
+      return True
+    segmentationNode = self.segmentationDict[nodeName]
+    created = ((nodeName in self.sourcePathDict and self._restoreCachedClosedSurfaces(self.sourcePathDict[nodeName], segmentationNode))
+               or segmentationNode.CreateClosedSurfaceRepresentation())
+    self.updateSubjectMemorySize(nodeName)
+    return created
+
+  def releaseClosedSurface(self, nodeName):
+    """
+    Remove the closed surface representation of the segmentation nodeName to free memory,
+    unless it is its master representation (imported models). It can be created again with createClosedSurface.
+    Subjects spilled to disk have no closed surface, they are not reloaded.
     """
+    if nodeName in self.spilledSubjects:
+      return
+    segmentation = self.segmentationDict[nodeName].GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    if segmentation.GetMasterRepresentationName() == closedSurfaceName:
+      return
+    segmentation.RemoveRepresentation(closedSurfaceName)
+    if nodeName in self.residentSubjects:
+      self.residentSubjects[nodeName] = self._subjectMemorySize(nodeName)
 
-    self.expectedTopologiesBySegment = {}
-    segmentNames = set()
-    for name in inputTopologyDictionary:
-      for segmentName in inputTopologyDictionary[name]:
-        segmentNames.add(segmentName)
-
-
-    for segmentName in segmentNames:
-      topologyType = self._computeModeOfSegment(inputTopologyDictionary, segmentName)
-      validTopologyType = (topologyType in self.TOPOLOGY_TYPES)
-      if not validTopologyType:
-        logging.warning("Topology: [{}] for segmentName: '{}', shows multiple holes. Use a key from {}".format(topologyType, segmentName, self.TOPOLOGY_TYPES))
-        topologyType = self.TOPOLOGY_MULTIPLE_HOLES_TYPE
-
-      self.expectedTopologiesBySegment[segmentName] = int(topologyType)
-
-  def initExpectedTopologyBySubjectTemplate(self, inputTopologyDictionary, templateName):
+  @staticmethod
+  def decimatePolyData(polydata, numberOfTriangles):
     """
-    Populate the dict from the selected template subject:
-    Example::
-    {'segmentName0' : 2, 'segmentName1': 0'}
-    Where the integers correspond to the enum TOPOLOGY_TYPES
+    Return a copy of polydata triangulated and decimated to about numberOfTriangles triangles.
+    It is only copied if it does not have more triangles.
     """
-    self.expectedTopologiesBySegment = {}
-    segmentNames = set()
-    for name in inputTopologyDictionary:
-      for segmentName in inputTopologyDictionary[name]:
-        segmentNames.add(segmentName)
-
-    for segmentName in segmentNames:
-      if segmentName in inputTopologyDictionary[templateName]:
-        topologyType = inputTopologyDictionary[templateName][segmentName]
-      else:
-        topologyType = self.TOPOLOGY_MULTIPLE_HOLES_TYPE
-      validTopologyType = (topologyType in self.TOPOLOGY_TYPES)
-      if not validTopologyType:
-        logging.warning("Topology: [{}] for segmentName: '{}', shows multiple holes. Use a key from {}".format(topologyType, segmentName, self.TOPOLOGY_TYPES))
-        topologyType = self.TOPOLOGY_MULTIPLE_HOLES_TYPE
-
-      self.expectedTopologiesBySegment[segmentName] = int(topologyType)
-
-  def setFreeSurferimport(self, bool):
-    self.freesurfer_import = bool
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polydata)
+    triangleFilter.Update()
+    triangles = triangleFilter.GetOutput()
+    decimated = vtk.vtkPolyData()
+    if triangles.GetNumberOfPolys() <= numberOfTriangles:
+      decimated.DeepCopy(triangles)
+      return decimated
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(triangles)
+    decimation.SetTargetReduction(1.0 - float(numberOfTriangles) / triangles.GetNumberOfPolys())
+    decimation.Update()
+    decimated.ShallowCopy(decimation.GetOutput())
+    return decimated
+
+  def getPreviewModelNodes(self, nodeName):
+    """
+    Return OrderedDict {segmentName: vtkMRMLModelNode} of the previews of the segments of nodeName:
+    hidden model nodes showing their closed surfaces decimated to previewNumberOfTriangles, faster to render.
+    They are created once and kept until the subject is removed, with the topology if createPreviews.
+    Otherwise the closed surface is created here and left created, to show the full resolution surfaces next.
+    """
+    if nodeName in self.previewModelNodes:
+      return self.previewModelNodes[nodeName]
+    if not self.createClosedSurface(nodeName):
+      return OrderedDict()
+    segmentationNode = self.segmentationDict[nodeName]
+    segmentation = segmentationNode.GetSegmentation()
+    segmentIds = [segmentation.GetNthSegmentID(index) for index in range(segmentation.GetNumberOfSegments())]
+    closedSurfaces = {segmentId: segmentationNode.GetClosedSurfaceRepresentation(segmentId) for segmentId in segmentIds}
+    return self._createPreviewModelNodes(nodeName, closedSurfaces)
+
+  def _createPreviewModelNodes(self, nodeName, closedSurfaces):
+    """
+    Create the previews of nodeName (see getPreviewModelNodes) from closedSurfaces {segmentId: vtkPolyData}.
+    Return OrderedDict {segmentName: vtkMRMLModelNode}.
+    """
+    segmentationNode = self.segmentationDict[nodeName]
+    segmentation = segmentationNode.GetSegmentation()
+    modelNodes = OrderedDict()
+    for index in range(segmentation.GetNumberOfSegments()):
+      segment = segmentation.GetNthSegment(index)
+      polydata = closedSurfaces.get(segmentation.GetNthSegmentID(index))
+      if polydata is None:
+        continue
+      modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode',
+                                                     '{}_{}_preview'.format(segmentationNode.GetName(), segment.GetName()))
+      modelNode.SetHideFromEditors(True)
+      modelNode.SetSaveWithScene(False)
+      modelNode.SetAndObservePolyData(self.decimatePolyData(polydata, self.previewNumberOfTriangles))
+      modelNode.CreateDefaultDisplayNodes()
+      modelNode.GetDisplayNode().SetColor(segment.GetColor())
+      modelNode.GetDisplayNode().SetVisibility(False)
+      modelNodes[segment.GetName()] = modelNode
+    self.previewModelNodes[nodeName] = modelNodes
+    return modelNodes
+
+  def removePreviewModelNodes(self, nodeName=None):
+    """
+    Remove the previews of nodeName from the scene, of all the subjects if None. See getPreviewModelNodes.
+    """
+    nodeNames = list(self.previewModelNodes) if nodeName is None else [nodeName]
+    for name in nodeNames:
+      for modelNode in self.previewModelNodes.pop(name, {}).values():
+        slicer.mrmlScene.RemoveNode(modelNode)
 
-  def setExpectedFileType(self, filetype):
-    self.expected_file_type = filetype
+  def getPolyData(self, nodeName, segmentName):
+    """
+    Return the polydata of segmentName in nodeName: the clean data if saveCleanData, the closed surface otherwise.
+    It is taken from polyDataDict if there, otherwise from the resultStore or created from the segmentation,
+    in which case the closed surface of nodeName is left created.
+    Return None if the segment does not exist.
+    """
+    polydata = self.polyDataDict.get(nodeName, {}).get(segmentName)
+    if polydata is not None:
+      return polydata
+    segmentation = self.segmentationDict[nodeName].GetSegmentation()
+    segmentId = segmentation.GetSegmentIdBySegmentName(segmentName)
+    if not segmentId:
+      return None
+    if self.saveCleanData and self.resultStore is not None and nodeName in self.sourcePathDict:
+      cachedResult = self.resultStore.getResults(self._sourceFileHash(self.sourcePathDict[nodeName]),
+                                                 self._resultStoreParameters(segmentation)).get(segmentName)
+      if cachedResult is not None and cachedResult['cleanSurface']:
+        return DataImporterResultStore.stringToPolyData(cachedResult['cleanSurface'])
+    if not self.createClosedSurface(nodeName):
+      return None
+    polydata = self.segmentationDict[nodeName].GetClosedSurfaceRepresentation(segmentId)
+    if polydata is not None and self.saveCleanData:
+      polydata = self.computeSurfaceTopology(polydata, createCleanData=True)[1]
+    return polydata
 
-  def setColorTableId(self, id):
-    self.color_table_id = id
+  def computeSurfaceTopology(self, polydata, createCleanData=False):
+    """
+    Compute the topology properties of polydata, see computeTopologyFromArrays.
+    properties['euler'] is the topologyNumber = points - edges + polys of the largest component.
+    Return tuple (properties, cleanData), cleanData is the largest component
+    as vtkPolyData if createCleanData, None otherwise.
+    """
+    points, triangles = self._polyDataToArrays(polydata)
+    properties, cleanPoints, cleanTriangles = self.computeTopologyFromArrays(points, triangles)
+    cleanData = self._arraysToPolyData(cleanPoints, cleanTriangles) if createCleanData else None
+    return properties, cleanData
 
-  #
-  # Function to estimate topology of segmentations, and check for consistencies.
-  #
-  def populateTopologyDictionary(self):
+  def populateTopologyDictionary(self, nodeNames=None):
     """
     PRE: Requires segmentationDict populated from files with importXXX
     POST: populate topologyDict, polyDataDict
@@ -486,14 +2437,39 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     [nodeName][SegmentName]
     SegmentName might not be alphanumerical, create a map self.dictSegmentNamesWithIntegers
     between strings and ints.
+    Nodes already in topologyDict (computed by a parallel importFiles) are skipped.
+    If a resultStore is set, segments found in it are not recomputed and new results are stored.
+    With TOPOLOGY_BACKEND_VOXEL, label maps use computeVoxelTopology and polyDataDict is not populated for them.
+    With lazyClosedSurfaces, polyDataDict is not populated and closed surfaces created here are released.
+    If nodeNames is given, only those nodes are considered.
     """
-
-    # Create vtk objects that will be used to clean the geometries
-    for nodeName in self.segmentationDict:
+    if nodeNames is None:
+      nodeNames = list(self.segmentationDict)
+    nodeNames = [nodeName for nodeName in nodeNames
+                 if nodeName in self.segmentationDict and nodeName not in self.topologyDict]
+
+    if self.topologyBackend == self.TOPOLOGY_BACKEND_VOXEL:
+      voxelNodeNames = [nodeName for nodeName in nodeNames if nodeName in self.labelMapDict]
+      unmatchedNames = self._populateVoxelTopologies(voxelNodeNames)
+      for nodeName in unmatchedNames:
+        logging.warning('Segments of {} do not match label values, using its closed surface.'.format(nodeName))
+      for nodeName in voxelNodeNames:
+        if nodeName not in unmatchedNames:
+          self.updateSubjectMemorySize(nodeName)
+
+    for nodeName in nodeNames:
+      if nodeName in self.topologyDict:
+        continue
       # Topology table is a dictionary of dictionaries.
       self.topologyDict[nodeName] = {}
-      self.polyDataDict[nodeName] = {}
+      self.topologyPropertiesDict[nodeName] = {}
+      self.polyDataDict[nodeName] = self._newPolyDatas()
       segmentationNode = self.segmentationDict[nodeName]
+      fileHash, parameters, cachedResults = self._getCachedResults(nodeName)
+      releaseClosedSurface = self.lazyClosedSurfaces and not self.hasClosedSurface(nodeName)
+      if not (self.lazyClosedSurfaces and self._isInResultStore(nodeName, cachedResults)):
+        self.createClosedSurface(nodeName)
+      newResults = {}
       for segmentIndex in range(segmentationNode.GetSegmentation().GetNumberOfSegments()):
         segmentId = segmentationNode.GetSegmentation().GetNthSegmentID(segmentIndex)
         segmentName = segmentationNode.GetSegmentation().GetSegment(segmentId).GetName()
@@ -501,49 +2477,103 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
         # 0 label is assumed to be the background. XXX Pablo: assumed where?
         if segmentName == "0":
           continue
+
+        cachedResult = cachedResults.get(segmentName)
+        if cachedResult is not None and (self.lazyClosedSurfaces or not self.saveCleanData or cachedResult['cleanSurface']):
+          self.topologyDict[nodeName][segmentName] = cachedResult['topology']
+          self.topologyPropertiesDict[nodeName][segmentName] = cachedResult['properties']
+          if self.lazyClosedSurfaces:
+            continue
+          if self.saveCleanData:
+            self.polyDataDict[nodeName][segmentName] = DataImporterResultStore.stringToPolyData(cachedResult['cleanSurface'])
+          else:
+            self.polyDataDict[nodeName][segmentName] = segmentationNode.GetClosedSurfaceRepresentation(segmentId)
+          continue
+
         polydata = segmentationNode.GetClosedSurfaceRepresentation(segmentId)
         if polydata is None:
           logging.warning('Ignoring segment id ' + segmentName + ' for case: ' + nodeName)
           continue
 
-        polydataCleaner = vtk.vtkCleanPolyData()
-        connectivityFilter = vtk.vtkPolyDataConnectivityFilter()
-        extractEdgeFilter = vtk.vtkExtractEdges()
-
-        # clean up polydata
-        polydataCleaner.SetInputData(polydata)
-        polydataCleaner.Update()
-        cleanData = polydataCleaner.GetOutput()
-
-        # Get the largest connected component
-        connectivityFilter.SetInputData(cleanData)
-        connectivityFilter.SetExtractionModeToLargestRegion()
-        connectivityFilter.SetScalarConnectivity(0)
-        connectivityFilter.Update()
-        largestComponent = connectivityFilter.GetOutput()
-
-        # Clean the largest component to get rid of spurious points
-        polydataCleaner.SetInputData(largestComponent)
-        polydataCleaner.Update()
-        cleanData = polydataCleaner.GetOutput()
-
-        # run extract edge filter
-        extractEdgeFilter.SetInputData(cleanData)
-        extractEdgeFilter.Update()
-        edges = extractEdgeFilter.GetOutput()
-
-        # calculate the numbers
-        topologyNumber = cleanData.GetNumberOfPoints() - edges.GetNumberOfLines() + cleanData.GetNumberOfPolys()
+        topologyProperties, cleanData = self.computeSurfaceTopology(polydata, self.saveCleanData)
+        topologyNumber = topologyProperties['euler']
 
         self.topologyDict[nodeName][segmentName] = topologyNumber
+        self.topologyPropertiesDict[nodeName][segmentName] = topologyProperties
+        newResults[segmentName] = (topologyNumber, topologyProperties, polydata, cleanData)
+        if self.lazyClosedSurfaces:
+          continue
         if self.saveCleanData:
           self.polyDataDict[nodeName][segmentName] = cleanData
         else:
           self.polyDataDict[nodeName][segmentName] = polydata
 
-        del edges
-        del largestComponent
-        del cleanData
+      if newResults and self.resultStore is not None:
+        self.resultStore.setResults(fileHash, parameters, newResults)
+      # Previews are decimated from the closed surfaces before they are released
+      if self.createPreviews and self.hasClosedSurface(nodeName):
+        self.getPreviewModelNodes(nodeName)
+      if releaseClosedSurface:
+        self.releaseClosedSurface(nodeName)
+      self.updateSubjectMemorySize(nodeName)
+
+  def _resultStoreParameters(self, segmentation):
+    """
+    Return the string identifying the parameters of the results of segmentation in the resultStore.
+    """
+    return '{};topology={}'.format(segmentation.SerializeAllConversionParameters(), self.TOPOLOGY_ALGORITHM)
+
+  def _getCachedResults(self, nodeName):
+    """
+    Return tuple (fileHash, parameters, cachedResults) for the source file of nodeName,
+    (None, None, {}) if there is no resultStore.
+    """
+    if self.resultStore is None or nodeName not in self.sourcePathDict:
+      return None, None, {}
+    fileHash = self._sourceFileHash(self.sourcePathDict[nodeName])
+    if self.topologyBackend == self.TOPOLOGY_BACKEND_VOXEL and nodeName in self.labelMapDict:
+      parameters = 'voxel;connectivity={}'.format(self.voxelConnectivity)
+    else:
+      parameters = self._resultStoreParameters(self.segmentationDict[nodeName].GetSegmentation())
+    return fileHash, parameters, self.resultStore.getResults(fileHash, parameters)
+
+  def _isInResultStore(self, nodeName, cachedResults=None):
+    """
+    Return True if the topologies of all the segments of nodeName are in cachedResults,
+    by default the results of nodeName in the resultStore.
+    """
+    if cachedResults is None:
+      cachedResults = self._getCachedResults(nodeName)[2]
+    if not cachedResults:
+      return False
+    segmentation = self.segmentationDict[nodeName].GetSegmentation()
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      segmentName = segmentation.GetSegment(segmentation.GetNthSegmentID(segmentIndex)).GetName()
+      if segmentName != "0" and segmentName not in cachedResults:
+        return False
+    return True
+
+  def _restoreCachedClosedSurfaces(self, path, segmentationNode):
+    """
+    Add the closed surfaces stored in the resultStore for the file in path to the segments of segmentationNode.
+    Return False, without modifying segmentationNode, if any of the segments is not in the store.
+    """
+    if self.resultStore is None:
+      return False
+    segmentation = segmentationNode.GetSegmentation()
+    cachedResults = self.resultStore.getResults(self._sourceFileHash(path), self._resultStoreParameters(segmentation))
+    closedSurfaces = {}
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      segmentId = segmentation.GetNthSegmentID(segmentIndex)
+      cachedResult = cachedResults.get(segmentation.GetSegment(segmentId).GetName())
+      if cachedResult is None or not cachedResult['closedSurface']:
+        return False
+      closedSurfaces[segmentId] = cachedResult['closedSurface']
+
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    for segmentId, closedSurface in closedSurfaces.items():
+      segmentation.GetSegment(segmentId).AddRepresentation(closedSurfaceName, DataImporterResultStore.stringToPolyData(closedSurface))
+    return True
 
   def populateInconsistentTopologyDict(self):
     """
@@ -557,6 +2587,78 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     consistent, self.inconsistentTopologyDict = self.checkTopologyConsistency(self.topologyDict)
     return consistent, self.inconsistentTopologyDict
 
+  def updateInconsistentTopologyDict(self, nodeNames):
+    """
+    Incremental version of populateInconsistentTopologyDict for nodeNames, that have just been added to topologyDict.
+    If there is no TemplateName yet, the first of nodeNames becomes the template.
+    Expected topologies are only added for segments seen for the first time, from the template
+    (multiple holes if the template does not have the segment), so previous subjects are not affected.
+    Return dict of dicts with the inconsistencies of nodeNames.
+    """
+    if not nodeNames:
+      return {}
+    if self.TemplateName == '' or not self.TemplateName in self.topologyDict:
+      self.TemplateName = nodeNames[0]
+    templateTopologies = self.topologyDict[self.TemplateName]
+    storedExpectedTopologies = self.resultStore.getExpectedTopologies() if self.resultStore is not None else {}
+
+    for nodeName in nodeNames:
+      for segmentName in self.topologyDict[nodeName]:
+        if segmentName in self.expectedTopologiesBySegment:
+          continue
+        topologyType = storedExpectedTopologies.get(segmentName,
+                                                    templateTopologies.get(segmentName, self.TOPOLOGY_MULTIPLE_HOLES_TYPE))
+        if not topologyType in self.TOPOLOGY_TYPES:
+          logging.warning("Topology: [{}] for segmentName: '{}', shows multiple holes. Use a key from {}".format(topologyType, segmentName, self.TOPOLOGY_TYPES))
+          topologyType = self.TOPOLOGY_MULTIPLE_HOLES_TYPE
+        self.expectedTopologiesBySegment[segmentName] = int(topologyType)
+
+    expected = self.topologyDict.expectedArray(self.expectedTopologiesBySegment)
+    inconsistentSegments = self.topologyDict.inconsistencies(expected, nodeNames)
+    for nodeName in nodeNames:
+      if nodeName in inconsistentSegments:
+        self.inconsistentTopologyDict[nodeName] = inconsistentSegments[nodeName]
+      else:
+        self.inconsistentTopologyDict.pop(nodeName, None)
+    return inconsistentSegments
+
+  def updateInconsistentTopologyDictForSegments(self, segmentNames):
+    """
+    Incremental version of populateInconsistentTopologyDict after the expected topology of segmentNames changed,
+    only their columns of topologyDict are compared.
+    Return the list of nodeNames whose inconsistencies changed, in topologyDict order.
+    """
+    segmentNames = [segmentName for segmentName in segmentNames
+                    if segmentName in self.topologyDict.columnOfSegment and segmentName in self.expectedTopologiesBySegment]
+    if not segmentNames or not self.topologyDict:
+      return []
+    nodeNames = list(self.topologyDict)
+    expected = np.array([self.expectedTopologiesBySegment[segmentName] for segmentName in segmentNames], dtype=np.int32)
+    values = self.topologyDict.toArray(segmentNames=segmentNames)
+    mask = self.topologyDict.inconsistencyMask(expected, segmentNames=segmentNames)
+
+    rowOfNode = {nodeName: row for row, nodeName in enumerate(nodeNames)}
+    segmentNameSet = set(segmentNames)
+    candidateRows = set(np.flatnonzero(mask.any(axis=1)).tolist())
+    candidateRows.update(rowOfNode[nodeName] for nodeName, inconsistencies in self.inconsistentTopologyDict.items()
+                         if nodeName in rowOfNode and not segmentNameSet.isdisjoint(inconsistencies))
+    changedNodeNames = []
+    for row in sorted(candidateRows):
+      nodeName = nodeNames[row]
+      previous = self.inconsistentTopologyDict.get(nodeName, {})
+      inconsistencies = {segmentName: topologyType for segmentName, topologyType in previous.items()
+                         if segmentName not in segmentNameSet}
+      for column in np.flatnonzero(mask[row]):
+        inconsistencies[segmentNames[column]] = int(values[row, column])
+      if inconsistencies == previous:
+        continue
+      changedNodeNames.append(nodeName)
+      if inconsistencies:
+        self.inconsistentTopologyDict[nodeName] = inconsistencies
+      else:
+        self.inconsistentTopologyDict.pop(nodeName, None)
+    return changedNodeNames
+
   def populateDictSegmentNamesWithIntegers(self):
     """
     Populate numberOfDifferentSegments and dictSegmentNamesWithIntegers from existing topologyDict.
@@ -565,11 +2667,13 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
       logging.warning("Cannot populate dictSegmentNamesWithIntegers without topologyDict")
       return
     self.numberOfDifferentSegments = 0
-    for nodeName in self.topologyDict:
-      for segmentName in self.topologyDict[nodeName]:
-        if not segmentName in self.dictSegmentNamesWithIntegers:
-          self.numberOfDifferentSegments+=1
-          self.dictSegmentNamesWithIntegers[segmentName] = self.numberOfDifferentSegments
+    # Segments are numbered in column order of the topology matrix
+    segmentNames = self.topologyDict.segmentNames()
+    for column in np.flatnonzero(self.topologyDict.presentSegmentsMask()):
+      segmentName = segmentNames[column]
+      if not segmentName in self.dictSegmentNamesWithIntegers:
+        self.numberOfDifferentSegments+=1
+        self.dictSegmentNamesWithIntegers[segmentName] = self.numberOfDifferentSegments
 
   def checkTopologyConsistency(self, inputTopologyDictionary):
     """
@@ -582,21 +2686,167 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
         self.initExpectedTopologyBySegmentWithModes(inputTopologyDictionary)
       else:
         self.initExpectedTopologyBySubjectTemplate(inputTopologyDictionary, self.TemplateName)
+      # Expected topologies chosen previously for this cohort take precedence
+      if self.resultStore is not None:
+        for segmentName, topologyType in self.resultStore.getExpectedTopologies().items():
+          if segmentName in self.expectedTopologiesBySegment:
+            self.expectedTopologiesBySegment[segmentName] = topologyType
+
+    topologyMatrix = self._topologyMatrix(inputTopologyDictionary)
+    inconsistentSegments = topologyMatrix.inconsistencies(topologyMatrix.expectedArray(self.expectedTopologiesBySegment))
+    return (bool(inconsistentSegments), inconsistentSegments)
+
+  @classmethod
+  def _metricsOfProperties(cls, properties):
+    """
+    Return the list of the QC_METRICS of the topology properties of a segment, NaN for the unknown ones.
+    """
+    bounds = properties.get('bounds') or [np.nan] * 6
+    centroid = properties.get('centroid') or [np.nan] * 3
+    return ([properties.get(metricName, np.nan) for metricName in cls.QC_METRICS[:4]]
+            + [bounds[1] - bounds[0], bounds[3] - bounds[2], bounds[5] - bounds[4]] + list(centroid))
 
-    inconsistenciesExist = False
-    inconsistentSegments = {}
-
-    for nameNode, segmentsDict in inputTopologyDictionary.items():
-      for segmentName, topologyType in segmentsDict.items():
-        if topologyType != self.expectedTopologiesBySegment[segmentName]:
-          if not nameNode in inconsistentSegments:
-            inconsistentSegments[nameNode] = {}
-          inconsistentSegments[nameNode][segmentName] = topologyType
+  def getMetricsTable(self, nodeNames=None):
+    """
+    Return the cohort metrics table as tuple (rows, values): rows is the list of (nodeName, segmentName)
+    of the segments of nodeNames (all the subjects if None) with topology properties, and values is
+    the float array of their QC_METRICS, with NaN for metrics not computed (voxel topology backend).
+    """
+    if nodeNames is None:
+      nodeNames = list(self.topologyPropertiesDict)
+    rows = []
+    values = []
+    for nodeName in nodeNames:
+      for segmentName, properties in self.topologyPropertiesDict.get(nodeName, {}).items():
+        rows.append((nodeName, segmentName))
+        values.append(self._metricsOfProperties(properties))
+    return rows, np.array(values, dtype=np.float64).reshape(-1, len(self.QC_METRICS))
+
+  def computeMetricOutliers(self, threshold=None):
+    """
+    Flag the metrics of getMetricsTable whose robust z-score (x - median) / (1.4826 * MAD) among the subjects
+    with the same segment is above threshold (QC_OUTLIER_THRESHOLD if None) in absolute value.
+    QC_POSITION_METRICS are not flagged: they depend on where each subject is in the scanner.
+    When the MAD is 0, 1.2533 * mean absolute deviation is used instead, so a single subject differing from
+    a constant cohort is flagged. Segments of less than QC_MINIMUM_SUBJECTS subjects are not flagged.
+    Populate and return outlierMetricsDict.
+    """
+    if threshold is None:
+      threshold = self.QC_OUTLIER_THRESHOLD
+    rows, values = self.getMetricsTable()
+    self.outlierMetricsDict = {}
+    if not rows:
+      return self.outlierMetricsDict
+    segmentNames, segmentOfRow = np.unique([segmentName for _, segmentName in rows], return_inverse=True)
+    zScores = np.zeros_like(values)
+    # Metrics missing for every subject of a segment are expected, not worth a warning
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+      warnings.simplefilter('ignore', RuntimeWarning)
+      for segmentIndex in range(len(segmentNames)):
+        segmentRows = np.flatnonzero(segmentOfRow == segmentIndex)
+        if len(segmentRows) < self.QC_MINIMUM_SUBJECTS:
+          continue
+        segmentValues = values[segmentRows]
+        deviations = segmentValues - np.nanmedian(segmentValues, axis=0)
+        absoluteDeviations = np.abs(deviations)
+        scales = np.nanmedian(absoluteDeviations, axis=0) * 1.4826
+        scales = np.where(scales > 0, scales, np.nanmean(absoluteDeviations, axis=0) * 1.2533)
+        zScores[segmentRows] = np.where(scales > 0, deviations / scales, 0.0)
+    positionColumns = [self.QC_METRICS.index(metricName) for metricName in self.QC_POSITION_METRICS]
+    zScores[:, positionColumns] = 0.0
+    outlierRows, outlierColumns = np.nonzero(np.abs(np.nan_to_num(zScores)) > threshold)
+    for row, column in zip(outlierRows, outlierColumns):
+      nodeName, segmentName = rows[row]
+      segmentOutliers = self.outlierMetricsDict.setdefault(nodeName, {}).setdefault(segmentName, {})
+      segmentOutliers[self.QC_METRICS[column]] = float(zScores[row, column])
+    return self.outlierMetricsDict
+
+  def getTopologyReport(self):
+    """
+    PRE: Requires topologyDict and inconsistentTopologyDict populated.
+    Return a dict, serializable to JSON, with the topologies and the consistency of the cohort::
+    {'consistent': bool, 'template': nodeName, 'topologyTypes': {'2': 'Sphere', ...},
+     'expectedTopologies': {segmentName: int}, 'segmentNamesWithIntegers': {segmentName: int},
+     'labelRange': [first, last],
+     'subjects': {nodeName: {'path': path, 'metadata': {columnName: str}, 'labelRange': [first, last],
+                             'topologies': {segmentName: int},
+                             'properties': {segmentName: dict},
+                             'inconsistencies': {segmentName: int},
+                             'outliers': {segmentName: {metricName: zScore}}}},
+     'importErrors': {path: message}}
+    Subjects and segments keep the order of topologyDict. The outliers are computed with computeMetricOutliers.
+    """
+    self.computeMetricOutliers()
+    subjects = OrderedDict()
+    for nodeName, topologies in self.topologyDict.items():
+      subjects[nodeName] = {
+        'path': self.sourcePathDict.get(nodeName, ''),
+        'metadata': self.sourceMetadata.get(self.sourcePathDict.get(nodeName), {}),
+        'labelRange': list(self.labelRangeDict.get(nodeName, self.labelRangeInCohort)),
+        'topologies': OrderedDict((segmentName, int(topologyType)) for segmentName, topologyType in topologies.items()),
+        'properties': self.topologyPropertiesDict.get(nodeName, {}),
+        'inconsistencies': {segmentName: int(topologyType)
+                            for segmentName, topologyType in self.inconsistentTopologyDict.get(nodeName, {}).items()},
+        'outliers': self.outlierMetricsDict.get(nodeName, {}),
+      }
+    return {
+      'consistent': not self.inconsistentTopologyDict,
+      'template': self.TemplateName,
+      'topologyTypes': {str(topologyType): name for topologyType, name in self.TOPOLOGY_TYPES.items()},
+      'expectedTopologies': {segmentName: int(topologyType)
+                             for segmentName, topologyType in self.expectedTopologiesBySegment.items()},
+      'segmentNamesWithIntegers': dict(self.dictSegmentNamesWithIntegers),
+      'labelRange': list(self.labelRangeInCohort),
+      'subjects': subjects,
+      'importErrors': dict(self.importErrors),
+    }
 
-    if inconsistentSegments:
-      inconsistenciesExist = True
+  @staticmethod
+  def shardFilePaths(filePaths, shardCount, shardIndex):
+    """
+    Return the filePaths processed by shard shardIndex (0 <= shardIndex < shardCount), every shardCount-th file,
+    so shards have similar sizes whatever the order of the manifest.
+    """
+    if not 0 <= shardIndex < shardCount:
+      raise ValueError('Shard index {} is not in [0, {})'.format(shardIndex, shardCount))
+    return list(filePaths[shardIndex::shardCount])
 
-    return (inconsistenciesExist, inconsistentSegments)
+  def mergeTopologyReports(self, reports):
+    """
+    Populate topologyDict, topologyPropertiesDict, sourcePathDict, sourceMetadata, importErrors and labelRangeInCohort from the
+    partial reports of all the shards of a cohort, see getTopologyReport and shardFilePaths.
+    Each report has 'shard': {'index': int, 'count': int} and the position in the manifest of each subject in
+    subjects[nodeName]['index']. Subjects are merged in manifest order, so that modes, template, consistency and
+    dictSegmentNamesWithIntegers are the same as if the cohort had been imported by a single process.
+    Shards do not check the label range (see setCheckLabelRange): subjects with a label range different from
+    the one of the first subject of the cohort are rejected here, as importLabelMap would do.
+    Raise ValueError if reports are missing or do not come from the same sharding.
+    """
+    shardCounts = set(report['shard']['count'] for report in reports)
+    shardIndexes = sorted(report['shard']['index'] for report in reports)
+    if len(shardCounts) != 1 or shardIndexes != list(range(shardCounts.pop())):
+      raise ValueError('Reports do not contain each shard once: {}'.format(shardIndexes))
+
+    subjects = []
+    for report in reports:
+      for nodeName, subject in report['subjects'].items():
+        subjects.append((subject['index'], nodeName, subject, tuple(subject.get('labelRange', report['labelRange']))))
+      self.importErrors.update(report['importErrors'])
+    subjects.sort(key=lambda subject: subject[0])
+
+    for index, nodeName, subject, labelRange in subjects:
+      if self.labelRangeInCohort == (-1, -1):
+        self.labelRangeInCohort = labelRange
+      elif labelRange != self.labelRangeInCohort:
+        logging.error('Label range {} does not match with the existing label range in cohort {}.'.format(labelRange, self.labelRangeInCohort))
+        self.importErrors[subject['path']] = 'Label range {} is not the one of the cohort'.format(labelRange)
+        continue
+      self.topologyDict[nodeName] = OrderedDict(subject['topologies'])
+      self.topologyPropertiesDict[nodeName] = subject.get('properties', {})
+      self.sourcePathDict[nodeName] = subject['path']
+      self.labelRangeDict[nodeName] = labelRange
+      if subject.get('metadata'):
+        self.sourceMetadata[subject['path']] = OrderedDict(subject['metadata'])
 
   def getLabelRangeInCohort(self):
     return self.labelRangeInCohort
@@ -633,6 +2883,34 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     """
     return self.getTopologyString(nodeName, inputSegmentName), self.getConsistencyString(nodeName, inputSegmentName)
 
+  def topologyFilterMask(self, nodeNames=None, segmentNameFilter='', topologyType=None, inconsistentOnly=False):
+    """
+    Return the boolean matrix of the subjects nodeNames (all of them by default) and segments of topologyDict
+    whose segment name contains segmentNameFilter (case insensitive), whose topology is topologyType
+    (unknown topologies are multiple holes, see getTopologyString) and that are in inconsistentTopologyDict.
+    Each filter is optional, segments missing in a subject are never selected.
+    """
+    nodeNames = list(self.topologyDict) if nodeNames is None else list(nodeNames)
+    values = self.topologyDict.toArray(nodeNames)
+    mask = values != self.topologyDict.MISSING
+    if segmentNameFilter:
+      segmentNameFilter = segmentNameFilter.lower()
+      mask &= np.array([segmentNameFilter in segmentName.lower() for segmentName in self.topologyDict.segmentNames()],
+                       dtype=bool)
+    if topologyType == self.TOPOLOGY_MULTIPLE_HOLES_TYPE:
+      mask &= ~np.isin(values, [knownType for knownType in self.TOPOLOGY_TYPES if knownType != topologyType])
+    elif topologyType is not None:
+      mask &= values == topologyType
+    if inconsistentOnly:
+      inconsistent = np.zeros(mask.shape, dtype=bool)
+      rowOfNode = {nodeName: row for row, nodeName in enumerate(nodeNames)}
+      columnOfSegment = self.topologyDict.columnOfSegment
+      for nodeName, inconsistencies in self.inconsistentTopologyDict.items():
+        if nodeName in rowOfNode:
+          inconsistent[rowOfNode[nodeName], [columnOfSegment[segmentName] for segmentName in inconsistencies]] = True
+      mask &= inconsistent
+    return mask
+
   #
   # FreeSurfer tab functions
   #
@@ -650,102 +2928,861 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
         line = LUT.readline()
 
   def getFreeSurferAvailableSegmentIds(self, template_path):
-    # check available labels for ONE subject,
-    # we assume that there is a consistency across the analysable labels in the freesurfer pipeline
-    # additional labels correspond to anomalies
+    """
+    Return the label ids (str) of ONE subject, except the background, False if it cannot be read.
+    Use computeFreeSurferLabelCensus to check the labels of every subject.
+    """
+    census = self.computeFreeSurferLabelCensus([template_path])
+    if not census['presence'][0].any():
+      logging.error('Failed to read the labels of ' + template_path)
+      return False
+    return census['labelIds']
 
-    label_ids = []
+  @classmethod
+  def readMGHArray(cls, path):
+    """
+    Return the voxels of the first frame of the FreeSurfer MGH (or gzip compressed MGZ) volume in path
+    as a flat numpy array, without loading it in the scene. Raises ValueError if the file is not supported.
+    """
+    opener = gzip.open if path.lower().endswith(('.mgz', '.gz')) else open
+    with opener(path, 'rb') as f:
+      header = f.read(cls.MGH_HEADER_SIZE)
+      if len(header) != cls.MGH_HEADER_SIZE:
+        raise ValueError('{} is not a MGH file'.format(path))
+      version, width, height, depth, frames, dataType = np.frombuffer(header[:24], dtype='>i4')
+      if version != 1 or dataType not in cls.MGH_DATA_TYPES:
+        raise ValueError('{} is not a supported MGH file'.format(path))
+      dtype = np.dtype(cls.MGH_DATA_TYPES[dataType])
+      count = int(width) * int(height) * int(depth)
+      data = f.read(count * dtype.itemsize)
+    if len(data) != count * dtype.itemsize:
+      raise ValueError('{} is truncated'.format(path))
+    return np.frombuffer(data, dtype=dtype)
+
+  @staticmethod
+  def readLabelMapVolume(path):
+    """
+    Read the label map in path without accessing the scene, with the reader of vtkMRMLVolumeArchetypeStorageNode.
+    Return tuple (voxels, ijkToRAS): voxels is a KJI numpy array like slicer.util.arrayFromVolume,
+    and ijkToRAS the 4x4 numpy matrix of the volume.
+    Raises ValueError if the file cannot be read.
+    """
+    reader = slicer.vtkITKArchetypeImageSeriesScalarReader()
+    reader.SetArchetype(path)
+    reader.SetSingleFile(1)
+    reader.SetOutputScalarTypeToNative()
+    reader.SetDesiredCoordinateOrientationToNative()
+    reader.SetUseNativeOriginOn()
+    reader.Update()
+    imageData = reader.GetOutput()
+    scalars = imageData.GetPointData().GetScalars()
+    if reader.GetErrorCode() or scalars is None or scalars.GetNumberOfComponents() != 1:
+      raise ValueError('Failed to read {} as a labelmap'.format(path))
+    rasToIJK = vtk.vtkMatrix4x4()
+    rasToIJK.DeepCopy(reader.GetRasToIjkMatrix())
+    rasToIJK.Invert()
+    ijkToRAS = np.array([[rasToIJK.GetElement(row, column) for column in range(4)] for row in range(4)])
+    voxels = numpy_support.vtk_to_numpy(scalars).reshape(imageData.GetDimensions()[::-1]).copy()
+    return voxels, ijkToRAS
+
+  @staticmethod
+  def _labelValuesOfArray(array):
+    """
+    Return the sorted label values in array, label maps stored as floats are truncated.
+    """
+    if array.size == 0:
+      return []
+    if array.dtype.kind == 'f':
+      array = array.astype(np.int64)
+    minimum, maximum = array.min(), array.max()
+    if minimum >= 0 and maximum < 1 << 20:
+      # Faster than np.unique for the label values of segmentations
+      return np.flatnonzero(np.bincount(array.astype(np.intp))).tolist()
+    return np.unique(array).tolist()
+
+  def readLabelValues(self, path):
+    """
+    Return the sorted label values of the label map in path. MGH files are read directly and can be read
+    from several threads, other files are loaded in the scene.
+    Raises ValueError if the file cannot be read.
+    """
+    if path.lower().endswith(('.mgz', '.mgh', '.mgh.gz')):
+      return self._labelValuesOfArray(self.readMGHArray(path))
+    labelMapNode = slicer.util.loadLabelVolume(path, returnNode=True)[1]
+    if labelMapNode is None:
+      raise ValueError('Failed to load {} as a labelmap'.format(path))
+    try:
+      return self._labelValuesOfArray(slicer.util.arrayFromVolume(labelMapNode))
+    finally:
+      slicer.mrmlScene.RemoveNode(labelMapNode)
 
-    directory, fileName = os.path.split(template_path)
-    labelMapNode = slicer.util.loadLabelVolume(template_path, returnNode=True)[1]
-    labelMapNode.SetDisplayVisibility(False)
+  def _cachedLabelValues(self, path):
+    """
+    Return the label values of path from labelValuesCache if the file did not change,
+    otherwise from the resultStore if any. Return None if they are unknown.
+    """
+    stat = os.stat(path)
+    cached = self.labelValuesCache.get(path)
+    if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+      return cached[2]
+    if self.resultStore is None:
+      return None
+    labelValues = self.resultStore.getLabelValues(self.resultStore.fileHash(path))
+    if labelValues is not None:
+      self.labelValuesCache[path] = (stat.st_mtime, stat.st_size, labelValues)
+    return labelValues
+
+  def _cacheLabelValues(self, path, labelValues):
+    stat = os.stat(path)
+    self.labelValuesCache[path] = (stat.st_mtime, stat.st_size, labelValues)
+    if self.resultStore is not None:
+      self.resultStore.setLabelValues(self.resultStore.fileHash(path), labelValues)
+
+  def computeFreeSurferLabelCensus(self, filePaths):
+    """
+    Find the labels present in each of filePaths without importing them. Only the files that changed since
+    they were last read are read, MGH files in numberOfWorkers threads.
+    Return dict {'filePaths': filePaths, 'labelIds': sorted label ids (str) found in any file except the background,
+    'presence': boolean numpy array [fileIndex, labelIndex]}. Files that cannot be read have no label.
+    """
+    labelValuesByPath = {}
+    pathsToRead = []
+    for path in filePaths:
+      try:
+        labelValues = self._cachedLabelValues(path)
+      except OSError as e:
+        logging.warning('Unable to read the labels of {}: {}'.format(path, e))
+        continue
+      if labelValues is None:
+        pathsToRead.append(path)
+      else:
+        labelValuesByPath[path] = labelValues
+
+    def readMGHLabelValues(path):
+      return self._labelValuesOfArray(self.readMGHArray(path))
+
+    mghPaths = [path for path in pathsToRead if path.lower().endswith(('.mgz', '.mgh', '.mgh.gz'))]
+    otherPaths = [path for path in pathsToRead if not path.lower().endswith(('.mgz', '.mgh', '.mgh.gz'))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+      futures = [(path, executor.submit(readMGHLabelValues, path)) for path in mghPaths]
+      # Other files are loaded in the scene, from the main thread
+      for path in otherPaths:
+        try:
+          labelValuesByPath[path] = self.readLabelValues(path)
+        except (OSError, ValueError) as e:
+          logging.warning('Unable to read the labels of {}: {}'.format(path, e))
+      for path, future in futures:
+        try:
+          labelValuesByPath[path] = future.result()
+        except (OSError, ValueError, EOFError) as e:
+          logging.warning('Unable to read the labels of {}: {}'.format(path, e))
+    for path in pathsToRead:
+      if path in labelValuesByPath:
+        self._cacheLabelValues(path, labelValuesByPath[path])
+
+    labelValues = sorted(set(itertools.chain.from_iterable(labelValuesByPath.values())) - {0})
+    labelIndexes = {labelValue: index for index, labelValue in enumerate(labelValues)}
+    presence = np.zeros((len(filePaths), len(labelValues)), dtype=bool)
+    for fileIndex, path in enumerate(filePaths):
+      presence[fileIndex, [labelIndexes[value] for value in labelValuesByPath.get(path, []) if value != 0]] = True
+    return {'filePaths': list(filePaths), 'labelIds': [str(labelValue) for labelValue in labelValues], 'presence': presence}
+
+  @staticmethod
+  def getFilesMissingLabels(census, labelIds):
+    """
+    Return OrderedDict {filePath: missing label ids} of the files of the census (see computeFreeSurferLabelCensus)
+    missing some of labelIds.
+    """
+    columns = [census['labelIds'].index(labelId) if labelId in census['labelIds'] else None for labelId in labelIds]
+    missingFiles = OrderedDict()
+    if not labelIds:
+      return missingFiles
+    presence = np.zeros((len(census['filePaths']), len(labelIds)), dtype=bool)
+    for index, column in enumerate(columns):
+      if column is not None:
+        presence[:, index] = census['presence'][:, column]
+    for fileIndex in np.flatnonzero(~presence.all(axis=1)):
+      missingFiles[census['filePaths'][fileIndex]] = [labelIds[index] for index in np.flatnonzero(~presence[fileIndex])]
+    return missingFiles
+
+  def excludeFilesMissingWantedLabels(self, filePaths):
+    """
+    In FreeSurfer import, return the filePaths that have all freesurfer_wanted_segments according to the label census.
+    The other ones are recorded in importErrors, they would fail to import.
+    """
+    if not self.freesurfer_import or not self.freesurfer_wanted_segments:
+      return list(filePaths)
+    census = self.computeFreeSurferLabelCensus(filePaths)
+    missingFiles = self.getFilesMissingLabels(census, [segmentId.split('_')[-1] for segmentId in self.freesurfer_wanted_segments])
+    for path, labelIds in missingFiles.items():
+      self.importErrors[path] = 'Missing labels {}'.format(', '.join(labelIds))
+    if missingFiles:
+      logging.warning('{} subjects do not have all the wanted labels and are not imported.'.format(len(missingFiles)))
+    return [path for path in filePaths if path not in missingFiles]
 
-    if labelMapNode is None:
-      logging.error('Failed to load ' + fileName + 'as a labelmap')
-      # make sure each one is a labelmap
-      return False
+  #
+  # Shape analysis structure
+  #
+  def generateShapeAnlaysisStructure(self, save_path, dryRun=False):
+    """
+    Export the label map and the model of each segment of each subject to save_path/<segmentName>/input/{volume,model}.
+    Empty segments are not exported, they are listed in the 'emptySegments' of their subject in the manifest.
+    The manifest save_path/SHAPE_ANALYSIS_MANIFEST_FILE_NAME records the source hash, the parameters and the outputs
+    of each subject. Subjects whose source and parameters did not change, and whose outputs still exist with the
+    same size, are not exported again.
+    The manifest is rewritten after each exported subject, so that an interrupted export resumes where it stopped.
+    If dryRun, nothing is written, and the source hashes are kept for the export that follows.
+    Return dict {'subjects': number of subjects to export, 'skippedSubjects': number of subjects up to date,
+    'files': number of files written, 'skippedFiles': number of files up to date}.
+    """
+    manifestPath = os.path.join(save_path, self.SHAPE_ANALYSIS_MANIFEST_FILE_NAME)
+    manifest = {'version': self.SHAPE_ANALYSIS_MANIFEST_VERSION, 'sources': {}, 'subjects': {}}
+    if os.path.isfile(manifestPath):
+      try:
+        with open(manifestPath) as f:
+          previousManifest = json.load(f)
+        if previousManifest.get('version') == self.SHAPE_ANALYSIS_MANIFEST_VERSION:
+          manifest = previousManifest
+      except ValueError as e:
+        logging.warning('Ignoring invalid manifest {}: {}'.format(manifestPath, e))
+    # Hashes of the dry run are reused, _shapeAnalysisSourceHash checks that the sources did not change since
+    if self.shapeAnalysisPlan is not None and self.shapeAnalysisPlan['savePath'] == os.path.abspath(save_path):
+      for path, cached in self.shapeAnalysisPlan['sources'].items():
+        manifest['sources'].setdefault(path, cached)
+
+    parameters = self._shapeAnalysisParameters()
+    summary = {'subjects': 0, 'skippedSubjects': 0, 'files': 0, 'skippedFiles': 0}
+    for name in self.segmentationDict:
+      sourcePath = self.sourcePathDict.get(name)
+      sourceHash = self._shapeAnalysisSourceHash(sourcePath, manifest['sources']) if sourcePath else None
+      entry = manifest['subjects'].get(name)
+      if (entry is not None and sourceHash is not None and entry['sha256'] == sourceHash
+          and entry['parameters'] == parameters and self._shapeAnalysisOutputsExist(save_path, entry['outputs'])):
+        summary['skippedSubjects'] += 1
+        summary['skippedFiles'] += 2 * len(entry['outputs'])
+        continue
+
+      summary['subjects'] += 1
+      if dryRun:
+        summary['files'] += 2 * len(self._shapeAnalysisSegmentIds(name)[0])
+        continue
+
+      outputs, emptySegmentNames = self._exportSubjectToShapeAnalysisStructure(save_path, name)
+      summary['files'] += 2 * len(outputs)
+      manifest['subjects'][name] = {
+        'source': sourcePath,
+        'sha256': sourceHash,
+        'parameters': parameters,
+        'outputs': {segmentName: {outputType: {'path': path, 'size': os.path.getsize(os.path.join(save_path, path))}
+                                  for outputType, path in segmentOutputs.items()}
+                    for segmentName, segmentOutputs in outputs.items()},
+        'emptySegments': emptySegmentNames,
+      }
+      self._writeShapeAnalysisManifest(manifestPath, manifest)
+
+    if dryRun:
+      self.shapeAnalysisPlan = {'savePath': os.path.abspath(save_path), 'sources': manifest['sources']}
+    else:
+      self._writeShapeAnalysisManifest(manifestPath, manifest)
+      self.shapeAnalysisPlan = None
+    return summary
+
+  @staticmethod
+  def _writeShapeAnalysisManifest(manifestPath, manifest):
+    """
+    Write manifest to a temporary file replacing manifestPath once complete, so that manifestPath is never truncated.
+    """
+    temporaryPath = manifestPath + '.tmp'
+    with open(temporaryPath, 'w') as f:
+      json.dump(manifest, f, indent=2)
+    os.replace(temporaryPath, manifestPath)
+
+  def _shapeAnalysisParameters(self):
+    """
+    Return the string identifying the settings that change the files exported by generateShapeAnlaysisStructure.
+    Closed surfaces use the default conversion parameters of the segmentations.
+    """
+    return 'version={};colorTable={};freesurfer={};segments={};modelFormat={}'.format(
+      self.SHAPE_ANALYSIS_MANIFEST_VERSION, self.color_table_id, self.freesurfer_import,
+      ','.join(sorted(self.freesurfer_wanted_segments)) if self.freesurfer_import else '', self.modelFormat)
+
+  def _shapeAnalysisSourceHash(self, path, hashCache):
+    """
+    Return the SHA-256 of the file in path, from hashCache {path: {'mtime', 'size', 'sha256'}} if the file did not
+    change, otherwise from _sourceFileHash. Return None if path does not exist.
+    """
+    if not os.path.isfile(path):
+      return None
+    stat = os.stat(path)
+    cached = hashCache.get(path)
+    if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+      return cached['sha256']
+    fileHash = self._sourceFileHash(path)
+    hashCache[path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': fileHash}
+    return fileHash
+
+  @staticmethod
+  def _shapeAnalysisOutputsExist(save_path, outputs):
+    for segmentOutputs in outputs.values():
+      for output in segmentOutputs.values():
+        outputPath = os.path.join(save_path, output['path'])
+        if not os.path.isfile(outputPath) or os.path.getsize(outputPath) != output['size']:
+          return False
+    return True
 
-    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", labelMapNode.GetName() + '_allSegments')
+  def _shapeAnalysisSegmentIds(self, name):
+    """
+    Return tuple (segmentIds, emptySegmentIds) of subject name: the segments exported by
+    _exportSubjectToShapeAnalysisStructure, and the empty ones that are not. Only the segments of
+    label map subjects are known to be empty, from the label values of their voxels.
+    """
+    segmentation = self.segmentationDict[name].GetSegmentation()
+    segmentIds = [segmentation.GetNthSegmentID(segmentIndex) for segmentIndex in range(segmentation.GetNumberOfSegments())]
+    if name not in self.labelMapDict:
+      return segmentIds, []
+    labelValues = set(self._labelValuesOfArray(slicer.util.arrayFromVolume(self.labelMapDict[name])))
+    emptySegmentIds = []
+    for segmentId in segmentIds:
+      labelValue = self._labelValueFromSegmentId(segmentId)
+      if labelValue is not None and labelValue > 0 and labelValue not in labelValues:
+        emptySegmentIds.append(segmentId)
+    return [segmentId for segmentId in segmentIds if segmentId not in emptySegmentIds], emptySegmentIds
+
+  def _exportSubjectToShapeAnalysisStructure(self, save_path, name):
+    """
+    Export the label map and the model of each segment of subject name, see generateShapeAnlaysisStructure.
+    Return tuple (outputs, emptySegmentNames): outputs is the dict {segmentName: {'volume': path, 'model': path}}
+    with paths relative to save_path, and emptySegmentNames the names of the empty segments, not exported.
+    """
     segmentationLogic = slicer.modules.segmentations.logic()
-    segmentationLogic.ImportLabelmapToSegmentationNode(labelMapNode, segmentationNode)
+    segmentation_node = self.segmentationDict[name]
+    # With lazyClosedSurfaces, the closed surface is only kept during the export
+    releaseClosedSurface = self.lazyClosedSurfaces and not self.hasClosedSurface(name)
+    self.createClosedSurface(name)
+    outputs = {}
+    labelMapPaths = {}
+    modelPaths = {}
+    segmentIds, emptySegmentIds = self._shapeAnalysisSegmentIds(name)
+    emptySegmentNames = [segmentation_node.GetSegmentation().GetSegment(segmentId).GetName() for segmentId in emptySegmentIds]
+    for segmentName in emptySegmentNames:
+      logging.warning('Segment {} of {} is empty, it is not exported.'.format(segmentName, name))
+    for segmentId in segmentIds:
+      segmentName = segmentation_node.GetSegmentation().GetSegment(segmentId).GetName()
+      directory_path = os.path.join(save_path, segmentName)
+      if not os.path.isdir(directory_path):
+        os.mkdir(directory_path)
+      input_directory_path = os.path.join(directory_path, 'input')
+      if not os.path.isdir(input_directory_path):
+        os.mkdir(input_directory_path)
+      volume_directory_path = os.path.join(input_directory_path, 'volume')
+      if not os.path.isdir(volume_directory_path):
+        os.mkdir(volume_directory_path)
+      model_directory_path = os.path.join(input_directory_path, 'model')
+      if not os.path.isdir(model_directory_path):
+        os.mkdir(model_directory_path)
+      output_directory_path = os.path.join(directory_path, 'output')
+      if not os.path.isdir(output_directory_path):
+        os.mkdir(output_directory_path)
+
+      labelMap_filename = segmentation_node.GetName().replace(" ", "_")+'.nrrd'
+      labelMap_filepath = os.path.join(volume_directory_path, labelMap_filename)
+
+      polydata_filename = segmentation_node.GetName().replace(" ", "_")+'.'+self.modelFormat
+      polydata_filepath = os.path.join(model_directory_path, polydata_filename)
+
+      # label maps and models are saved after the loop
+      labelMapPaths[segmentId] = labelMap_filepath
+      modelPaths[segmentId] = polydata_filepath
+
+      # create output directory
+      if not os.path.isdir(output_directory_path):
+        os.mkdir(output_directory_path)
+
+      outputs[segmentName] = {'volume': os.path.relpath(labelMap_filepath, save_path),
+                              'model': os.path.relpath(polydata_filepath, save_path)}
+
+    # save label maps, in one pass over the label map of the subject if possible
+    exportedSegmentIds = self._exportSegmentLabelMapsFromArray(name, labelMapPaths)
+    for segmentId, labelMap_filepath in labelMapPaths.items():
+      if segmentId in exportedSegmentIds:
+        continue
+      segmentIdList = vtk.vtkStringArray()
+      segmentIdList.InsertNextValue(segmentId)
+      full_segmentName = segmentation_node.GetName() + segmentation_node.GetSegmentation().GetSegment(segmentId).GetName()
+      exported_labelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", full_segmentName+' LabelMap')
+
+      if name in self.labelMapDict.keys():
+        segmentationLogic.ExportSegmentsToLabelmapNode(segmentation_node, segmentIdList, exported_labelmap, self.labelMapDict[name])
+      else:
+        segmentationLogic.ExportSegmentsToLabelmapNode(segmentation_node, segmentIdList, exported_labelmap)
 
-    labelMapNode.SetDisplayVisibility(False)
-    segmentationNode.SetDisplayVisibility(False)
-    segmentationNode.GetDisplayNode().SetAllSegmentsVisibility(False)
+      slicer.util.saveNode(exported_labelmap, labelMap_filepath)
+      slicer.mrmlScene.RemoveNode(slicer.util.getNode(pattern=full_segmentName+' LabelMap_ColorTable'))
+      slicer.mrmlScene.RemoveNode(exported_labelmap)
 
-    for segmentIndex in range(segmentationNode.GetSegmentation().GetNumberOfSegments()):
-      segmentId = segmentationNode.GetSegmentation().GetNthSegmentID(segmentIndex)
-      segmentName = segmentationNode.GetSegmentation().GetSegment(segmentId).GetName()
-      label_id = segmentName.split('_')[1]
-      label_ids.append(label_id)
+    self._writeSegmentModels(name, modelPaths)
 
-    slicer.mrmlScene.RemoveNode(segmentationNode)
-    slicer.mrmlScene.RemoveNode(labelMapNode)
+    if releaseClosedSurface:
+      self.releaseClosedSurface(name)
+    return outputs, emptySegmentNames
+
+  def _exportSegmentLabelMapsFromArray(self, name, labelMapPaths):
+    """
+    Write the binary label map of each segment in labelMapPaths {segmentId: path} of the label map subject name,
+    reading its voxels once, each one cropped to the extent of its segment. No node is added to the scene.
+    Segments whose label value is unknown or not in the voxels are not written.
+    Return the set of segmentIds written.
+    """
+    if name not in self.labelMapDict:
+      return set()
+    labelValues = {segmentId: self._labelValueFromSegmentId(segmentId) for segmentId in labelMapPaths}
+    labelValues = {segmentId: labelValue for segmentId, labelValue in labelValues.items()
+                   if labelValue is not None and labelValue > 0}
+    if not labelValues:
+      return set()
+    import scipy.ndimage
+
+    labelMapNode = self.labelMapDict[name]
+    labelArray = slicer.util.arrayFromVolume(labelMapNode)
+    if not np.issubdtype(labelArray.dtype, np.integer):
+      labelArray = labelArray.astype(np.int32)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    labelMapNode.GetIJKToRASMatrix(ijkToRAS)
+    # Bounding box of every label in one pass
+    labelSlices = scipy.ndimage.find_objects(np.maximum(labelArray, 0))
+    exportedSegmentIds = set()
+    for segmentId, labelValue in labelValues.items():
+      slices = labelSlices[labelValue - 1] if labelValue <= len(labelSlices) else None
+      if slices is None:
+        continue
+      segmentArray = (labelArray[slices] == labelValue).astype(np.uint8)
+      self.writeLabelMapNrrd(labelMapPaths[segmentId], segmentArray, ijkToRAS, [s.start for s in slices])
+      exportedSegmentIds.add(segmentId)
+    return exportedSegmentIds
+
+  def _writeSegmentModels(self, name, modelPaths):
+    """
+    Write the closed surface of each segment in modelPaths {segmentId: path} of subject name with modelFormat.
+    No node is added to the scene.
+    """
+    segmentation_node = self.segmentationDict[name]
+    for segmentId, modelPath in modelPaths.items():
+      polydata = segmentation_node.GetClosedSurfaceRepresentation(segmentId)
+      self.writeModel(modelPath, self.modelForWriting(polydata if polydata is not None else vtk.vtkPolyData()),
+                      self.modelFormat)
+
+  @staticmethod
+  def modelForWriting(polydata):
+    """
+    Return a copy of the polydata in LPS, as the models saved by Slicer, with single precision points.
+    """
+    rasToLPS = vtk.vtkTransform()
+    rasToLPS.Scale(-1, -1, 1)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(rasToLPS)
+    transformFilter.SetOutputPointsPrecision(vtk.vtkAlgorithm.SINGLE_PRECISION)
+    transformFilter.SetInputData(polydata)
+    transformFilter.Update()
+    model = vtk.vtkPolyData()
+    model.ShallowCopy(transformFilter.GetOutput())
+    return model
+
+  @classmethod
+  def writeModel(cls, path, polydata, modelFormat):
+    """
+    Write the polydata, already in LPS, to path as binary legacy VTK (MODEL_FORMAT_VTK)
+    or zlib compressed XML VTK (MODEL_FORMAT_VTP). The coordinate system is recorded as Slicer does.
+    """
+    if modelFormat == cls.MODEL_FORMAT_VTK:
+      writer = vtk.vtkPolyDataWriter()
+      writer.SetFileTypeToBinary()
+      writer.SetHeader('3D Slicer output. SPACE=LPS')
+    elif modelFormat == cls.MODEL_FORMAT_VTP:
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetCompressorTypeToZLib()
+      writer.SetDataModeToBinary()
+      spaceArray = vtk.vtkStringArray()
+      spaceArray.SetName('SPACE')
+      spaceArray.InsertNextValue('LPS')
+      polydataWithSpace = vtk.vtkPolyData()
+      polydataWithSpace.ShallowCopy(polydata)
+      polydataWithSpace.GetFieldData().AddArray(spaceArray)
+      polydata = polydataWithSpace
+    else:
+      raise ValueError('Unknown model format {}'.format(modelFormat))
+    writer.SetFileName(path)
+    writer.SetInputData(polydata)
+    if not writer.Write():
+      raise IOError('Failed to write {}'.format(path))
+
+  @staticmethod
+  def writeLabelMapNrrd(path, array, ijkToRAS, start=(0, 0, 0)):
+    """
+    Write the uint8 array, in KJI order as returned by slicer.util.arrayFromVolume, to a gzip compressed NRRD file.
+    ijkToRAS is the vtkMatrix4x4 of the volume the array comes from, and start the (k, j, i) index of its first voxel.
+    The file uses the LPS space, as the files saved by Slicer.
+    """
+    k, j, i = start
+    origin = [sum(ijkToRAS.GetElement(row, column) * index for column, index in enumerate([i, j, k]))
+              + ijkToRAS.GetElement(row, 3) for row in range(3)]
+    rasToLPS = [-1, -1, 1]
+    directions = ['({:.17g},{:.17g},{:.17g})'.format(*[rasToLPS[row] * ijkToRAS.GetElement(row, column) for row in range(3)])
+                  for column in range(3)]
+    header = ('NRRD0004\n'
+              '# Complete NRRD file format specification at:\n'
+              '# http://teem.sourceforge.net/nrrd/format.html\n'
+              'type: unsigned char\n'
+              'dimension: 3\n'
+              'space: left-posterior-superior\n'
+              'sizes: {} {} {}\n'
+              'space directions: {}\n'
+              'kinds: domain domain domain\n'
+              'endian: little\n'
+              'encoding: gzip\n'
+              'space origin: ({:.17g},{:.17g},{:.17g})\n'
+              '\n').format(array.shape[2], array.shape[1], array.shape[0], ' '.join(directions),
+                            *[rasToLPS[row] * origin[row] for row in range(3)])
+    with open(path, 'wb') as f:
+      f.write(header.encode('ascii'))
+      f.write(gzip.compress(np.ascontiguousarray(array, dtype=np.uint8).tobytes(), compresslevel=1))
 
-    return label_ids
+#
+# Worker processes of DataImporterLogic._importFilesInParallel
+#
 
-  #
-  # Shape analysis structure
-  #
-  def generateShapeAnlaysisStructure(self, save_path):
-    segmentationLogic = slicer.modules.segmentations.logic()
+def importLabelMapInWorkerProcess(path, wantedLabelValues, createCleanData, keepClosedSurfaces):
+  """
+  Return DataImporterLogic.computeLabelMapFileTopology of path. The worker is forked from the application,
+  so it does not log nor display VTK warnings: the handlers of the application belong to the parent process.
+  """
+  vtk.vtkObject.GlobalWarningDisplayOff()
+  return DataImporterLogic.computeLabelMapFileTopology(path, wantedLabelValues, createCleanData, keepClosedSurfaces)
 
-    for name, segmentation_node in self.segmentationDict.items():
-      for segmentIndex in range(segmentation_node.GetSegmentation().GetNumberOfSegments()):
-        segmentId = segmentation_node.GetSegmentation().GetNthSegmentID(segmentIndex)
-        segmentName = segmentation_node.GetSegmentation().GetSegment(segmentId).GetName()
-        directory_path = os.path.join(save_path, segmentName)
-        if not os.path.isdir(directory_path):
-          os.mkdir(directory_path)
-        input_directory_path = os.path.join(directory_path, 'input')
-        if not os.path.isdir(input_directory_path):
-          os.mkdir(input_directory_path)
-        volume_directory_path = os.path.join(input_directory_path, 'volume')
-        if not os.path.isdir(volume_directory_path):
-          os.mkdir(volume_directory_path)
-        model_directory_path = os.path.join(input_directory_path, 'model')
-        if not os.path.isdir(model_directory_path):
-          os.mkdir(model_directory_path)
-        output_directory_path = os.path.join(directory_path, 'output')
-        if not os.path.isdir(output_directory_path):
-          os.mkdir(output_directory_path)
-
-        labelMap_filename = segmentation_node.GetName().replace(" ", "_")+'.nrrd'
-        labelMap_filepath = os.path.join(volume_directory_path, labelMap_filename)
-
-        polydata_filename = segmentation_node.GetName().replace(" ", "_")+'.vtk'
-        polydata_filepath = os.path.join(model_directory_path, polydata_filename)
-
-        segmentIdList = vtk.vtkStringArray()
-        segmentIdList.InsertNextValue(segmentId)
-
-        full_segmentName = segmentation_node.GetName() + segmentName
-
-        # save label map
-        exported_labelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", full_segmentName+' LabelMap')
-
-        if name in self.labelMapDict.keys():
-          segmentationLogic.ExportSegmentsToLabelmapNode(segmentation_node, segmentIdList, exported_labelmap, self.labelMapDict[name])
-        else:
-          segmentationLogic.ExportSegmentsToLabelmapNode(segmentation_node, segmentIdList, exported_labelmap)
-
-        slicer.util.saveNode(exported_labelmap, labelMap_filepath)
-        slicer.mrmlScene.RemoveNode(slicer.util.getNode(pattern=full_segmentName+' LabelMap_ColorTable'))
-        slicer.mrmlScene.RemoveNode(exported_labelmap)
-
-        # save Polydata
-        exported_hierarchy = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelHierarchyNode", full_segmentName+' Model')
-        segmentationLogic.ExportSegmentsToModelHierarchy(segmentation_node, segmentIdList, exported_hierarchy)
-        collec = vtk.vtkCollection()
-        exported_hierarchy.GetChildrenModelNodes(collec)
-        exported_model = collec.GetItemAsObject(0)
-        slicer.util.saveNode(exported_model, polydata_filepath)
-        slicer.mrmlScene.RemoveNode(exported_hierarchy)
-        slicer.mrmlScene.RemoveNode(exported_model)
-
-        # create output directory
-        if not os.path.isdir(output_directory_path):
-          os.mkdir(output_directory_path)
+#
+# DataImporterSubjectsTableModel
+#
+
+class DataImporterSubjectsTableModel(qt.QAbstractTableModel):
+  """
+  Model of the subjects table of DataImporterWidget over the topologies of a DataImporterLogic.
+  Only the names of the subjects are kept, rows are the subjects passing the filters (see setFilters and
+  DataImporterLogic.topologyFilterMask). The template column is drawn and edited by DataImporterRadioButtonDelegate,
+  templateCallback(name) is called when a subject is chosen as template. The QC column shows the metrics of
+  DataImporterLogic.outlierMetricsDict.
+  """
+  COLUMN_NAME = 0
+  COLUMN_CONSISTENCY = 1
+  COLUMN_TEMPLATE = 2
+  COLUMN_QC = 3
+  COLUMN_LABELS = ['Subject name', 'Consistency', 'Use as template', 'QC']
+
+  def __init__(self, logic, templateCallback=None, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.logic = logic
+    self.templateCallback = templateCallback
+    # All the subjects of the table in table order, and the ones passing the filters
+    self.names = []
+    self.visibleNames = []
+    self.visibleRowOfName = {}
+    self.filters = {}
+
+  def rowCount(self, parent=None):
+    return len(self.visibleNames)
+
+  def columnCount(self, parent=None):
+    return len(self.COLUMN_LABELS)
+
+  def headerData(self, section, orientation, role):
+    if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole:
+      return self.COLUMN_LABELS[section]
+    return None
+
+  def flags(self, index):
+    return qt.Qt.ItemIsSelectable | qt.Qt.ItemIsEnabled
+
+  def data(self, index, role):
+    name = self.visibleNames[index.row()]
+    column = index.column()
+    if column == self.COLUMN_NAME and role == qt.Qt.DisplayRole:
+      return name
+    if column == self.COLUMN_CONSISTENCY:
+      countInconsistencies = len(self.logic.inconsistentTopologyDict.get(name, {}))
+      if role == qt.Qt.DisplayRole:
+        return '# Inconsistencies: ' + str(countInconsistencies) if countInconsistencies > 0 else 'Consistent'
+      if role == qt.Qt.BackgroundRole and countInconsistencies > 0:
+        return qt.QBrush(qt.QColor(255, 204, 203)) # light red
+    if column == self.COLUMN_TEMPLATE and role == qt.Qt.UserRole:
+      return name == self.logic.TemplateName
+    if column == self.COLUMN_QC:
+      outliers = self.logic.outlierMetricsDict.get(name, {})
+      countOutliers = sum(len(metrics) for metrics in outliers.values())
+      if role == qt.Qt.DisplayRole:
+        return '# Outliers: ' + str(countOutliers) if countOutliers > 0 else ''
+      if role == qt.Qt.ToolTipRole and countOutliers > 0:
+        return '\n'.join('{}: {} (z = {:.1f})'.format(segmentName, metricName, zScore)
+                         for segmentName, metrics in outliers.items() for metricName, zScore in metrics.items())
+      if role == qt.Qt.BackgroundRole and countOutliers > 0:
+        return qt.QBrush(qt.QColor(255, 229, 180)) # light orange
+    return None
+
+  def setData(self, index, value, role):
+    if index.column() != self.COLUMN_TEMPLATE or not value:
+      return False
+    if self.templateCallback is not None:
+      self.templateCallback(self.visibleNames[index.row()])
+    self.dataChanged(self.index(0, self.COLUMN_TEMPLATE), self.index(self.rowCount() - 1, self.COLUMN_TEMPLATE))
+    return True
+
+  def sort(self, column, order):
+    if column == self.COLUMN_CONSISTENCY:
+      key = lambda name: len(self.logic.inconsistentTopologyDict.get(name, {}))
+    elif column == self.COLUMN_TEMPLATE:
+      key = lambda name: name != self.logic.TemplateName
+    elif column == self.COLUMN_QC:
+      key = lambda name: sum(len(metrics) for metrics in self.logic.outlierMetricsDict.get(name, {}).values())
+    else:
+      key = None
+    self.names.sort(key=key, reverse=(order == qt.Qt.DescendingOrder))
+    self.refilter()
+
+  def _filteredNames(self, names):
+    if not any(self.filters.values()):
+      return list(names)
+    names = [name for name in names if name in self.logic.topologyDict]
+    mask = self.logic.topologyFilterMask(names, **self.filters)
+    return [names[row] for row in np.flatnonzero(mask.any(axis=1))]
+
+  def setFilters(self, segmentNameFilter='', topologyType=None, inconsistentOnly=False):
+    self.filters = {'segmentNameFilter': segmentNameFilter, 'topologyType': topologyType,
+                    'inconsistentOnly': inconsistentOnly}
+    self.refilter()
+
+  def refilter(self):
+    self.beginResetModel()
+    self.visibleNames = self._filteredNames(self.names)
+    self.visibleRowOfName = {name: row for row, name in enumerate(self.visibleNames)}
+    self.endResetModel()
+
+  def setNames(self, names):
+    self.names = list(names)
+    self.refilter()
+
+  def appendNames(self, names):
+    """
+    Append the subjects names at the end of the table, only the ones passing the filters are inserted.
+    """
+    self.names.extend(names)
+    visibleNames = self._filteredNames(names)
+    if not visibleNames:
+      return
+    first = len(self.visibleNames)
+    self.beginInsertRows(qt.QModelIndex(), first, first + len(visibleNames) - 1)
+    for row, name in enumerate(visibleNames, first):
+      self.visibleNames.append(name)
+      self.visibleRowOfName[name] = row
+    self.endInsertRows()
+
+  def removeNames(self, names):
+    names = set(names)
+    self.names = [name for name in self.names if name not in names]
+    self.refilter()
+
+  def updateNames(self, names):
+    """
+    Update the consistency of the subjects names, the visible rows are repainted.
+    """
+    if self.filters.get('inconsistentOnly'):
+      self.refilter()
+      return
+    for name in names:
+      row = self.visibleRowOfName.get(name)
+      if row is not None:
+        self.dataChanged(self.index(row, self.COLUMN_CONSISTENCY), self.index(row, self.COLUMN_TEMPLATE))
+
+  def updateOutliers(self):
+    """
+    Repaint the QC column after DataImporterLogic.outlierMetricsDict changed.
+    """
+    if self.rowCount() > 0:
+      self.dataChanged(self.index(0, self.COLUMN_QC), self.index(self.rowCount() - 1, self.COLUMN_QC))
+
+  def nameOfRow(self, row):
+    return self.visibleNames[row]
+
+#
+# DataImporterSegmentsTableModel
+#
+
+class DataImporterSegmentsTableModel(qt.QAbstractTableModel):
+  """
+  Model of the segments table of DataImporterWidget: one row per segment of the subjects given to setSubjectNames,
+  with a subject name column if there are several of them. Rows are arrays of subject and segment indexes of
+  the segments passing the filters, see DataImporterLogic.topologyFilterMask. The expected topology column is
+  edited by DataImporterTopologyTypeDelegate, expectedTopologyCallback(segmentName, topologyType) is called on change.
+  """
+  def __init__(self, logic, expectedTopologyCallback=None, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.logic = logic
+    self.expectedTopologyCallback = expectedTopologyCallback
+    self.subjectNames = []
+    self.segmentNames = []
+    self.rowSubjects = np.zeros(0, dtype=np.intp)
+    self.rowSegments = np.zeros(0, dtype=np.intp)
+    self.filters = {}
+    self._setColumns(False)
+
+  def _setColumns(self, hasSubjectNameColumn):
+    offset = 1 if hasSubjectNameColumn else 0
+    self.columnSubjectName = 0 if hasSubjectNameColumn else -1
+    self.columnSegmentName = offset
+    self.columnTopologyCurrent = offset + 1
+    self.columnTopologyExpected = offset + 2
+    self.columnLabels = (['Subject'] if hasSubjectNameColumn else []) + \
+                        ['Segment Name', 'Current Segment Topology', 'Expected Cohort Topology']
+
+  def rowCount(self, parent=None):
+    return len(self.rowSubjects)
+
+  def columnCount(self, parent=None):
+    return len(self.columnLabels)
+
+  def headerData(self, section, orientation, role):
+    if orientation == qt.Qt.Horizontal and role == qt.Qt.DisplayRole:
+      return self.columnLabels[section]
+    return None
+
+  def flags(self, index):
+    flags = qt.Qt.ItemIsSelectable | qt.Qt.ItemIsEnabled
+    if index.column() == self.columnTopologyExpected:
+      flags |= qt.Qt.ItemIsEditable
+    return flags
+
+  def data(self, index, role):
+    subjectName, segmentName = self.subjectAndSegmentOfRow(index.row())
+    column = index.column()
+    if column == self.columnSubjectName and role == qt.Qt.DisplayRole:
+      return subjectName
+    if column == self.columnSegmentName and role == qt.Qt.DisplayRole:
+      return segmentName
+    if column == self.columnTopologyCurrent:
+      if role == qt.Qt.DisplayRole:
+        return self.logic.getTopologyString(subjectName, segmentName)
+      if role == qt.Qt.BackgroundRole and self.logic.getConsistencyString(subjectName, segmentName) == 'Inconsistent':
+        return qt.QBrush(qt.QColor(255, 204, 203)) # light red
+    if column == self.columnTopologyExpected and segmentName in self.logic.expectedTopologiesBySegment:
+      topologyExpected = self.logic.expectedTopologiesBySegment[segmentName]
+      if role == qt.Qt.DisplayRole:
+        return self.logic.TOPOLOGY_TYPES[topologyExpected]
+      if role == qt.Qt.EditRole:
+        return self.logic.topologyTypeToIndex[topologyExpected]
+    return None
+
+  def setData(self, index, value, role):
+    if index.column() != self.columnTopologyExpected or role != qt.Qt.EditRole:
+      return False
+    subjectName, segmentName = self.subjectAndSegmentOfRow(index.row())
+    topologyType = self.logic.indexToTopologyType[int(value)]
+    if self.logic.expectedTopologiesBySegment.get(segmentName) == topologyType:
+      return False
+    if self.expectedTopologyCallback is not None:
+      self.expectedTopologyCallback(segmentName, topologyType)
+    return True
+
+  def sort(self, column, order):
+    if not self.rowCount():
+      return
+    rows = [self.subjectAndSegmentOfRow(row) for row in range(self.rowCount())]
+    if column == self.columnSubjectName:
+      keys = [subjectName for subjectName, segmentName in rows]
+    elif column == self.columnSegmentName:
+      keys = [segmentName for subjectName, segmentName in rows]
+    elif column == self.columnTopologyCurrent:
+      keys = [self.logic.getTopologyString(subjectName, segmentName) for subjectName, segmentName in rows]
+    else:
+      keys = [self.logic.TOPOLOGY_TYPES.get(self.logic.expectedTopologiesBySegment.get(segmentName), '')
+              for subjectName, segmentName in rows]
+    rowOrder = sorted(range(len(keys)), key=keys.__getitem__, reverse=(order == qt.Qt.DescendingOrder))
+    self.beginResetModel()
+    self.rowSubjects = self.rowSubjects[rowOrder]
+    self.rowSegments = self.rowSegments[rowOrder]
+    self.endResetModel()
+
+  def setFilters(self, segmentNameFilter='', topologyType=None, inconsistentOnly=False):
+    self.filters = {'segmentNameFilter': segmentNameFilter, 'topologyType': topologyType,
+                    'inconsistentOnly': inconsistentOnly}
+    self.setSubjectNames(self.subjectNames)
+
+  def setSubjectNames(self, subjectNames):
+    """
+    Show the segments of subjectNames that pass the filters, in subject then segment order.
+    """
+    self.beginResetModel()
+    self.subjectNames = [name for name in subjectNames if name in self.logic.topologyDict]
+    self._setColumns(len(self.subjectNames) > 1)
+    self.segmentNames = self.logic.topologyDict.segmentNames()
+    mask = self.logic.topologyFilterMask(self.subjectNames, **self.filters)
+    self.rowSubjects, self.rowSegments = np.nonzero(mask)
+    self.endResetModel()
+
+  def updateSegments(self, segmentNames):
+    """
+    Update the rows of segmentNames after their expected topology changed, the visible rows are repainted.
+    """
+    if self.filters.get('inconsistentOnly'):
+      self.setSubjectNames(self.subjectNames)
+      return
+    if self.rowCount():
+      self.dataChanged(self.index(0, self.columnTopologyCurrent), self.index(self.rowCount() - 1, self.columnTopologyExpected))
+
+  def subjectAndSegmentOfRow(self, row):
+    return self.subjectNames[self.rowSubjects[row]], self.segmentNames[self.rowSegments[row]]
+
+#
+# DataImporterTopologyTypeDelegate
+#
+
+class DataImporterTopologyTypeDelegate(qt.QStyledItemDelegate):
+  """
+  Edit the expected topology of a segment with a combo box of TOPOLOGY_TYPES, created only while editing.
+  The model gives and receives the index of the combo box with qt.Qt.EditRole.
+  """
+  def __init__(self, topologyTypeNames, parent=None):
+    qt.QStyledItemDelegate.__init__(self, parent)
+    self.topologyTypeNames = list(topologyTypeNames)
+
+  def createEditor(self, parent, option, index):
+    comboBox = qt.QComboBox(parent)
+    for topologyTypeName in self.topologyTypeNames:
+      comboBox.addItem(topologyTypeName)
+    comboBox.connect('activated(int)', lambda comboBoxIndex, comboBox=comboBox: self.commitData(comboBox))
+    return comboBox
+
+  def setEditorData(self, editor, index):
+    editor.setCurrentIndex(index.data(qt.Qt.EditRole))
+
+  def setModelData(self, editor, model, index):
+    model.setData(index, editor.currentIndex, qt.Qt.EditRole)
+
+#
+# DataImporterRadioButtonDelegate
+#
+
+class DataImporterRadioButtonDelegate(qt.QStyledItemDelegate):
+  """
+  Draw a radio button, checked if the qt.Qt.UserRole data of the index is True, and set the data of the model
+  to True when it is clicked. Nothing is created per row.
+  """
+  def paint(self, painter, option, index):
+    qt.QStyledItemDelegate.paint(self, painter, option, index)
+    buttonOption = qt.QStyleOptionButton()
+    buttonOption.rect = option.rect
+    buttonOption.state = qt.QStyle.State_Enabled | (qt.QStyle.State_On if index.data(qt.Qt.UserRole) else qt.QStyle.State_Off)
+    qt.QApplication.style().drawControl(qt.QStyle.CE_RadioButton, buttonOption, painter)
+
+  def editorEvent(self, event, model, option, index):
+    if event.type() == qt.QEvent.MouseButtonRelease and not index.data(qt.Qt.UserRole):
+      return model.setData(index, True, qt.Qt.EditRole)
+    return False
 
 #
 # DataImporterWidget
@@ -772,20 +3809,30 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     #
     self.logic = DataImporterLogic()
     self.filteredFilePathsList = list()
-    self.tableWidgetItemDefaultFlags = qt.Qt.NoItemFlags | qt.Qt.ItemIsSelectable | qt.Qt.ItemIsEnabled
     self.displayOnClick = True
-
-    self.TemplateButtonLookup = {}
-
-    # Table columns
-    self.subjectsColumnName = 0
-    self.subjectsColumnConsistency = 1
-    self.subjectsColumnTemplate = 2
-    # Note that these values change on initSegmentsTable/initSegmentsMultiTable
-    self.segmentsColumnSubjectName = -1
-    self.segmentsColumnSegmentName = 0
-    self.segmentsColumnTopologyCurrent = 1
-    self.segmentsColumnTopologyExpected = 2
+    # Subjects shown by displaySelectedIndexes, their closed surfaces are released when hidden in lazy mode
+    self.displayedSubjectNames = set()
+    # Segment ids shown by displaySelectedIndexes for each subject of displayedSubjectNames, None for all of them
+    self.displayedSegmentIds = {}
+    # Segment names of the previews shown by displaySelectedIndexes for each subject, see PreviewCheckBox
+    self.displayedPreviewSegmentNames = {}
+    # Last selection requested by displaySelectedIndexes, shown at full resolution by showFullResolution
+    self.requestedSegmentNames = OrderedDict()
+    # Previews are replaced by the full resolution surfaces when the selection does not change for a while
+    self.fullResolutionTimer = qt.QTimer()
+    self.fullResolutionTimer.setSingleShot(True)
+    self.fullResolutionTimer.setInterval(1500)
+    self.fullResolutionTimer.connect('timeout()', self.showFullResolution)
+
+    # Models of SubjectsTableView and SegmentsTableView, created with the views
+    self.subjectsTableModel = None
+    self.segmentsTableModel = None
+
+    # Streaming import, see importFiles
+    self.importGenerator = None
+    self.importTimer = qt.QTimer()
+    self.importTimer.setInterval(0)
+    self.importTimer.connect('timeout()', self.onImportTimeout)
 
     # get available color tables
     self.color_table_dict = dict()
@@ -814,6 +3861,9 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.InputFolderNameLineEdit = self.ui.InputFolderNameLineEdit
     self.FolderDirectoryButton = self.ui.FolderDirectoryButton
     self.FolderDirectoryButton.connect('directoryChanged(QString)', self.onDirectoryChanged)
+    self.ui.RecursiveDirectoryCheckBox.connect('toggled(bool)', self.onDirectoryFilterChanged)
+    self.ui.IncludePatternsLineEdit.connect('editingFinished()', self.onDirectoryFilterChanged)
+    self.ui.ExcludePatternsLineEdit.connect('editingFinished()', self.onDirectoryFilterChanged)
 
     self.InputFileTypeSelection = self.ui.InputFileTypeSelection
     self.InputFileTypeSelection.connect('currentIndexChanged(QString)', self.onFileTypeSelectionChanged)
@@ -848,6 +3898,8 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.freesurferFilesOfInterest['aseg'] = os.path.normpath("mri/aseg.mgz")
     self.freesurferFilesOfInterest['aparc+aseg'] = os.path.normpath("mri/aparc+aseg.mgz")
     self.freesurferFilesOfInterest['aparc.a2009s+aseg'] = os.path.normpath("mri/aparc.a2009s+aseg.mgz")
+    # Labels present in each subject, see DataImporterLogic.computeFreeSurferLabelCensus
+    self.freesurferLabelCensus = None
 
     # home directory
     self.InputFreeSurferHomeFolderNameLineEdit = self.ui.InputFreeSurferHomeFolderNameLineEdit
@@ -863,6 +3915,21 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.InputFreeSurferFileSelection = self.ui.InputFreeSurferFileSelection
     self.InputFreeSurferFileSelection.connect('currentIndexChanged(QString)', self.onFreeSurferFileSelectionChanged)
 
+    # Index of the files of interest in the subjects directory, see DataImporterLogic.updateFreeSurferSubjectsIndex
+    self.freesurferSubjectsIndex = None
+    # Subjects directory watching: refresh once changes settle, and periodically for files created in existing subjects
+    self.freesurferSubjectsWatcher = qt.QFileSystemWatcher()
+    self.freesurferSubjectsWatcher.connect('directoryChanged(QString)', self.onFreeSurferSubjectsDirectoryModified)
+    self.freesurferRefreshTimer = qt.QTimer()
+    self.freesurferRefreshTimer.setSingleShot(True)
+    self.freesurferRefreshTimer.setInterval(2000)
+    self.freesurferRefreshTimer.connect('timeout()', self.refreshFreeSurferSubjects)
+    self.freesurferPollTimer = qt.QTimer()
+    self.freesurferPollTimer.setInterval(60000)
+    self.freesurferPollTimer.connect('timeout()', self.refreshFreeSurferSubjects)
+    self.WatchFreeSurferSubjectsCheckBox = self.ui.WatchFreeSurferSubjectsCheckBox
+    self.WatchFreeSurferSubjectsCheckBox.connect('toggled(bool)', self.updateFreeSurferSubjectsWatcher)
+
     # FreeSurfer Subjects table
     self.InputFreeSurferSubjectsTable = self.ui.InputFreeSurferSubjectsTable
     self.FreeSurferImportAllSubjectsOption = self.ui.FreeSurferImportAllSubjectsOption
@@ -888,22 +3955,66 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.InputFreeSurferFileSelection.addItem(file_name)
 
     self.ui.ImportButton.connect('clicked(bool)', self.onClickImportButton)
-    self.SubjectsTableWidget = self.ui.SubjectsTableWidget
-    self.SegmentsTableWidget = self.ui.SegmentsTableWidget
+    self.ui.UpdateImportButton.connect('clicked(bool)', self.onClickUpdateImportButton)
+    # True while importing the files of an update, see onClickUpdateImportButton
+    self.importIsUpdate = False
+    self.ui.CancelImportButton.connect('clicked(bool)', self.onClickCancelImportButton)
+    self.SubjectsTableView = self.ui.SubjectsTableView
+    self.SegmentsTableView = self.ui.SegmentsTableView
+    self.subjectsTableModel = DataImporterSubjectsTableModel(self.logic, self.onTemplateChanged, self.SubjectsTableView)
+    self.SubjectsTableView.setModel(self.subjectsTableModel)
+    self.templateDelegate = DataImporterRadioButtonDelegate(self.SubjectsTableView)
+    self.SubjectsTableView.setItemDelegateForColumn(DataImporterSubjectsTableModel.COLUMN_TEMPLATE, self.templateDelegate)
+    self.segmentsTableModel = DataImporterSegmentsTableModel(self.logic, self.onExpectedTopologyChanged, self.SegmentsTableView)
+    self.SegmentsTableView.setModel(self.segmentsTableModel)
+    self.topologyTypeDelegate = DataImporterTopologyTypeDelegate(
+      [self.logic.TOPOLOGY_TYPES[self.logic.indexToTopologyType[index]] for index in sorted(self.logic.indexToTopologyType)],
+      self.SegmentsTableView)
+    # Delegates are set on the view: the expected topology column moves with the subject name column
+    self.SegmentsTableView.setItemDelegate(self.topologyTypeDelegate)
+    self.initSubjectsTable()
+    self.initSegmentsTable()
+
+    self.ui.TopologyTypeFilterComboBox.addItem('All topologies')
+    for index in sorted(self.logic.indexToTopologyType):
+      self.ui.TopologyTypeFilterComboBox.addItem(self.logic.TOPOLOGY_TYPES[self.logic.indexToTopologyType[index]])
+    self.ui.InconsistentOnlyCheckBox.connect('toggled(bool)', self.onTopologyFilterChanged)
+    self.ui.SegmentNameFilterLineEdit.connect('textChanged(QString)', self.onTopologyFilterChanged)
+    self.ui.TopologyTypeFilterComboBox.connect('currentIndexChanged(int)', self.onTopologyFilterChanged)
     self.ui.SaveCleanDataCheckBox.setChecked(True)
     self.ui.SaveCleanDataCheckBox.connect('toggled(bool)', self.onSaveCleanDataCheckBoxToggled)
-
-    self.SubjectsTableWidget.connect('cellClicked(int, int)', self.onSubjectsTableWidgetCellClicked)
-    self.SegmentsTableWidget.connect('cellClicked(int, int)', self.onSegmentsTableWidgetCellClicked)
+    self.ui.LazyClosedSurfacesCheckBox.connect('toggled(bool)', self.onLazyClosedSurfacesCheckBoxToggled)
+    self.ui.CompactPolyDataCheckBox.connect('toggled(bool)', self.onCompactPolyDataCheckBoxToggled)
+    self.ui.NumberOfWorkersSpinBox.connect('valueChanged(int)', self.onNumberOfWorkersChanged)
+    self.ui.MemoryBudgetSpinBox.connect('valueChanged(int)', self.onMemoryBudgetChanged)
+
+    # Topology backends: (combobox text, backend, voxel connectivity)
+    self.topologyBackends = [
+      ('Closed Surface', DataImporterLogic.TOPOLOGY_BACKEND_SURFACE, 26),
+      ('Label Map Voxels (26-connectivity)', DataImporterLogic.TOPOLOGY_BACKEND_VOXEL, 26),
+      ('Label Map Voxels (6-connectivity)', DataImporterLogic.TOPOLOGY_BACKEND_VOXEL, 6),
+    ]
+    for text, backend, connectivity in self.topologyBackends:
+      self.ui.TopologyBackendSelection.addItem(text)
+    self.ui.TopologyBackendSelection.connect('currentIndexChanged(int)', self.onTopologyBackendSelectionChanged)
+
+    self.SubjectsTableView.connect('clicked(QModelIndex)', self.onSubjectsTableViewClicked)
+    self.SegmentsTableView.connect('clicked(QModelIndex)', self.onSegmentsTableViewClicked)
 
     self.ui.DisplaySelectedPushButton.connect('clicked(bool)', self.onClickDisplaySelectedPushButton)
     self.ui.DisplayOnClickCheckBox.connect('toggled(bool)', self.onDisplayOnClickCheckBoxToggled)
+    self.ui.PreviewCheckBox.connect('toggled(bool)', self.onPreviewCheckBoxToggled)
+    self.ui.FullResolutionPushButton.connect('clicked(bool)', self.showFullResolution)
 
     # Set self.displayOnClick according to ui file
     self.onDisplayOnClickCheckBoxToggled()
 
     # Initialize the beginning input type.
     self.onSaveCleanDataCheckBoxToggled()
+    self.onLazyClosedSurfacesCheckBoxToggled()
+    self.onCompactPolyDataCheckBoxToggled()
+    self.onPreviewCheckBoxToggled()
+    self.onNumberOfWorkersChanged()
 
     # Shape Analysis Structure Generation
     self.InputShapeAnalysisFolderNameLineEdit = self.ui.InputShapeAnalysisFolderNameLineEdit
@@ -911,6 +4022,11 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ShapeAnalysisFolderPushButton.connect('directoryChanged(QString)', self.onShapeAnalysisFolderChanged)
     self.CreateShapeAnalysisStructurePushButton = self.ui.CreateShapeAnalysisStructurePushButton
     self.CreateShapeAnalysisStructurePushButton.connect('clicked(bool)', self.onGenerateShapeAnalysisStructure)
+    self.modelFormats = [('Binary VTK (.vtk)', DataImporterLogic.MODEL_FORMAT_VTK),
+                         ('Compressed VTK XML (.vtp)', DataImporterLogic.MODEL_FORMAT_VTP)]
+    for text, modelFormat in self.modelFormats:
+      self.ui.ModelFormatSelection.addItem(text)
+    self.ui.ModelFormatSelection.connect('currentIndexChanged(int)', self.onModelFormatSelectionChanged)
 
     # detect if when a node is added to update colortable list
     self.registerCallbacks()
@@ -920,17 +4036,24 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   
   def onSceneStartClose(self, caller, event):
+    self.stopImport()
     self.logic.cleanup()
+    self.updateMemoryUsageLabel()
     self.resetSubjectsTable()
     self.resetSegmentsTable()
     self.resetFreeSurferSubjectsTable()
     self.resetFreeSurferSegmentsTable()  
+    self.freesurferSubjectsIndex = None
+    self.updateFreeSurferSubjectsWatcher()
 
   #
   # Reset all the data for data import
   #
   def cleanup(self):
     logging.debug('Cleaning up widget')
+    self.stopImport()
+    self.freesurferRefreshTimer.stop()
+    self.freesurferPollTimer.stop()
     self.resetFreeSurferSubjectsTable()
     self.resetFreeSurferSegmentsTable()
     self.resetSubjectsTable()
@@ -956,136 +4079,95 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def initSubjectsTable(self):
     """
-    Set options and headers of SubjectsTable.
+    Set options and headers of SubjectsTableView.
     Does not require any other data structure populated.
     """
     ##### Subjects Table
     self.resetSubjectsTable()
-    nameColumn = 0
-    consistencyColumn = 1
-    checkColumn = 2
-    nameColumnLabel = 'Subject name'
-    consistencyColumnLabel = 'Consistency'
-    checkColumnLabel = "Use as template"
-    self.SubjectsTableWidget.setColumnCount(3)
-    self.SubjectsTableWidget.setHorizontalHeaderLabels([
-      nameColumnLabel,
-      consistencyColumnLabel,
-      checkColumnLabel
-    ])
-    self.SubjectsTableWidget.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
-    self.SubjectsTableWidget.verticalHeader().setVisible(False)
-    self.SubjectsTableWidget.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.SubjectsTableView.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
+    self.SubjectsTableView.verticalHeader().setVisible(False)
+    self.SubjectsTableView.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
 
   def initSegmentsTable(self):
     """
-    Set options and headers of SegmentsTable for the case of a single subject displayed.
-    Does not require any other data structure populated.
-    """
-    self.resetSegmentsTable()
-    self.segmentsColumnSubjectName = -1
-    self.segmentsColumnSegmentName = 0
-    self.segmentsColumnTopologyCurrent = 1
-    self.segmentsColumnTopologyExpected = 2
-    segmentNameColumnLabel = 'Segment Name'
-    topologyCurrentColumnLabel = 'Current Segment Topology'
-    topologyExpectedColumnLabel = 'Expected Cohort Topology'
-    self.SegmentsTableWidget.setColumnCount(3)
-    self.SegmentsTableWidget.setHorizontalHeaderLabels([
-      segmentNameColumnLabel,
-      topologyCurrentColumnLabel,
-      topologyExpectedColumnLabel
-    ])
-    self.SegmentsTableWidget.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
-    self.SegmentsTableWidget.verticalHeader().setVisible(False)
-    self.SegmentsTableWidget.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
-
-  def initSegmentsMultiTable(self):
-    """
-    Set options and headers of SegmentsTable for the case of multiple subjects displayed.
+    Set options and headers of SegmentsTableView.
     Does not require any other data structure populated.
     """
     self.resetSegmentsTable()
-    self.segmentsColumnSubjectName = 0
-    self.segmentsColumnSegmentName = 1
-    self.segmentsColumnTopologyCurrent = 2
-    self.segmentsColumnTopologyExpected = 3
-    subjectNameColumnLabel = 'Subject'
-    segmentNameColumnLabel = 'Segment'
-    topologyCurrentColumnLabel = 'Current Segment Topology'
-    topologyExpectedColumnLabel = 'Expected Cohort Topology'
-    self.SegmentsTableWidget.setColumnCount(4)
-    self.SegmentsTableWidget.setHorizontalHeaderLabels([
-      subjectNameColumnLabel,
-      segmentNameColumnLabel,
-      topologyCurrentColumnLabel,
-      topologyExpectedColumnLabel
-    ])
-    self.SegmentsTableWidget.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
-    self.SegmentsTableWidget.verticalHeader().setVisible(False)
-    self.SegmentsTableWidget.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.SegmentsTableView.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
+    self.SegmentsTableView.verticalHeader().setVisible(False)
+    self.SegmentsTableView.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.SegmentsTableView.setEditTriggers(qt.QAbstractItemView.AllEditTriggers)
 
   def resetSubjectsTable(self):
-    if self.SubjectsTableWidget is not None:
-      self.SubjectsTableWidget.setRowCount(0)
+    if self.subjectsTableModel is not None:
+      self.subjectsTableModel.setNames([])
+    # Nodes of a new import are hidden
+    self.fullResolutionTimer.stop()
+    self.displayedSegmentIds = {}
+    self.displayedPreviewSegmentNames = {}
+    self.requestedSegmentNames = OrderedDict()
 
   def resetSegmentsTable(self):
-    if self.SegmentsTableWidget is not None:
-      self.SegmentsTableWidget.setRowCount(0)
+    if self.segmentsTableModel is not None:
+      self.segmentsTableModel.setSubjectNames([])
+
+  def getRowsFromSelectedIndexes(self, tableView):
+    """ Return list with unique rows from selectedIndexes of input table. """
+    return sorted(set(qModelIndex.row() for qModelIndex in tableView.selectedIndexes()))
 
-  def getRowsFromSelectedIndexes(self, tableWidget):
-    """ Return set with unique rows from selectedIndexes of input table. """
-    currentSelectedIndexes = tableWidget.selectedIndexes()
-    uniqueRowIndexes = set()
-    for qModelIndex in currentSelectedIndexes:
-      uniqueRowIndexes.add(qModelIndex.row())
-    return list(uniqueRowIndexes)
+  def getSelectedSubjectNames(self):
+    return [self.subjectsTableModel.nameOfRow(row) for row in self.getRowsFromSelectedIndexes(self.SubjectsTableView)]
 
   def populateSegmentsTableWithCurrentSubjectsSelection(self):
-    uniqueRowIndexes = self.getRowsFromSelectedIndexes(self.SubjectsTableWidget)
-    # Get Names from rows
-    if len(uniqueRowIndexes) == 1:
-      # Save current selection
-      selectedSegmentIndex = self.getRowsFromSelectedIndexes(self.SegmentsTableWidget)
+    names = self.getSelectedSubjectNames()
+    # Save current selection, restored if the same subject is shown
+    selectedSegmentRows = self.getRowsFromSelectedIndexes(self.SegmentsTableView)
+    keepSelection = len(names) == 1 and self.segmentsTableModel.subjectNames == names
+    self.segmentsTableModel.setSubjectNames(names)
+    if keepSelection:
+      for row in selectedSegmentRows:
+        if row < self.segmentsTableModel.rowCount():
+          self.SegmentsTableView.selectRow(row)
 
-      self.initSegmentsTable()
-      name = self.SubjectsTableWidget.item(uniqueRowIndexes[0], self.subjectsColumnName).text()
-      self.populateSegmentsTable(name)
-      # Restore selection
-      for rowindex in selectedSegmentIndex:
-        self.SegmentsTableWidget.selectRow(rowindex)
+  def updateSubjectsTableConsistencyColumn(self):
+    # Subjects hidden by the filters are updated too
+    if len(self.subjectsTableModel.names) == 0:
       return
+    self.logic.populateInconsistentTopologyDict()
+    self.subjectsTableModel.refilter()
+    self.populateSegmentsTableWithCurrentSubjectsSelection()
 
-    self.initSegmentsMultiTable()
-    for row in uniqueRowIndexes:
-      name = self.SubjectsTableWidget.item(row, self.subjectsColumnName).text()
-      self.populateSegmentsMultiTable(name)
+  def updateConsistencyOfSegments(self, segmentNames):
+    """
+    Update the consistency after the expected topology of segmentNames changed. Only the columns of
+    segmentNames are compared (see logic.updateInconsistentTopologyDictForSegments), and only the rows of the
+    subjects whose inconsistencies changed are repainted.
+    """
+    changedNames = self.logic.updateInconsistentTopologyDictForSegments(segmentNames)
+    self.subjectsTableModel.updateNames(changedNames)
+    self.segmentsTableModel.updateSegments(segmentNames)
 
-  def updateSubjectsTableConsistencyColumn(self):
-    self.SubjectsTableWidget.setSortingEnabled(False)
-    consistencyColumn = 1
-    rowCount = self.SubjectsTableWidget.rowCount
-    if not rowCount:
-      return
-    inconsistenciesExist, inconsistentDict = self.logic.populateInconsistentTopologyDict()
-    for row in range(0, rowCount):
-      name = self.SubjectsTableWidget.item(row, 0).text()
-      consistency = 'Consistent'
-      countInconsistencies = 0
-      if name in inconsistentDict:
-        countInconsistencies = len(inconsistentDict[name])
-      if countInconsistencies > 0:
-        consistency = '# Inconsistencies: ' + str(countInconsistencies)
-        consistencyBackground = qt.QBrush(qt.QColor(255, 204, 203)) # light red
-      else:
-        consistencyBackground = qt.QBrush(qt.QColor(255, 255, 255)) # white
-      self.SubjectsTableWidget.item(row, consistencyColumn).setText(consistency)
-      self.SubjectsTableWidget.item(row, consistencyColumn).setBackground(consistencyBackground)
+  def updateMetricOutliers(self):
+    """
+    Flag the outliers of the cohort metrics (see logic.computeMetricOutliers) in the QC column of SubjectsTableView.
+    They are computed once the whole cohort is imported, not after each batch.
+    """
+    self.logic.computeMetricOutliers()
+    self.subjectsTableModel.updateOutliers()
 
-    #XXX is this the best place to trigger re-populate?
-    self.resetSegmentsTable()
-    self.populateSegmentsTableWithCurrentSubjectsSelection()
-    self.SubjectsTableWidget.setSortingEnabled(True)
+  def onTopologyFilterChanged(self):
+    """
+    Apply the filters of the subjects and segments tables, see DataImporterLogic.topologyFilterMask.
+    """
+    topologyTypeIndex = self.ui.TopologyTypeFilterComboBox.currentIndex
+    filters = {
+      'segmentNameFilter': self.ui.SegmentNameFilterLineEdit.text.strip(),
+      'topologyType': self.logic.indexToTopologyType[topologyTypeIndex - 1] if topologyTypeIndex > 0 else None,
+      'inconsistentOnly': self.ui.InconsistentOnlyCheckBox.isChecked(),
+    }
+    self.subjectsTableModel.setFilters(**filters)
+    self.segmentsTableModel.setFilters(**filters)
 
   def populateSubjectsTable(self):
     """
@@ -1096,222 +4178,130 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       logging.error("Trying to populateSubjectsTable with non existant topologyDict.")
       return
 
-    self.TemplateButtonLookup = {}
-
-    # Required to safely populate table when sorting is enabled, restored later.
-    self.SubjectsTableWidget.setSortingEnabled(False)
-
-    nameColumn = 0
-    consistencyColumn = 1
-    checkColumn = 2
-
-    buttonGroup = qt.QButtonGroup(self.SubjectsTableWidget)
-    buttonGroup.setExclusive(True)
-
-    
-    inconsistenciesExist = False
-    inconsistentDict = {}
-    # User can change self.logic.expectedTopologiesBySegment prior to call this function
-    
-
-    for name in self.logic.topologyDict:
-      # Populate subject names
-      rowPosition = self.SubjectsTableWidget.rowCount
-
-      if rowPosition == 0:
-        self.logic.TemplateName = name
-        inconsistenciesExist, inconsistentDict = self.logic.populateInconsistentTopologyDict()
-
-      self.SubjectsTableWidget.insertRow(rowPosition)
-      nameItem = qt.QTableWidgetItem(name)
-      nameItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SubjectsTableWidget.setItem(rowPosition, nameColumn, nameItem)
-
-      # Populate consistency column
-      consistency = 'Consistent'
-      countInconsistencies = 0
-      if name in inconsistentDict:
-        countInconsistencies = len(inconsistentDict[name])
-      if countInconsistencies > 0:
-        consistency = '# Inconsistencies: ' + str(countInconsistencies)
-      consistencyItem = qt.QTableWidgetItem(consistency)
-      consistencyItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SubjectsTableWidget.setItem(rowPosition, consistencyColumn, consistencyItem)
-      if countInconsistencies > 0:
-        consistencyItem.setBackground(qt.QBrush(qt.QColor(255, 204, 203))) # light red
-
-      #populate checkboxes
-      checkItem = qt.QRadioButton()
-      if rowPosition == 0:
-        checkItem.setChecked(True)        
-      buttonGroup.addButton(checkItem)
-      self.TemplateButtonLookup[buttonGroup.id(checkItem)] = name      
-      self.SubjectsTableWidget.setCellWidget(rowPosition, checkColumn, checkItem)
-
-    # Restore sorting
-    self.SubjectsTableWidget.setSortingEnabled(True)
-
-    #connect buttons
-    buttonGroup.connect('buttonClicked(int)', self.onTemplateRadioButtons)
-
-
-  def onTemplateRadioButtons(self, id):
-    if self.TemplateButtonLookup[id] != self.logic.TemplateName:      
-      if self.TemplateButtonLookup[id] in self.logic.topologyDict:
-        self.logic.TemplateName = self.TemplateButtonLookup[id]
-        self.logic.initExpectedTopologyBySubjectTemplate(self.logic.topologyDict, self.logic.TemplateName)
-        self.updateSubjectsTableConsistencyColumn()
+    # User can change self.logic.expectedTopologiesBySegment prior to call this function.
+    # The table is empty if it has no subject, not if the filters hide all of them.
+    if len(self.subjectsTableModel.names) == 0:
+      self.logic.TemplateName = next(iter(self.logic.topologyDict))
+      self.logic.populateInconsistentTopologyDict()
+
+    self.appendSubjectsToTable(list(self.logic.topologyDict))
+    self.updateMetricOutliers()
 
-  def populateSegmentsTable(self, nameKey):
+  def appendSubjectsToTable(self, names):
     """
-    Given the name acting as first key for self.logic.topologyDict,
-    populates the segment table for the subject with such a name.
-    PRE: topologyDict has to have a key equal to input nameKey
-    POST: Populates SegmentsTable (appending) for given name.
+    PRE: Requires self.logic.inconsistentTopologyDict populated for names.
+    POST: Append a row to SubjectTable for each name passing the filters.
     """
-    if not self.logic.topologyDict:
-      logging.error("Trying to populateSegmentsTable with non existant topologyDict.")
-      return
-    if not nameKey in self.logic.topologyDict:
-      logging.error("Input nameKey: {} does not exist in topologyDict.".format(nameKey))
-      return
-
-    # Required to safely populate table when sorting is enabled, restored later.
-    self.SegmentsTableWidget.setSortingEnabled(False)
-    # Block signals while populating programatically
-    self.SegmentsTableWidget.blockSignals(True)
-    self.SegmentsTableWidget.hide()
-
-    segmentNameColumn = 0
-    topologyCurrentColumn = 1
-    topologyExpectedColumn = 2
-    # cohortConsistencyColumn = 2
-    for segmentName in self.logic.topologyDict[nameKey]:
-      # Populate segmentName row
-      rowPosition = self.SegmentsTableWidget.rowCount
-      self.SegmentsTableWidget.insertRow(rowPosition)
-      segmentNameItem = qt.QTableWidgetItem(segmentName)
-      segmentNameItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SegmentsTableWidget.setItem(rowPosition, segmentNameColumn, segmentNameItem )
-
-      # Get topology and consistency of segment
-      topologyCurrent, consistency = self.logic.getTopologyAndConsistencyString(nameKey, segmentName)
-      # Populate topology row
-      topologyCurrentItem = qt.QTableWidgetItem(topologyCurrent)
-      topologyCurrentItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SegmentsTableWidget.setItem(rowPosition, topologyCurrentColumn, topologyCurrentItem)
-      if consistency == 'Inconsistent':
-        topologyCurrentItem.setBackground(qt.QBrush(qt.QColor(255, 204, 203))) # light red
-
-      topologyExpected = self.logic.expectedTopologiesBySegment[segmentName]
-      comboBox = self._createTopologyTypesComboBox()
-      comboBox.setCurrentIndex(self.logic.topologyTypeToIndex[topologyExpected])
-      comboBox.connect('currentIndexChanged(int)', lambda index, name=segmentName: self.onSegmentTableWidgetComboBoxCurrentIndexChanged(index, name))
-      self.SegmentsTableWidget.setCellWidget(rowPosition, topologyExpectedColumn, comboBox)
-
-    # Restore sorting
-    self.SegmentsTableWidget.setSortingEnabled(True)
-
-    # Restore signals
-    self.SegmentsTableWidget.blockSignals(False)
-    self.SegmentsTableWidget.show()
+    self.subjectsTableModel.appendNames(names)
 
-  def populateSegmentsMultiTable(self, nameKey):
+  def removeSubjectsFromTable(self, names):
     """
-    Given the name acting as first key for self.logic.topologyDict,
-    populates the segment table for the subject with such a name.
-    PRE: topologyDict has to have a key equal to input nameKey
-    POST: Populates SegmentsTable (appending) for given name.
-    The difference between this and populateSegmentsTable is that
-    the table is populated differentely.
+    Remove the rows of names from SubjectsTable.
     """
-    ### TODO: Merge both populateSegmentsXTable to avoid repetition.
-    if not self.logic.topologyDict:
-      logging.error("Trying to populateSegmentsMultiTable with non existant topologyDict.")
-      return
-    if not nameKey in self.logic.topologyDict:
-      logging.error("Input nameKey: {} does not exist in topologyDict.".format(nameKey))
-      return
-
-    # Required to safely populate table when sorting is enabled, restored later.
-    self.SegmentsTableWidget.setSortingEnabled(False)
-
-    # Block signals while populating programatically
-    self.SegmentsTableWidget.blockSignals(True)
-    self.SegmentsTableWidget.hide()
-
-    subjectNameColumn = 0
-    segmentNameColumn = 1
-    topologyCurrentColumn = 2
-    topologyExpectedColumn = 3
-    # cohortConsistencyColumn = 2
-    for segmentName in self.logic.topologyDict[nameKey]:
-      # Populate segmentName row
-      rowPosition = self.SegmentsTableWidget.rowCount
-      self.SegmentsTableWidget.insertRow(rowPosition)
-
-      # subjectName
-      subjectNameItem = qt.QTableWidgetItem(nameKey)
-      subjectNameItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SegmentsTableWidget.setItem(rowPosition, subjectNameColumn, subjectNameItem )
-      # segmentName
-      segmentNameItem = qt.QTableWidgetItem(segmentName)
-      segmentNameItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SegmentsTableWidget.setItem(rowPosition, segmentNameColumn, segmentNameItem )
-
-      # Get topology and consistency of segment
-      topologyCurrent, consistency = self.logic.getTopologyAndConsistencyString(nameKey, segmentName)
-      # Populate topology row
-      topologyCurrentItem = qt.QTableWidgetItem(topologyCurrent)
-      topologyCurrentItem.setFlags(self.tableWidgetItemDefaultFlags)
-      self.SegmentsTableWidget.setItem(rowPosition, topologyCurrentColumn, topologyCurrentItem)
-      if consistency == 'Inconsistent':
-        topologyCurrentItem.setBackground(qt.QBrush(qt.QColor(255, 204, 203))) # light red
-
-      topologyExpected = self.logic.expectedTopologiesBySegment[segmentName]
-      comboBox = self._createTopologyTypesComboBox()
-      comboBox.setCurrentIndex(self.logic.topologyTypeToIndex[topologyExpected])
-      comboBox.connect('currentIndexChanged(int)', lambda index, name=segmentName: self.onSegmentTableWidgetComboBoxCurrentIndexChanged(index, name))
-      self.SegmentsTableWidget.setCellWidget(rowPosition, topologyExpectedColumn, comboBox)
-
-    # Restore sorting
-    self.SegmentsTableWidget.setSortingEnabled(True)
-
-    # Restore signals
-    self.SegmentsTableWidget.blockSignals(False)
-    self.SegmentsTableWidget.show()
-
-  def _createTopologyTypesComboBox(self):
+    self.displayedSubjectNames -= set(names)
+    for name in names:
+      self.displayedSegmentIds.pop(name, None)
+      self.displayedPreviewSegmentNames.pop(name, None)
+      self.requestedSegmentNames.pop(name, None)
+    self.subjectsTableModel.removeNames(names)
+
+  def onTemplateChanged(self, name):
+    if name != self.logic.TemplateName and name in self.logic.topologyDict:
+      changedSegmentNames = self.logic.setTemplateName(name)
+      self.updateConsistencyOfSegments(changedSegmentNames)
+
+  def importFiles(self, filePaths, update=False):
     """
-    Return ComboBox with values from enum TOPOLOGY_TYPES
+    Import filePaths without blocking the interface: the logic imports one batch of subjects on each
+    timeout of importTimer, and each subject is added to the tables with its consistency as soon as
+    its topology is computed. See onImportTimeout and onClickCancelImportButton.
+    If update, the subjects are appended to the tables, and the consistency of all the subjects
+    is updated at the end.
     """
-    comboBox = qt.QComboBox()
-    for string_value in self.logic.TOPOLOGY_TYPES.values():
-      comboBox.addItem(string_value)
+    self.stopImport()
+    try:
+      # Files are validated as they are imported, missing ones are reported in importErrors
+      self.importGenerator = self.logic.importFilesIncrementally(iter(filePaths))
+    except TypeError as e:
+      logging.warning("logic.importFiles issues: {}".format(e))
+      return
+    self.importIsUpdate = update
 
-    return comboBox
+    ######### Init Tables ##########
+    if not update:
+      self.initSubjectsTable()
+      self.initSegmentsTable()
 
-  def importFiles(self, filePaths):
+    self.numberOfFilesToImport = len(filePaths)
+    self.importStartTime = time.time()
+    self.ui.ImportProgressBar.setMaximum(self.numberOfFilesToImport)
+    self.ui.ImportProgressBar.setValue(0)
+    self.ui.ImportProgressBar.setFormat('%v/%m subjects')
+    self.ui.ImportProgressBar.visible = True
+    self.ui.CancelImportButton.visible = True
+    self.ui.ImportButton.enabled = False
+    self.ui.UpdateImportButton.enabled = False
+    self.importTimer.start()
+
+  def onImportTimeout(self):
     """
-    Use logic.importFiles, populateTopologyDict and populate tables.
+    Import the next batch of subjects and append them to the tables.
     """
-    if not self.logic.importFiles(filePaths):
-      logging.warning("logic.importFiles issues, see raised errors.")
+    if self.importGenerator is None:
+      self.importTimer.stop()
+      return
+    try:
+      numberOfProcessedFiles, names = next(self.importGenerator)
+    except StopIteration:
+      self.stopImport()
+      return
+    except Exception as e:
+      logging.error("Import stopped: {}".format(e))
+      self.stopImport()
       return
-
-    # Populate the topology table
-    self.logic.populateTopologyDictionary()
-    self.logic.populateInconsistentTopologyDict()
-
-    ######### Init Tables ##########
-    self.initSubjectsTable()
-    self.initSegmentsTable()
 
     ######### Populate Tables ##########
-    self.populateSubjectsTable()
+    isFirstBatch = len(self.subjectsTableModel.names) == 0
+    self.logic.updateInconsistentTopologyDict(names)
+    self.appendSubjectsToTable(names)
+    if isFirstBatch and self.subjectsTableModel.rowCount() > 0:
+      self.SubjectsTableView.selectRow(0)
+      self.onSubjectsTableViewClicked()
+
+    elapsedTime = time.time() - self.importStartTime
+    throughput = numberOfProcessedFiles / elapsedTime if elapsedTime > 0 else 0.0
+    remainingTime = (self.numberOfFilesToImport - numberOfProcessedFiles) / throughput if throughput > 0 else 0.0
+    self.updateMemoryUsageLabel()
+    self.ui.ImportProgressBar.setValue(numberOfProcessedFiles)
+    self.ui.ImportProgressBar.setFormat('%v/%m subjects - {:.2f} subjects/s - {:d}s remaining'.format(throughput, int(round(remainingTime))))
+
+  def onClickCancelImportButton(self):
+    """
+    Stop the import, subjects already imported are kept.
+    """
+    if self.importGenerator is not None:
+      logging.info("import cancelled")
+    self.stopImport()
 
-    self.SubjectsTableWidget.setCurrentCell(0, 0)
-    self.onSubjectsTableWidgetCellClicked(0, 0)
+  def stopImport(self):
+    """
+    Stop the streaming import if any, and restore the import controls.
+    """
+    self.importTimer.stop()
+    if self.importGenerator is not None:
+      self.importGenerator.close()
+      self.importGenerator = None
+      for path, error in self.logic.importErrors.items():
+        logging.warning("File {} has not been imported: {}".format(path, error))
+      self.updateMetricOutliers()
+    if self.importIsUpdate:
+      self.importIsUpdate = False
+      if self.logic.topologyDict:
+        self.updateSubjectsTableConsistencyColumn()
+    self.ui.ImportProgressBar.visible = False
+    self.ui.CancelImportButton.visible = False
+    self.ui.ImportButton.enabled = True
+    self.ui.UpdateImportButton.enabled = True
 
   #freesurfer tab functions
   def resetFreeSurferSubjectsTable(self):
@@ -1322,12 +4312,15 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.resetFreeSurferSubjectsTable()
     self.freesurferSubjectImport = 0
     self.freesurferSubjectName = 1
+    self.freesurferSubjectMissingLabels = 2
     freesurferSubjectImportLabel = 'Import'
     freesurferSubjectLabel = 'Subject'
-    self.InputFreeSurferSubjectsTable.setColumnCount(2)
+    freesurferSubjectMissingLabelsLabel = 'Missing Labels'
+    self.InputFreeSurferSubjectsTable.setColumnCount(3)
     self.InputFreeSurferSubjectsTable.setHorizontalHeaderLabels([
       freesurferSubjectImportLabel,
-      freesurferSubjectLabel
+      freesurferSubjectLabel,
+      freesurferSubjectMissingLabelsLabel
     ])
     self.InputFreeSurferSubjectsTable.verticalHeader().setVisible(False)
     self.InputFreeSurferSubjectsTable.setSortingEnabled(True)
@@ -1337,6 +4330,7 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     header = self.InputFreeSurferSubjectsTable.horizontalHeader()
     header.setSectionResizeMode(self.freesurferSubjectImport, qt.QHeaderView.ResizeToContents)
     header.setSectionResizeMode(self.freesurferSubjectName, qt.QHeaderView.Stretch)
+    header.setSectionResizeMode(self.freesurferSubjectMissingLabels, qt.QHeaderView.ResizeToContents)
 
   def addRowToFreeSurferSubjectsTable(self, subject_name, path):
     #create checkbox with a centered layout
@@ -1354,7 +4348,21 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     rowPosition = self.InputFreeSurferSubjectsTable.rowCount
     self.InputFreeSurferSubjectsTable.insertRow(rowPosition)
     self.InputFreeSurferSubjectsTable.setCellWidget(rowPosition , self.freesurferSubjectImport, container)
-    self.InputFreeSurferSubjectsTable.setItem(rowPosition , self.freesurferSubjectName, qt.QTableWidgetItem(subject_name))
+    nameItem = qt.QTableWidgetItem(subject_name)
+    nameItem.setData(qt.Qt.UserRole, path)
+    self.InputFreeSurferSubjectsTable.setItem(rowPosition , self.freesurferSubjectName, nameItem)
+    self.InputFreeSurferSubjectsTable.setItem(rowPosition , self.freesurferSubjectMissingLabels, qt.QTableWidgetItem(''))
+
+  def addRowsToFreeSurferSubjectsTable(self, subjects):
+    """
+    Add a row for each (subject_name, path) of subjects, with sorting and repainting disabled until all are added.
+    """
+    self.InputFreeSurferSubjectsTable.setSortingEnabled(False)
+    self.InputFreeSurferSubjectsTable.setUpdatesEnabled(False)
+    for subject_name, path in subjects:
+      self.addRowToFreeSurferSubjectsTable(subject_name, path)
+    self.InputFreeSurferSubjectsTable.setUpdatesEnabled(True)
+    self.InputFreeSurferSubjectsTable.setSortingEnabled(True)
 
   def resetFreeSurferSegmentsTable(self):
     if self.InputFreeSurferSegmentsTable is not None:
@@ -1364,12 +4372,15 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.resetFreeSurferSegmentsTable()
     self.freesurferSegmentsImport = 0
     self.freesurferSegmentsName = 1
+    self.freesurferSegmentsSubjects = 2
     freesurferSegmentsImportLabel = 'Import'
     freesurferSegmentsLabel = 'Segment'
-    self.InputFreeSurferSegmentsTable.setColumnCount(2)
+    freesurferSegmentsSubjectsLabel = 'Subjects'
+    self.InputFreeSurferSegmentsTable.setColumnCount(3)
     self.InputFreeSurferSegmentsTable.setHorizontalHeaderLabels([
       freesurferSegmentsImportLabel,
-      freesurferSegmentsLabel
+      freesurferSegmentsLabel,
+      freesurferSegmentsSubjectsLabel
     ])
     self.InputFreeSurferSegmentsTable.verticalHeader().setVisible(False)
     self.InputFreeSurferSegmentsTable.setSortingEnabled(True)
@@ -1378,8 +4389,9 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     header = self.InputFreeSurferSegmentsTable.horizontalHeader()
     header.setSectionResizeMode(self.freesurferSubjectImport, qt.QHeaderView.ResizeToContents)
     header.setSectionResizeMode(self.freesurferSubjectName, qt.QHeaderView.Stretch)
+    header.setSectionResizeMode(self.freesurferSegmentsSubjects, qt.QHeaderView.ResizeToContents)
 
-  def addRowToFreeSurferSegmentsTable(self, segment_name, label_id):
+  def addRowToFreeSurferSegmentsTable(self, segment_name, label_id, subjects_text=''):
     #create checkbox with a centered layout
     check_box = qt.QCheckBox()
     check_box.setChecked(False)
@@ -1395,7 +4407,50 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     rowPosition = self.InputFreeSurferSegmentsTable.rowCount
     self.InputFreeSurferSegmentsTable.insertRow(rowPosition)
     self.InputFreeSurferSegmentsTable.setCellWidget(rowPosition , self.freesurferSegmentsImport, container)
-    self.InputFreeSurferSegmentsTable.setItem(rowPosition , self.freesurferSegmentsName, qt.QTableWidgetItem(segment_name))
+    nameItem = qt.QTableWidgetItem(segment_name)
+    nameItem.setData(qt.Qt.UserRole, label_id)
+    self.InputFreeSurferSegmentsTable.setItem(rowPosition , self.freesurferSegmentsName, nameItem)
+    self.InputFreeSurferSegmentsTable.setItem(rowPosition , self.freesurferSegmentsSubjects, qt.QTableWidgetItem(subjects_text))
+
+  def updateFreeSurferSegmentsTableFromCensus(self):
+    """
+    Add a row for each label of the label census missing in the segments table, and update the number of subjects
+    having each label.
+    """
+    rows = {}
+    for i_row in range(self.InputFreeSurferSegmentsTable.rowCount):
+      rows[self.InputFreeSurferSegmentsTable.item(i_row, self.freesurferSegmentsName).data(qt.Qt.UserRole)] = i_row
+    subject_number = len(self.freesurferLabelCensus['filePaths'])
+    subject_counts = dict(zip(self.freesurferLabelCensus['labelIds'], self.freesurferLabelCensus['presence'].sum(axis=0)))
+    self.InputFreeSurferSegmentsTable.setSortingEnabled(False)
+    for label_id, i_row in rows.items():
+      self.InputFreeSurferSegmentsTable.item(i_row, self.freesurferSegmentsSubjects).setText(
+        '{}/{}'.format(subject_counts.get(label_id, 0), subject_number))
+    for label_id in self.freesurferLabelCensus['labelIds']:
+      if label_id in rows:
+        continue
+      if label_id not in self.logic.freesurfer_lut_dict:
+        logging.warning('Label {} is not in FreeSurferColorLUT.txt, it is ignored.'.format(label_id))
+        continue
+      segment_name = self.logic.freesurfer_lut_dict[label_id]['name']
+      self.addRowToFreeSurferSegmentsTable(segment_name, label_id, '{}/{}'.format(subject_counts[label_id], subject_number))
+    self.InputFreeSurferSegmentsTable.setSortingEnabled(True)
+
+  def updateFreeSurferSubjectsMissingLabels(self):
+    """
+    Show in the subjects table the wanted labels each subject is missing according to the label census.
+    """
+    if self.freesurferLabelCensus is None:
+      return
+    labelIds = [segmentId.split('_')[-1] for segmentId in self.logic.freesurfer_wanted_segments]
+    missingFiles = self.logic.getFilesMissingLabels(self.freesurferLabelCensus, labelIds)
+    for i_row in range(self.InputFreeSurferSubjectsTable.rowCount):
+      path = self.InputFreeSurferSubjectsTable.item(i_row, self.freesurferSubjectName).data(qt.Qt.UserRole)
+      missingItem = self.InputFreeSurferSubjectsTable.item(i_row, self.freesurferSubjectMissingLabels)
+      missingLabelIds = missingFiles.get(path, [])
+      missingItem.setText(', '.join(self.logic.freesurfer_lut_dict[labelId]['name'] if labelId in self.logic.freesurfer_lut_dict else labelId
+                                    for labelId in missingLabelIds))
+      missingItem.setBackground(qt.QBrush(qt.QColor(255, 204, 203) if missingLabelIds else qt.QColor(0, 0, 0, 0)))
 
   def uncheckFreeSurferTables(self):
     # uncheck subjects
@@ -1417,6 +4472,7 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def resetFreeSurferTab(self):
     self.logic.freesurfer_wanted_segments = []
     self.uncheckFreeSurferTables()
+    self.updateFreeSurferSubjectsMissingLabels()
 
   def resetCSVTab(self):
     # reset CSV tab
@@ -1453,9 +4509,20 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       logging.error("No Shape Analysis folder specified")
       return
 
+    summary = self.logic.generateShapeAnlaysisStructure(self.inputShapeAnalysisPath, dryRun=True)
+    logging.info('Shape analysis structure: {files} files of {subjects} subjects to write, '
+                 '{skippedFiles} files of {skippedSubjects} subjects up to date.'.format(**summary))
+    if summary['subjects'] == 0:
+      logging.info('The shape analysis folder located at {} is up to date'.format(self.inputShapeAnalysisPath))
+      return
+    if not slicer.util.confirmOkCancelDisplay('{files} files of {subjects} subjects will be written, '
+                                              '{skippedFiles} files are up to date.'.format(**summary),
+                                              windowTitle='Shape Analysis Structure'):
+      return
+
     self.logic.generateShapeAnlaysisStructure(self.inputShapeAnalysisPath)
 
-    print('the shape analysis folder located at %s is ready' % self.inputShapeAnalysisPath)
+    logging.info('The shape analysis folder located at {} is ready'.format(self.inputShapeAnalysisPath))
 
   def onCurrentTabChanged(self, index):
     """Resize tabs to fit minimal space
@@ -1543,6 +4610,12 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.freesurfer_subjects_path = freesurfer_subjects_path
     self.InputFreeSurferSubjectsFolderNameLineEdit.text = freesurfer_subjects_path
 
+    # Only the subjects that changed since the index was saved are checked
+    self.freesurferSubjectsIndex = self.logic.loadFreeSurferSubjectsIndex(freesurfer_subjects_path)
+    self.logic.updateFreeSurferSubjectsIndex(self.freesurferSubjectsIndex, list(self.freesurferFilesOfInterest.values()))
+    self.logic.saveFreeSurferSubjectsIndex(self.freesurferSubjectsIndex)
+    self.updateFreeSurferSubjectsWatcher()
+
     # init subject list and segments list
     current_file = self.InputFreeSurferFileSelection.currentText
     if current_file != '':
@@ -1555,27 +4628,83 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.initFreeSurferSegmentsTable()
     if file_name == "":
       return
-    try:
-      subjects_path = self.freesurfer_subjects_path
-      file_path = self.freesurferFilesOfInterest[file_name]
-    except:
+    if self.freesurferSubjectsIndex is None or file_name not in self.freesurferFilesOfInterest:
       return
-    for subject_name in os.listdir(subjects_path):
-      subject_path = os.path.join(subjects_path, subject_name)
-
-      if os.path.isdir(subject_path):
-        abs_path = os.path.join(subject_path, file_path)
-        if os.path.isfile(abs_path):
-          template_path = abs_path
-          self.addRowToFreeSurferSubjectsTable(subject_name, abs_path)
+    subjects = self.logic.filePathsFromFreeSurferSubjectsIndex(self.freesurferSubjectsIndex, self.freesurferFilesOfInterest[file_name])
+    self.addRowsToFreeSurferSubjectsTable(subjects)
 
-    label_ids = self.logic.getFreeSurferAvailableSegmentIds(template_path)
+    # labels of every subject, cached in the result store of SUBJECTS_DIR if enabled
+    self.updateResultStore()
+    self.freesurferLabelCensus = self.logic.computeFreeSurferLabelCensus([path for subject_name, path in subjects])
     self.logic.freesurfer_wanted_segments = []
 
     # populate segments selection table
-    for label_id in label_ids:
-      segment_name = self.logic.freesurfer_lut_dict[label_id]['name']
-      self.addRowToFreeSurferSegmentsTable(segment_name, label_id)
+    self.updateFreeSurferSegmentsTableFromCensus()
+
+  def updateFreeSurferSubjectsWatcher(self):
+    """
+    Watch the subjects directory if WatchFreeSurferSubjectsCheckBox is checked, see refreshFreeSurferSubjects.
+    """
+    watchedDirectories = self.freesurferSubjectsWatcher.directories()
+    if watchedDirectories:
+      self.freesurferSubjectsWatcher.removePaths(watchedDirectories)
+    if self.WatchFreeSurferSubjectsCheckBox.isChecked() and self.freesurferSubjectsIndex is not None:
+      self.freesurferSubjectsWatcher.addPath(self.freesurferSubjectsIndex['subjectsPath'])
+      self.freesurferPollTimer.start()
+    else:
+      self.freesurferRefreshTimer.stop()
+      self.freesurferPollTimer.stop()
+
+  def onFreeSurferSubjectsDirectoryModified(self, path):
+    # recon-all creates many files, wait for changes to settle
+    self.freesurferRefreshTimer.start()
+
+  def refreshFreeSurferSubjects(self):
+    """
+    Update the subjects index and the FreeSurfer tables with the subjects added, removed or changed,
+    keeping the selection of the other ones.
+    """
+    if self.freesurferSubjectsIndex is None:
+      return
+    try:
+      changedSubjectNames = self.logic.updateFreeSurferSubjectsIndex(self.freesurferSubjectsIndex,
+                                                                     list(self.freesurferFilesOfInterest.values()))
+    except OSError as e:
+      logging.warning('Unable to scan {}: {}'.format(self.freesurferSubjectsIndex['subjectsPath'], e))
+      return
+    if not changedSubjectNames:
+      return
+    self.logic.saveFreeSurferSubjectsIndex(self.freesurferSubjectsIndex)
+    file_name = self.InputFreeSurferFileSelection.currentText
+    if file_name not in self.freesurferFilesOfInterest:
+      return
+    subjects = self.logic.filePathsFromFreeSurferSubjectsIndex(self.freesurferSubjectsIndex, self.freesurferFilesOfInterest[file_name])
+    subjectPaths = set(path for subject_name, path in subjects)
+
+    tablePaths = set()
+    removedSubjectNumber = 0
+    for i_row in reversed(range(self.InputFreeSurferSubjectsTable.rowCount)):
+      path = self.InputFreeSurferSubjectsTable.item(i_row, self.freesurferSubjectName).data(qt.Qt.UserRole)
+      if path in subjectPaths:
+        tablePaths.add(path)
+        continue
+      if path in self.filteredFilePathsList:
+        self.filteredFilePathsList.remove(path)
+      self.InputFreeSurferSubjectsTable.removeRow(i_row)
+      removedSubjectNumber += 1
+    newSubjects = [(subject_name, path) for subject_name, path in subjects if path not in tablePaths]
+    self.addRowsToFreeSurferSubjectsTable(newSubjects)
+    if self.FreeSurferImportAllSubjectsOption.isChecked():
+      self.onStateChangedFreeSurferImportAllSubjectsOption_is_running = True
+      for i_row in range(self.InputFreeSurferSubjectsTable.rowCount):
+        rowItem = self.InputFreeSurferSubjectsTable.cellWidget(i_row, 0).children()[1]
+        rowItem.setChecked(True)
+      self.onStateChangedFreeSurferImportAllSubjectsOption_is_running = False
+
+    self.freesurferLabelCensus = self.logic.computeFreeSurferLabelCensus([path for subject_name, path in subjects])
+    self.updateFreeSurferSegmentsTableFromCensus()
+    self.updateFreeSurferSubjectsMissingLabels()
+    logging.info('FreeSurfer subjects: {} added, {} removed.'.format(len(newSubjects), removedSubjectNumber))
 
   def onToggleFreeSurferSubjectSelection(self, path):
     if not self.onStateChangedFreeSurferImportAllSubjectsOption_is_running:
@@ -1611,6 +4740,9 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     else:
       self.logic.freesurfer_wanted_segments.append(label_id)
 
+    if not self.onStateChangedFreeSurferImportAllSegmentsOption_is_running:
+      self.updateFreeSurferSubjectsMissingLabels()
+
   def onStateChangedFreeSurferImportAllSegmentsOption(self):
     self.onStateChangedFreeSurferImportAllSegmentsOption_is_running = True
     segment_number = self.InputFreeSurferSegmentsTable.rowCount
@@ -1619,6 +4751,7 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       rowItem = self.InputFreeSurferSegmentsTable.cellWidget(i_row, 0).children()[1]
       rowItem.setChecked(self.FreeSurferImportAllSegmentsOption.isChecked())
     self.onStateChangedFreeSurferImportAllSegmentsOption_is_running = False
+    self.updateFreeSurferSubjectsMissingLabels()
 
   #events to detect new or deleted color table
   def registerCallbacks(self):
@@ -1702,21 +4835,69 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         logging.info("import aborted")
         return
 
-    self.importFiles(self.filteredFilePathsList)
+    self.updateResultStore()
+    # FreeSurfer subjects missing wanted labels are reported instead of failing during import
+    filePaths = self.logic.excludeFilesMissingWantedLabels(self.filteredFilePathsList)
+    if not filePaths:
+      logging.warning('None of the selected subjects has all the selected segments.')
+      return
+    self.importFiles(filePaths)
+
+  def onClickUpdateImportButton(self):
+    """
+    Only import the files added or changed since the previous import, and remove the subjects whose file
+    is not selected anymore. See DataImporterLogic.updateImportedFiles.
+    """
+    if not self.logic.segmentationDict:
+      self.onClickImportButton()
+      return
+    if not self.filteredFilePathsList:
+      logging.warning('List of files is empty, choose a folder or a csv file to import first.')
+      return
+
+    self.stopImport()
+    self.updateResultStore()
+    filePaths = self.logic.excludeFilesMissingWantedLabels(self.filteredFilePathsList)
+    removedNodeNames, filePathsToImport = self.logic.updateImportedFiles(filePaths)
+    self.removeSubjectsFromTable(removedNodeNames)
+    self.updateMetricOutliers()
+    logging.info('Update import: {} subjects removed or changed, {} files to import.'.format(
+      len(removedNodeNames), len(filePathsToImport)))
+    self.importFiles(filePathsToImport, update=True)
+
+  def getCohortDirectory(self):
+    """
+    Return the directory of the cohort selected in the current import tab, '' if none.
+    """
+    tab_text = self.ImporterTypeTabWidget.tabText(self.ImporterTypeTabWidget.currentIndex)
+    if tab_text == 'Import from directory':
+      return self.inputPath
+    elif tab_text == 'Import from CSV':
+      return os.path.dirname(self.InputCSVFileNameLineEdit.text)
+    elif tab_text == 'Import from FreeSurfer':
+      return getattr(self, 'freesurfer_subjects_path', '')
+    return ''
+
+  def updateResultStore(self):
+    """
+    Open the result store of the cohort if CacheResultsCheckBox is checked, close it otherwise.
+    """
+    cohortDirectory = self.getCohortDirectory()
+    if not self.ui.CacheResultsCheckBox.isChecked() or not cohortDirectory:
+      self.logic.setResultStorePath('')
+      return
+    storePath = os.path.join(cohortDirectory, DataImporterResultStore.DEFAULT_FILE_NAME)
+    try:
+      self.logic.setResultStorePath(storePath)
+    except sqlite3.Error as e:
+      logging.warning('Unable to open result store {}, results will not be cached: {}'.format(storePath, e))
+      self.logic.setResultStorePath('')
 
   def filterFilePaths(self, filePathsList):
     """
     Return filtered filePaths of files that are readable by this module.
     """
-    filteredFilePathsList = list()
-    for filePath in filePathsList:
-      fileType = slicer.app.ioManager().fileType(filePath)
-      if fileType == 'VolumeFile' or fileType == 'SegmentationFile' or fileType == 'ModelFile':
-        filteredFilePathsList.append(filePath)
-      # else:
-      #   logging.debug("File: {} with fileType {} is not readable by this module.".format(filePath, fileType))
-
-    return filteredFilePathsList
+    return self.logic.filterFilePaths(filePathsList)
 
   def onClickCSVBrowseFilePushButton(self):
     csvFileName = qt.QFileDialog.getOpenFileName(self.widget, "Open CSV File", ".", "CSV Files (*.csv)")
@@ -1739,19 +4920,22 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.inputPath = directoryPath
 
-    fileNameList = directory.entryList(qt.QDir.Files | qt.QDir.Readable)
-    # Trim fileList to only accept types recognized by slicer
-    filePathsList = list()
-    for name in fileNameList:
-      filePathsList.append(os.path.join(directoryPath, name))
+    # Only accept types recognized by slicer
+    self.filteredFilePathsList = self.logic.filePathsFromDirectory(
+      directoryPath, recursive=self.ui.RecursiveDirectoryCheckBox.isChecked(),
+      includePatterns=self.ui.IncludePatternsLineEdit.text.replace(',', ' ').split(),
+      excludePatterns=self.ui.ExcludePatternsLineEdit.text.replace(',', ' ').split())
+    logging.info('{} files to import in {}'.format(len(self.filteredFilePathsList), directoryPath))
 
-    self.filteredFilePathsList = self.filterFilePaths(filePathsList)
+  def onDirectoryFilterChanged(self):
+    if self.inputPath:
+      self.onDirectoryChanged(self.inputPath)
 
-  def onSubjectsTableWidgetCellClicked(self, row, column):
+  def onSubjectsTableViewClicked(self, index=None):
     """
     On click in Subjects table populates segment table, and optionally display indexes.
     """
-    if self.SubjectsTableWidget.rowCount == 0:
+    if self.subjectsTableModel.rowCount() == 0:
       return
 
     self.populateSegmentsTableWithCurrentSubjectsSelection()
@@ -1759,32 +4943,65 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     if self.displayOnClick:
       self.displaySelectedIndexes()
 
-  def onSegmentsTableWidgetCellClicked(self, row, column):
+  def onSegmentsTableViewClicked(self, index=None):
     """
-    On click in Subjects, optionally display indexes.
+    On click in Segments table, optionally display indexes.
     """
-    if self.SegmentsTableWidget.rowCount == 0:
+    if self.segmentsTableModel.rowCount() == 0:
       return
 
     if self.displayOnClick:
       self.displaySelectedIndexes()
 
-  def onSegmentTableWidgetComboBoxCurrentIndexChanged(self, index, name):
+  def onExpectedTopologyChanged(self, name, newTopology):
     # Change self.logic.expectTopologiesBySegment
-    newTopology = self.logic.indexToTopologyType[index]
-    logging.debug("SegmentTableWidgetComboBox changed. index: {}, name: {}, newTopology: {}.".format(index, name, newTopology))
-    self.logic.expectedTopologiesBySegment[name] = newTopology
-    # Update Consistency column in SubjectsTable
-    self.updateSubjectsTableConsistencyColumn()
+    logging.debug("Expected topology changed. name: {}, newTopology: {}.".format(name, newTopology))
+    self.logic.setExpectedTopology(name, newTopology)
+    # Update Consistency column in SubjectsTable and the other rows of the segment
+    self.updateConsistencyOfSegments([name])
 
   def onSaveCleanDataCheckBoxToggled(self):
     self.logic.setSaveCleanData(self.ui.SaveCleanDataCheckBox.isChecked())
 
+  def onMemoryBudgetChanged(self):
+    self.logic.setMemoryBudget(self.ui.MemoryBudgetSpinBox.value)
+    self.updateMemoryUsageLabel()
+
+  def updateMemoryUsageLabel(self):
+    residentSize = self.logic.getResidentMemorySize() / (1024. * 1024.)
+    if self.logic.memoryBudget > 0:
+      text = 'In memory: {:.0f} / {:.0f} MB'.format(residentSize, self.logic.memoryBudget / (1024. * 1024.))
+    else:
+      text = 'In memory: {:.0f} MB'.format(residentSize)
+    self.ui.MemoryUsageLabel.setText(text)
+
+  def onLazyClosedSurfacesCheckBoxToggled(self):
+    self.logic.setLazyClosedSurfaces(self.ui.LazyClosedSurfacesCheckBox.isChecked())
+
+  def onCompactPolyDataCheckBoxToggled(self):
+    self.logic.setCompactPolyData(self.ui.CompactPolyDataCheckBox.isChecked())
+
+  def onNumberOfWorkersChanged(self):
+    self.logic.setNumberOfWorkers(self.ui.NumberOfWorkersSpinBox.value)
+
+  def onTopologyBackendSelectionChanged(self, index):
+    text, backend, connectivity = self.topologyBackends[index]
+    self.logic.setTopologyBackend(backend, connectivity)
+
+  def onModelFormatSelectionChanged(self, index):
+    self.logic.setModelFormat(self.modelFormats[index][1])
+
   def onDisplayOnClickCheckBoxToggled(self):
     self.displayOnClick = self.ui.DisplayOnClickCheckBox.isChecked()
 
   def onClickDisplaySelectedPushButton(self):
-    self.displaySelectedIndexes()
+    self.displaySelectedIndexes(center=True)
+
+  def onPreviewCheckBoxToggled(self):
+    checked = self.ui.PreviewCheckBox.isChecked()
+    self.logic.setCreatePreviews(checked)
+    if not checked and self.displayedPreviewSegmentNames:
+      self.showFullResolution()
 
   '''
   Supplemental functions to update the visualizations
@@ -1797,7 +5014,8 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def setVisibilitySegmentations(self, visibility):
     """ visiblity boolean """
-    nodes = [node for node in self.logic.segmentationDict.values()]
+    # Subjects spilled to disk by the memory budget are not reloaded
+    nodes = [node for name, node in self.logic.segmentationDict.residentItems()]
     for node in nodes:
       displayNode = node.GetDisplayNode()
       displayNode.SetVisibility(visibility)
@@ -1806,63 +5024,136 @@ class DataImporterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def hideAllSegmentations(self):
 
     self.setVisibilitySegmentations(False)
+    self.displayedSegmentIds = {}
+    self.fullResolutionTimer.stop()
+    self.updateDisplayedPreviews(OrderedDict())
 
-  def displaySelectedIndexes(self):
-    self.SubjectsTableWidget.setSortingEnabled(False)
-    self.SegmentsTableWidget.setSortingEnabled(False)
-    self.hideAllSegmentations()
-    # Get selection of both tables
-    rowsSubjects = self.getRowsFromSelectedIndexes(self.SubjectsTableWidget)
-    rowsSegments = self.getRowsFromSelectedIndexes(self.SegmentsTableWidget)
-    countSubjects = len(rowsSubjects)
-    countSegments = len(rowsSegments)
-    if not countSubjects and not countSegments:
-      pass
-
-    # Update column indexes (sanity)
-    segmentsColumnCount = self.SegmentsTableWidget.columnCount
-    hasSegmentsColumnSubjectName = True if segmentsColumnCount == 4 else False
-    if hasSegmentsColumnSubjectName:
-      self.segmentsColumnSubjectName = 0
-      self.segmentsColumnSegmentName = 1
-      self.segmentsColumnTopologyCurrent = 2
-      self.segmentsColumnTopologyExpected = 3
+  @staticmethod
+  def updateSegmentsVisibility(displayNode, shownSegmentIds, segmentIds):
+    """
+    Make displayNode show segmentIds, all the segments if None. shownSegmentIds are the segments it shows,
+    None for all of them and False if the node is hidden. Only the differences are applied, in one modification.
+    """
+    wasModifying = displayNode.StartModify()
+    if shownSegmentIds is False:
+      displayNode.SetVisibility(True)
+    if segmentIds is None:
+      if shownSegmentIds is not None:
+        displayNode.SetAllSegmentsVisibility(True)
+    elif shownSegmentIds is None or shownSegmentIds is False:
+      displayNode.SetAllSegmentsVisibility(False)
+      for segmentId in segmentIds:
+        displayNode.SetSegmentVisibility(segmentId, True)
     else:
-      self.segmentsColumnSubjectName = -1
-      self.segmentsColumnSegmentName = 0
-      self.segmentsColumnTopologyCurrent = 1
-      self.segmentsColumnTopologyExpected = 2
-
-    # segmentationNodes = list()
-    # segmentationNodes.append(node)
-    for row in rowsSubjects:
-      subjectName = self.SubjectsTableWidget.item(row, self.subjectsColumnName).text()
-      node = self.logic.segmentationDict[subjectName]
-      segmentationDisplayNode = node.GetDisplayNode()
-      segmentationDisplayNode.SetVisibility(True)
-      if countSegments == 0:
-        segmentationDisplayNode.SetAllSegmentsVisibility(True)
-        self.center3dView()
+      for segmentId in shownSegmentIds - segmentIds:
+        displayNode.SetSegmentVisibility(segmentId, False)
+      for segmentId in segmentIds - shownSegmentIds:
+        displayNode.SetSegmentVisibility(segmentId, True)
+    displayNode.EndModify(wasModifying)
 
-    subjectName = None
+  def displaySelectedIndexes(self, center=False):
+    """
+    Show the subjects selected in SubjectsTableView, with only the segments selected in SegmentsTableView if any.
+    With PreviewCheckBox, their decimated previews are shown first (see logic.getPreviewModelNodes)
+    and replaced by the full resolution surfaces once the selection is idle, see showFullResolution.
+    The 3D view is only centered if center or if nothing was displayed.
+    """
+    # Get selection of both tables
+    subjectNames = self.getSelectedSubjectNames()
+    rowsSegments = self.getRowsFromSelectedIndexes(self.SegmentsTableView)
+    # Segment names to show by subject, None for all the segments
+    segmentNamesToShow = OrderedDict()
+    if not rowsSegments:
+      for subjectName in subjectNames:
+        segmentNamesToShow[subjectName] = None
     for row in rowsSegments:
-      if hasSegmentsColumnSubjectName:
-        subjectName = self.SegmentsTableWidget.item(row, self.segmentsColumnSubjectName).text()
-      else:
-        if countSubjects:
-          subjectName = self.SubjectsTableWidget.item(rowsSubjects[0], self.subjectsColumnName).text()
-        else:
-          continue
+      subjectName, segmentName = self.segmentsTableModel.subjectAndSegmentOfRow(row)
+      segmentNamesToShow.setdefault(subjectName, set()).add(segmentName)
+
+    center = center or not (self.displayedSegmentIds or self.displayedPreviewSegmentNames)
+    self.requestedSegmentNames = segmentNamesToShow
+    if self.ui.PreviewCheckBox.isChecked():
+      self.showSegments(segmentNamesToShow, preview=True)
+      self.fullResolutionTimer.start()
+    else:
+      self.fullResolutionTimer.stop()
+      self.showSegments(segmentNamesToShow)
+    if center and segmentNamesToShow:
+      self.center3dView()
 
-      node = self.logic.segmentationDict[subjectName]
-      segmentName = self.SegmentsTableWidget.item(row, self.segmentsColumnSegmentName).text()
-      segmentId = node.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
-      segmentationDisplayNode = node.GetDisplayNode()
-      segmentationDisplayNode.SetVisibility(True)
-      segmentationDisplayNode.SetSegmentVisibility(segmentId, True)
+  def showFullResolution(self):
+    """
+    Replace the previews shown by displaySelectedIndexes by the full resolution surfaces.
+    """
+    self.fullResolutionTimer.stop()
+    self.showSegments(self.requestedSegmentNames)
 
-    self.SubjectsTableWidget.setSortingEnabled(True)
-    self.SegmentsTableWidget.setSortingEnabled(True)
+  def showSegments(self, segmentNamesToShow, preview=False):
+    """
+    Show segmentNamesToShow {subjectName: segmentNames, None for all of them} and hide the other displayed segments,
+    as previews if preview and at full resolution otherwise. Only the visibility changes are applied, in one render.
+    """
+    # Subjects displayed at full resolution are not spilled to disk by the memory budget
+    self.logic.pinnedNodeNames = set() if preview else set(segmentNamesToShow)
+    slicer.app.pauseRender()
+    try:
+      self.updateDisplayedPreviews(segmentNamesToShow if preview else OrderedDict())
+      self.updateDisplayedSegmentations(OrderedDict() if preview else segmentNamesToShow)
+    finally:
+      slicer.app.resumeRender()
+
+    # Closed surfaces created for the previews are kept to show the full resolution surfaces next
+    displayedSubjectNames = set(self.displayedSegmentIds) | set(self.displayedPreviewSegmentNames)
+    if self.logic.lazyClosedSurfaces:
+      for subjectName in self.displayedSubjectNames - displayedSubjectNames:
+        if subjectName in self.logic.segmentationDict:
+          self.logic.releaseClosedSurface(subjectName)
+    self.displayedSubjectNames = displayedSubjectNames
+    self.updateMemoryUsageLabel()
+
+  def updateDisplayedSegmentations(self, segmentNamesToShow):
+    """
+    Show the closed surfaces of segmentNamesToShow (see showSegments) and hide the other displayed subjects.
+    Only the differences with displayedSegmentIds are applied.
+    """
+    displayedSegmentIds = {}
+    for subjectName in set(self.displayedSegmentIds) - set(segmentNamesToShow):
+      # Hidden subjects are not reloaded if they have been spilled to disk
+      node = self.logic.segmentationDict.peek(subjectName) if subjectName in self.logic.segmentationDict else None
+      if node is not None:
+        node.GetDisplayNode().SetVisibility(False)
+
+    for subjectName, segmentNames in segmentNamesToShow.items():
+      node = self.logic.segmentationDict[subjectName]
+      # Closed surfaces are not created on import when topology is computed from voxels or in lazy mode
+      self.logic.createClosedSurface(subjectName)
+      segmentIds = None
+      if segmentNames is not None:
+        segmentIds = set(node.GetSegmentation().GetSegmentIdBySegmentName(segmentName) for segmentName in segmentNames)
+      self.updateSegmentsVisibility(node.GetDisplayNode(), self.displayedSegmentIds.get(subjectName, False), segmentIds)
+      displayedSegmentIds[subjectName] = segmentIds
+    self.displayedSegmentIds = displayedSegmentIds
+
+  def updateDisplayedPreviews(self, segmentNamesToShow):
+    """
+    Show the previews of segmentNamesToShow (see showSegments) and hide the other displayed previews.
+    Only the differences with displayedPreviewSegmentNames are applied.
+    """
+    displayedPreviewSegmentNames = {}
+    for subjectName in set(self.displayedPreviewSegmentNames) | set(segmentNamesToShow):
+      # Previews are created once for all the segments of the subject
+      modelNodes = (self.logic.getPreviewModelNodes(subjectName) if subjectName in segmentNamesToShow
+                    else self.logic.previewModelNodes.get(subjectName, {}))
+      segmentNames = segmentNamesToShow.get(subjectName, set())
+      segmentNames = set(modelNodes) if segmentNames is None else set(modelNodes).intersection(segmentNames)
+      shownSegmentNames = self.displayedPreviewSegmentNames.get(subjectName, set())
+      for segmentName in shownSegmentNames - segmentNames:
+        modelNodes[segmentName].GetDisplayNode().SetVisibility(False)
+      for segmentName in segmentNames - shownSegmentNames:
+        modelNodes[segmentName].GetDisplayNode().SetVisibility(True)
+      if segmentNames:
+        displayedPreviewSegmentNames[subjectName] = segmentNames
+    self.displayedPreviewSegmentNames = displayedPreviewSegmentNames
 
 # DataImporterLogic
 #
@@ -1941,15 +5232,41 @@ class DataImporterTest(ScriptedLoadableModuleTest):
     for fileName in self.casesModel:
       self.test_importModelFromFile(fileName)
 
+    ##### Directory #####
+    self.test_filePathsFromDirectory()
+
     ##### CSV #####
     self.test_filenamesFromCSVFile()
+    self.test_main()
+    self.test_mergeShardReports()
 
     ##### All #####
     self.test_importFiles()
+    self.test_importFilesInParallel()
+    self.test_importFilesIncrementally()
+    self.test_updateImportedFiles()
+    self.test_lazyClosedSurfaces()
+    self.test_compactPolyData()
+    self.test_updateSegmentsVisibility()
+    self.test_previewModelNodes()
+    self.test_memoryBudget()
+    self.test_generateShapeAnalysisStructure()
+    self.test_resultStore()
 
     ##########
     self.test_populateDictSegmentNamesWithIntegers()
     self.test_computeMode()
+    self.test_topologyMatrix()
+    self.test_updateInconsistentTopologyDictForSegments()
+    self.test_topologyTableModels()
+    self.test_computeSurfaceTopology()
+    self.test_metricOutliers()
+    self.test_computeVoxelTopology()
+
+    ##### FreeSurfer #####
+    self.test_freesurferLabelCensus()
+    self.test_keepFreeSurferWantedLabels()
+    self.test_freesurferSubjectsIndex()
 
     self.delayDisplay('All tests passed!')
 
@@ -2101,6 +5418,426 @@ class DataImporterTest(ScriptedLoadableModuleTest):
 
     logging.info('-- test_importFiles passed! --')
 
+  def test_importFilesInParallel(self):
+    """
+    Test that a parallel import gives the same topologies, in the same order, than a serial import.
+    """
+    logging.info('-- Starting test_importFilesInParallel --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    serialLogic = DataImporterLogic()
+    serialLogic.importFiles(filePaths)
+    serialLogic.populateTopologyDictionary()
+
+    parallelLogic = DataImporterLogic()
+    parallelLogic.setNumberOfWorkers(2)
+    parallelLogic.importFiles(filePaths)
+    # The topologies were computed by the workers
+    self.assertEqual(set(parallelLogic.topologyDict.keys()), set(serialLogic.segmentationDict.keys()))
+    parallelLogic.populateTopologyDictionary()
+
+    self.assertEqual(parallelLogic.importErrors, dict())
+    self.assertEqual(list(parallelLogic.segmentationDict.keys()), list(serialLogic.segmentationDict.keys()))
+    self.assertEqual(parallelLogic.topologyDict, serialLogic.topologyDict)
+    for name in parallelLogic.polyDataDict:
+      self.assertEqual(set(parallelLogic.polyDataDict[name].keys()), set(serialLogic.polyDataDict[name].keys()))
+
+    # Workers read the files like slicer.util.loadLabelVolume
+    for name, labelMapNode in serialLogic.labelMapDict.items():
+      voxels, ijkToRAS = DataImporterLogic.readLabelMapVolume(serialLogic.sourcePathDict[name])
+      np.testing.assert_array_equal(voxels, slicer.util.arrayFromVolume(labelMapNode))
+      matrix = vtk.vtkMatrix4x4()
+      labelMapNode.GetIJKToRASMatrix(matrix)
+      np.testing.assert_allclose(ijkToRAS, [[matrix.GetElement(row, column) for column in range(4)] for row in range(4)],
+                                 atol=1e-6)
+
+    # A first file failing in a worker is not imported and does not set the label range of the cohort
+    badPath = os.path.join(self.testDir, 'bad.nrrd')
+    with open(badPath, 'wb') as f:
+      f.write(b'NRRD0004\ntype: short\ndimension: 3\nsizes: 64 64 64\nencoding: raw\n\ntruncated')
+    failingLogic = DataImporterLogic()
+    failingLogic.setNumberOfWorkers(2)
+    failingLogic.importFiles([badPath] + filePaths)
+    self.assertEqual(list(failingLogic.importErrors), [badPath])
+    self.assertEqual(list(failingLogic.segmentationDict.keys()), list(serialLogic.segmentationDict.keys()))
+    self.assertEqual(failingLogic.labelRangeInCohort, serialLogic.labelRangeInCohort)
+    os.remove(badPath)
+    failingLogic.cleanup()
+
+    logging.info('-- test_importFilesInParallel passed! --')
+
+  def test_importFilesIncrementally(self):
+    """
+    Test that a streamed import, with incremental consistency, matches importFiles and populateInconsistentTopologyDict.
+    """
+    logging.info('-- Starting test_importFilesIncrementally --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    logic = DataImporterLogic()
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+    logic.TemplateName = next(iter(logic.topologyDict))
+    logic.populateInconsistentTopologyDict()
+
+    incrementalLogic = DataImporterLogic()
+    numberOfProcessedFiles = 0
+    for numberOfProcessedFiles, names in incrementalLogic.importFilesIncrementally(filePaths):
+      self.assertTrue(all(name in incrementalLogic.topologyDict for name in names))
+      incrementalLogic.updateInconsistentTopologyDict(names)
+    self.assertEqual(numberOfProcessedFiles, len(filePaths))
+    self.assertEqual(incrementalLogic.topologyDict, logic.topologyDict)
+    self.assertEqual(incrementalLogic.expectedTopologiesBySegment, logic.expectedTopologiesBySegment)
+    self.assertEqual(incrementalLogic.inconsistentTopologyDict, logic.inconsistentTopologyDict)
+
+    # Closing the generator keeps the subjects already imported
+    cancelledLogic = DataImporterLogic()
+    importGenerator = cancelledLogic.importFilesIncrementally(filePaths)
+    numberOfProcessedFiles, names = next(importGenerator)
+    importGenerator.close()
+    self.assertEqual(list(cancelledLogic.topologyDict.keys()), names)
+
+    logging.info('-- test_importFilesIncrementally passed! --')
+
+  def test_updateImportedFiles(self):
+    """
+    Test that an update of the import only imports new and changed files, and removes the other subjects.
+    """
+    logging.info('-- Starting test_updateImportedFiles --')
+    updateDir = os.path.join(self.testDir, 'Update')
+    if os.path.isdir(updateDir):
+      shutil.rmtree(updateDir)
+    os.mkdir(updateDir)
+    filePaths = [os.path.join(updateDir, fileName) for fileName in ['a.nrrd', 'b.nrrd']]
+    for fileName, filePath in zip(self.casesLabelMap, filePaths):
+      shutil.copy(os.path.join(self.testDir, fileName), filePath)
+
+    logic = DataImporterLogic()
+    logic.setResultStorePath(os.path.join(updateDir, DataImporterResultStore.DEFAULT_FILE_NAME))
+    logic.importFiles(filePaths[:1])
+    logic.populateTopologyDictionary()
+    self.assertEqual(logic.updateImportedFiles(filePaths), ([], filePaths[1:]))
+    logic.importFiles(filePaths[1:])
+    logic.populateTopologyDictionary()
+    self.assertEqual(logic.updateImportedFiles(filePaths), ([], []))
+
+    # A touched file is not imported again, a removed one is removed
+    os.utime(filePaths[0])
+    self.assertEqual(logic.updateImportedFiles(filePaths[:1]), (['b.nrrd'], []))
+    self.assertEqual(list(logic.topologyDict.keys()), ['a.nrrd'])
+
+    # A changed file is imported again
+    shutil.copy(os.path.join(self.testDir, self.casesLabelMap[1]), filePaths[0])
+    self.assertEqual(logic.updateImportedFiles(filePaths[:1]), (['a.nrrd'], filePaths[:1]))
+    self.assertEqual(len(logic.segmentationDict), 0)
+    logic.cleanup()
+
+    # Without result store nor CSV checksum, the files are not hashed on import, a touched file is imported again
+    logic = DataImporterLogic()
+    logic.importFiles(filePaths[:1])
+    self.assertIsNone(logic.sourceSignatures[filePaths[0]]['sha256'])
+    os.utime(filePaths[0], (0, 0))
+    self.assertEqual(logic.updateImportedFiles(filePaths[:1]), (['a.nrrd'], filePaths[:1]))
+    logic.cleanup()
+    logging.info('-- test_updateImportedFiles passed! --')
+
+  def test_lazyClosedSurfaces(self):
+    """
+    Test that lazy closed surfaces give the same topologies and polydata, and are only kept on demand.
+    """
+    logging.info('-- Starting test_lazyClosedSurfaces --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    logic = DataImporterLogic()
+    logic.setSaveCleanData(True)
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+
+    lazyLogic = DataImporterLogic()
+    lazyLogic.setSaveCleanData(True)
+    lazyLogic.setLazyClosedSurfaces(True)
+    lazyLogic.importFiles(filePaths)
+    lazyLogic.populateTopologyDictionary()
+
+    self.assertEqual(lazyLogic.topologyDict, logic.topologyDict)
+    name = self.casesLabelMap[0]
+    self.assertEqual(lazyLogic.polyDataDict[name], dict())
+    self.assertFalse(lazyLogic.hasClosedSurface(name))
+    for segmentName, polydata in logic.polyDataDict[name].items():
+      lazyPolyData = lazyLogic.getPolyData(name, segmentName)
+      self.assertEqual(lazyPolyData.GetNumberOfPoints(), polydata.GetNumberOfPoints())
+      self.assertEqual(lazyPolyData.GetNumberOfPolys(), polydata.GetNumberOfPolys())
+    self.assertTrue(lazyLogic.hasClosedSurface(name))
+    lazyLogic.releaseClosedSurface(name)
+    self.assertFalse(lazyLogic.hasClosedSurface(name))
+
+    logging.info('-- test_lazyClosedSurfaces passed! --')
+
+  def test_compactPolyData(self):
+    """
+    Test that compact clean data gives the same triangles in less memory.
+    """
+    logging.info('-- Starting test_compactPolyData --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    logic = DataImporterLogic()
+    logic.setSaveCleanData(True)
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+
+    compactLogic = DataImporterLogic()
+    compactLogic.setSaveCleanData(True)
+    compactLogic.setCompactPolyData(True)
+    compactLogic.importFiles(filePaths)
+    compactLogic.populateTopologyDictionary()
+
+    self.assertEqual(compactLogic.topologyDict, logic.topologyDict)
+    name = self.casesLabelMap[0]
+    polyDatas = compactLogic.polyDataDict[name]
+    self.assertIsInstance(polyDatas, DataImporterCompactPolyDataDict)
+    self.assertEqual(list(polyDatas), list(logic.polyDataDict[name]))
+    for segmentName, polydata in logic.polyDataDict[name].items():
+      compactPolyData = compactLogic.getPolyData(name, segmentName)
+      self.assertEqual(compactPolyData.GetPoints().GetDataType(), vtk.VTK_FLOAT)
+      self.assertEqual(compactPolyData.GetNumberOfPoints(), polydata.GetNumberOfPoints())
+      self.assertEqual(compactPolyData.GetNumberOfPolys(), polydata.GetNumberOfPolys())
+      points, triangles = DataImporterLogic._polyDataToArrays(compactPolyData)
+      expectedPoints, expectedTriangles = DataImporterLogic._polyDataToArrays(polydata)
+      np.testing.assert_allclose(points, expectedPoints, rtol=1e-6)
+      np.testing.assert_array_equal(triangles, expectedTriangles)
+    self.assertLess(polyDatas.memorySize(),
+                    sum(polydata.GetActualMemorySize() for polydata in logic.polyDataDict[name].values()) * 1024)
+    logic.cleanup()
+    compactLogic.cleanup()
+    logging.info('-- test_compactPolyData passed! --')
+
+  def test_updateSegmentsVisibility(self):
+    """
+    Test that only the visibility differences are applied, in one modification of the display node.
+    """
+    logging.info('-- Starting test_updateSegmentsVisibility --')
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+    segmentationNode.CreateDefaultDisplayNodes()
+    segmentIds = [segmentationNode.GetSegmentation().AddEmptySegment(name) for name in ['a', 'b', 'c']]
+    displayNode = segmentationNode.GetDisplayNode()
+    displayNode.SetVisibility(False)
+    modifiedEvents = []
+    observerTag = displayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, lambda caller, event: modifiedEvents.append(event))
+
+    def visibleSegmentIds():
+      return [segmentId for segmentId in segmentIds if displayNode.GetSegmentVisibility(segmentId)]
+
+    DataImporterWidget.updateSegmentsVisibility(displayNode, False, {segmentIds[0]})
+    self.assertTrue(displayNode.GetVisibility())
+    self.assertEqual(visibleSegmentIds(), segmentIds[:1])
+    self.assertEqual(len(modifiedEvents), 1)
+    DataImporterWidget.updateSegmentsVisibility(displayNode, {segmentIds[0]}, {segmentIds[1]})
+    self.assertEqual(visibleSegmentIds(), segmentIds[1:2])
+    DataImporterWidget.updateSegmentsVisibility(displayNode, {segmentIds[1]}, None)
+    self.assertEqual(visibleSegmentIds(), segmentIds)
+    del modifiedEvents[:]
+    DataImporterWidget.updateSegmentsVisibility(displayNode, None, None)
+    self.assertEqual(modifiedEvents, [])
+
+    displayNode.RemoveObserver(observerTag)
+    slicer.mrmlScene.RemoveNode(segmentationNode)
+    logging.info('-- test_updateSegmentsVisibility passed! --')
+
+  def test_previewModelNodes(self):
+    """
+    Test that previews are decimated once, with the topology if createPreviews, hidden, and removed with their subject.
+    """
+    logging.info('-- Starting test_previewModelNodes --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    # Previews created with the topology, the closed surfaces are released once
+    logic = DataImporterLogic()
+    logic.setLazyClosedSurfaces(True)
+    logic.setCreatePreviews(True)
+    logic.setPreviewNumberOfTriangles(100)
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+    for name in self.casesLabelMap:
+      self.assertIn(name, logic.previewModelNodes)
+      self.assertFalse(logic.hasClosedSurface(name))
+    logic.cleanup()
+
+    # Previews created on demand keep the closed surface, to show the full resolution surfaces next
+    logic = DataImporterLogic()
+    logic.setLazyClosedSurfaces(True)
+    logic.importFiles(filePaths)
+    name = self.casesLabelMap[0]
+    logic.setPreviewNumberOfTriangles(100)
+    modelNodes = logic.getPreviewModelNodes(name)
+    self.assertEqual(len(modelNodes), logic.segmentationDict[name].GetSegmentation().GetNumberOfSegments())
+    self.assertTrue(logic.hasClosedSurface(name))
+    for modelNode in modelNodes.values():
+      self.assertLessEqual(modelNode.GetPolyData().GetNumberOfPolys(), 200)
+      self.assertFalse(modelNode.GetDisplayNode().GetVisibility())
+    self.assertIs(logic.getPreviewModelNodes(name), modelNodes)
+
+    polydata = logic.getPolyData(name, next(iter(modelNodes)))
+    self.assertEqual(DataImporterLogic.decimatePolyData(polydata, polydata.GetNumberOfPolys()).GetNumberOfPolys(),
+                     polydata.GetNumberOfPolys())
+
+    modelNodeIds = [modelNode.GetID() for modelNode in modelNodes.values()]
+    logic.removeImportedNode(name)
+    self.assertNotIn(name, logic.previewModelNodes)
+    for modelNodeId in modelNodeIds:
+      self.assertIsNone(slicer.mrmlScene.GetNodeByID(modelNodeId))
+    logic.cleanup()
+    logging.info('-- test_previewModelNodes passed! --')
+
+  def test_memoryBudget(self):
+    """
+    Test that subjects over the memory budget are spilled to disk and transparently reloaded.
+    """
+    logging.info('-- Starting test_memoryBudget --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+
+    logic = DataImporterLogic()
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+    polyDataSizes = {name: {segmentName: polydata.GetNumberOfPoints() for segmentName, polydata in polyDatas.items()}
+                     for name, polyDatas in logic.polyDataDict.items()}
+    numberOfSegments = {name: node.GetSegmentation().GetNumberOfSegments() for name, node in logic.segmentationDict.items()}
+
+    # A budget of 1 byte keeps only the most recently used subject in memory
+    logic.memoryBudget = 1
+    logic.enforceMemoryBudget()
+    self.assertEqual(list(logic.residentSubjects.keys()), [self.casesLabelMap[-1]])
+    self.assertEqual(set(logic.spilledSubjects.keys()), set(self.casesLabelMap[:-1]))
+
+    name = self.casesLabelMap[0]
+    self.assertIsNone(logic.segmentationDict.peek(name))
+    segmentationNode = logic.segmentationDict[name]
+    self.assertIsNotNone(segmentationNode)
+    self.assertIsNotNone(logic.labelMapDict.peek(name))
+    self.assertEqual(segmentationNode.GetSegmentation().GetNumberOfSegments(), numberOfSegments[name])
+    self.assertEqual({segmentName: polydata.GetNumberOfPoints() for segmentName, polydata in logic.polyDataDict[name].items()},
+                     polyDataSizes[name])
+    self.assertEqual(list(logic.residentSubjects.keys()), [name])
+
+    spillDirectory = logic.spillDirectory
+    logic.cleanup()
+    self.assertFalse(os.path.exists(spillDirectory))
+
+    logging.info('-- test_memoryBudget passed! --')
+
+  def test_generateShapeAnalysisStructure(self):
+    """
+    Test that the shape analysis structure export only rewrites outputs that are missing or out of date.
+    """
+    logging.info('-- Starting test_generateShapeAnalysisStructure --')
+    filePaths = [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]
+    savePath = os.path.join(self.testDir, 'ShapeAnalysisStructure')
+    if os.path.isdir(savePath):
+      shutil.rmtree(savePath)
+    os.mkdir(savePath)
+
+    logic = DataImporterLogic()
+    logic.importFiles(filePaths)
+    logic.populateTopologyDictionary()
+
+    summary = logic.generateShapeAnlaysisStructure(savePath, dryRun=True)
+    self.assertEqual(summary['subjects'], len(filePaths))
+    self.assertEqual(os.listdir(savePath), [])
+    numberOfPlannedFiles = summary['files']
+    # The export reuses the source hashes of the dry run
+    self.assertEqual(set(logic.shapeAnalysisPlan['sources'].keys()), set(filePaths))
+    summary = logic.generateShapeAnlaysisStructure(savePath)
+    self.assertEqual(summary['subjects'], len(filePaths))
+    # The dry run counts the files of every segment, including the ones without topology
+    self.assertEqual(summary['files'], numberOfPlannedFiles)
+    self.assertIsNone(logic.shapeAnalysisPlan)
+    self.assertFalse(os.path.exists(os.path.join(savePath, DataImporterLogic.SHAPE_ANALYSIS_MANIFEST_FILE_NAME + '.tmp')))
+    with open(os.path.join(savePath, DataImporterLogic.SHAPE_ANALYSIS_MANIFEST_FILE_NAME)) as f:
+      manifest = json.load(f)
+    self.assertEqual(set(manifest['subjects'].keys()), set(self.casesLabelMap))
+    numberOfFiles = summary['files']
+
+    # Everything is up to date
+    summary = logic.generateShapeAnlaysisStructure(savePath, dryRun=True)
+    self.assertEqual(summary, {'subjects': 0, 'skippedSubjects': len(filePaths), 'files': 0, 'skippedFiles': numberOfFiles})
+
+    # Only the subject with a missing output is exported again
+    name = self.casesLabelMap[0]
+    outputs = manifest['subjects'][name]['outputs']
+    os.remove(os.path.join(savePath, next(iter(outputs.values()))['model']['path']))
+    summary = logic.generateShapeAnlaysisStructure(savePath)
+    self.assertEqual(summary['subjects'], 1)
+    self.assertEqual(summary['files'], 2 * len(outputs))
+    self.assertEqual(logic.generateShapeAnlaysisStructure(savePath, dryRun=True)['subjects'], 0)
+
+    # Changing the model format exports everything again, with single precision points
+    logic.setModelFormat(DataImporterLogic.MODEL_FORMAT_VTP)
+    logic.generateShapeAnlaysisStructure(savePath)
+    with open(os.path.join(savePath, DataImporterLogic.SHAPE_ANALYSIS_MANIFEST_FILE_NAME)) as f:
+      manifest = json.load(f)
+    modelPath = next(iter(manifest['subjects'][name]['outputs'].values()))['model']['path']
+    self.assertTrue(modelPath.endswith('.vtp'))
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(os.path.join(savePath, modelPath))
+    reader.Update()
+    self.assertGreater(reader.GetOutput().GetNumberOfPoints(), 0)
+    self.assertEqual(reader.GetOutput().GetPoints().GetDataType(), vtk.VTK_FLOAT)
+    self.assertEqual(manifest['subjects'][name]['emptySegments'], [])
+
+    # Empty segments are recorded in the manifest instead of being written
+    emptyLogic = DataImporterLogic()
+    emptyLogic.importFiles([filePaths[0]])
+    segmentation = emptyLogic.segmentationDict[name].GetSegmentation()
+    emptySegmentId = segmentation.GetNthSegmentID(segmentation.GetNumberOfSegments() - 1)
+    emptySegmentName = segmentation.GetSegment(emptySegmentId).GetName()
+    labelArray = slicer.util.arrayFromVolume(emptyLogic.labelMapDict[name])
+    labelArray[labelArray == DataImporterLogic._labelValueFromSegmentId(emptySegmentId)] = 0
+    slicer.util.arrayFromVolumeModified(emptyLogic.labelMapDict[name])
+    emptySavePath = os.path.join(self.testDir, 'ShapeAnalysisStructureEmptySegment')
+    if os.path.isdir(emptySavePath):
+      shutil.rmtree(emptySavePath)
+    os.mkdir(emptySavePath)
+    numberOfPlannedFiles = emptyLogic.generateShapeAnlaysisStructure(emptySavePath, dryRun=True)['files']
+    summary = emptyLogic.generateShapeAnlaysisStructure(emptySavePath)
+    self.assertEqual(summary['files'], numberOfPlannedFiles)
+    self.assertEqual(summary['files'], 2 * (segmentation.GetNumberOfSegments() - 1))
+    with open(os.path.join(emptySavePath, DataImporterLogic.SHAPE_ANALYSIS_MANIFEST_FILE_NAME)) as f:
+      manifest = json.load(f)
+    self.assertEqual(manifest['subjects'][name]['emptySegments'], [emptySegmentName])
+    self.assertNotIn(emptySegmentName, manifest['subjects'][name]['outputs'])
+    self.assertFalse(os.path.exists(os.path.join(emptySavePath, emptySegmentName)))
+    emptyLogic.cleanup()
+
+    logging.info('-- test_generateShapeAnalysisStructure passed! --')
+
+  def test_resultStore(self):
+    """
+    Test that a second import of the same file gets the same results from the result store.
+    """
+    logging.info('-- Starting test_resultStore --')
+    storePath = os.path.join(self.testDir, DataImporterResultStore.DEFAULT_FILE_NAME)
+    if os.path.exists(storePath):
+      os.remove(storePath)
+    filePath = os.path.join(self.testDir, self.casesLabelMap[0])
+
+    logic = DataImporterLogic()
+    logic.setResultStorePath(storePath)
+    logic.importFiles([filePath])
+    logic.populateTopologyDictionary()
+    fileHash = logic.resultStore.fileHash(filePath)
+    self.assertEqual(fileHash, DataImporterResultStore.computeFileHash(filePath))
+    parameters = logic._resultStoreParameters(logic.segmentationDict[self.casesLabelMap[0]].GetSegmentation())
+    cachedResults = logic.resultStore.getResults(fileHash, parameters)
+    self.assertEqual({name: result['topology'] for name, result in cachedResults.items()},
+                     logic.topologyDict[self.casesLabelMap[0]])
+
+    cachedLogic = DataImporterLogic()
+    cachedLogic.setResultStorePath(storePath)
+    cachedLogic.importFiles([filePath])
+    cachedLogic.populateTopologyDictionary()
+    self.assertEqual(cachedLogic.topologyDict, logic.topologyDict)
+    self.check_case01(cachedLogic, self.casesLabelMap[0])
+
+    logging.info('-- test_resultStore passed! --')
+
   def test_populateDictSegmentNamesWithIntegers(self):
     logging.info('-- Starting test_populateDictSegmentNamesWithIntegers --')
     filePath = os.path.join(self.testDir, self.casesModel[0])
@@ -2132,6 +5869,277 @@ class DataImporterTest(ScriptedLoadableModuleTest):
     mode_none = logic._computeModeOfSegment(exampleDict, 'non_existing')
     self.assertEqual(mode_none, None)
 
+  def test_topologyMatrix(self):
+    exampleDict = OrderedDict([
+      ('name0', {'segmentName0': 0, 'segmentName1': 1}),
+      ('name1', {'segmentName0': 1, 'segmentName1': 0}),
+      ('name2', {'segmentName0': 1}),
+      ('name3', {'segmentName1': 5}),
+    ])
+    topologyMatrix = DataImporterTopologyMatrix(exampleDict)
+    self.assertEqual(topologyMatrix, exampleDict)
+    self.assertEqual(list(topologyMatrix), list(exampleDict))
+    # Ties go to the first topology type in subject order
+    self.assertEqual(topologyMatrix.computeModes().tolist(), [1, 1])
+
+    logic = DataImporterLogic()
+    logic.initExpectedTopologyBySegmentWithModes(topologyMatrix)
+    self.assertEqual(logic.expectedTopologiesBySegment, {'segmentName0': 1, 'segmentName1': 1})
+    inconsistenciesExist, inconsistencies = logic.checkTopologyConsistency(topologyMatrix)
+    self.assertTrue(inconsistenciesExist)
+    self.assertEqual(inconsistencies, {'name0': {'segmentName0': 0}, 'name1': {'segmentName1': 0},
+                                       'name3': {'segmentName1': 5}})
+    logic.initExpectedTopologyBySubjectTemplate(topologyMatrix, 'name3')
+    self.assertEqual(logic.expectedTopologiesBySegment,
+                     {'segmentName0': logic.TOPOLOGY_MULTIPLE_HOLES_TYPE, 'segmentName1': logic.TOPOLOGY_MULTIPLE_HOLES_TYPE})
+
+    # Rows are views of the matrix
+    topologyMatrix['name2']['segmentName1'] = 1
+    del topologyMatrix['name0']
+    topologyMatrix['name4'] = {'segmentName2': 2}
+    self.assertEqual(dict(topologyMatrix['name2']), {'segmentName0': 1, 'segmentName1': 1})
+    self.assertEqual(list(topologyMatrix), ['name1', 'name2', 'name3', 'name4'])
+    self.assertEqual(topologyMatrix.segmentNames(), ['segmentName0', 'segmentName1', 'segmentName2'])
+
+  def test_updateInconsistentTopologyDictForSegments(self):
+    logic = DataImporterLogic()
+    logic.topologyDict = DataImporterTopologyMatrix(OrderedDict([
+      ('name0', {'segmentName0': 2, 'segmentName1': 2}),
+      ('name1', {'segmentName0': 2, 'segmentName1': 0}),
+      ('name2', {'segmentName0': 0, 'segmentName1': 0}),
+    ]))
+    logic.populateInconsistentTopologyDict()
+    self.assertEqual(logic.expectedTopologiesBySegment, {'segmentName0': 2, 'segmentName1': 0})
+    self.assertEqual(logic.inconsistentTopologyDict, {'name0': {'segmentName1': 2}, 'name2': {'segmentName0': 0}})
+
+    # Only the subjects whose inconsistencies changed are returned
+    logic.setExpectedTopology('segmentName1', 2)
+    self.assertEqual(logic.updateInconsistentTopologyDictForSegments(['segmentName1']), ['name0', 'name1', 'name2'])
+    logic.setExpectedTopology('segmentName0', 0)
+    self.assertEqual(logic.updateInconsistentTopologyDictForSegments(['segmentName0']), ['name0', 'name1', 'name2'])
+    self.assertEqual(logic.updateInconsistentTopologyDictForSegments(['segmentName0']), [])
+
+    # Switching template only compares the segments whose expected topology changed
+    self.assertEqual(logic.setTemplateName('name1'), ['segmentName0', 'segmentName1'])
+    logic.updateInconsistentTopologyDictForSegments(['segmentName0', 'segmentName1'])
+    self.assertEqual(logic.setTemplateName('name2'), ['segmentName0'])
+    self.assertEqual(logic.updateInconsistentTopologyDictForSegments(['segmentName0']), ['name0', 'name1', 'name2'])
+    self.assertEqual(logic.inconsistentTopologyDict, logic.checkTopologyConsistency(logic.topologyDict)[1])
+
+  def test_topologyTableModels(self):
+    logic = DataImporterLogic()
+    logic.topologyDict = DataImporterTopologyMatrix(OrderedDict([
+      ('name0', {'Left-Hippocampus': 2, 'Right-Hippocampus': 2}),
+      ('name1', {'Left-Hippocampus': 0, 'Right-Hippocampus': 2}),
+      ('name2', {'Left-Hippocampus': 2, 'Right-Hippocampus': 7}),
+    ]))
+    logic.populateInconsistentTopologyDict()
+    mask = logic.topologyFilterMask(segmentNameFilter='right', topologyType=logic.TOPOLOGY_MULTIPLE_HOLES_TYPE)
+    self.assertEqual(mask.tolist(), [[False, False], [False, False], [False, True]])
+    self.assertEqual(logic.topologyFilterMask(inconsistentOnly=True).tolist(), [[False, False], [True, False], [False, True]])
+
+    subjectsModel = DataImporterSubjectsTableModel(logic)
+    subjectsModel.setNames(list(logic.topologyDict))
+    self.assertEqual(subjectsModel.rowCount(), 3)
+    subjectsModel.setFilters(segmentNameFilter='left', inconsistentOnly=True)
+    self.assertEqual(subjectsModel.visibleNames, ['name1'])
+    subjectsModel.setFilters()
+    subjectsModel.sort(DataImporterSubjectsTableModel.COLUMN_NAME, qt.Qt.DescendingOrder)
+    self.assertEqual(subjectsModel.nameOfRow(0), 'name2')
+
+    segmentsModel = DataImporterSegmentsTableModel(logic)
+    segmentsModel.setSubjectNames(['name1'])
+    self.assertEqual(segmentsModel.columnCount(), 3)
+    self.assertEqual(segmentsModel.subjectAndSegmentOfRow(1), ('name1', 'Right-Hippocampus'))
+    segmentsModel.setFilters(inconsistentOnly=True)
+    segmentsModel.setSubjectNames(['name0', 'name1', 'name2'])
+    self.assertEqual(segmentsModel.columnCount(), 4)
+    self.assertEqual([segmentsModel.subjectAndSegmentOfRow(row) for row in range(segmentsModel.rowCount())],
+                     [('name1', 'Left-Hippocampus'), ('name2', 'Right-Hippocampus')])
+    index = segmentsModel.index(0, segmentsModel.columnTopologyExpected)
+    self.assertEqual(segmentsModel.data(index, qt.Qt.DisplayRole), logic.TOPOLOGY_TYPES[logic.TOPOLOGY_SPHERE_TYPE])
+
+  def test_computeSurfaceTopology(self):
+    """
+    Compare computeSurfaceTopology with the vtkCleanPolyData/vtkExtractEdges topology number on known surfaces.
+    """
+    logging.info('-- Starting test_computeSurfaceTopology --')
+    logic = DataImporterLogic()
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(32)
+    sphere.SetPhiResolution(16)
+    plane = vtk.vtkPlaneSource()
+    plane.SetResolution(10, 10)
+    annulus = vtk.vtkDiskSource()
+    annulus.SetCircumferentialResolution(32)
+    # (source, euler, boundaryLoops, genus)
+    cases = [(sphere, logic.TOPOLOGY_SPHERE_TYPE, 0, 0.0),
+             (plane, logic.TOPOLOGY_DISK_TYPE, 1, 0.0),
+             (annulus, logic.TOPOLOGY_STRIP_TYPE, 2, 0.0)]
+    for source, euler, boundaryLoops, genus in cases:
+      source.Update()
+      polydata = source.GetOutput()
+      properties, cleanData = logic.computeSurfaceTopology(polydata, createCleanData=True)
+      self.assertEqual(properties['euler'], euler)
+      self.assertEqual(properties['boundaryLoops'], boundaryLoops)
+      self.assertEqual(properties['genus'], genus)
+      self.assertEqual(properties['components'], 1)
+
+      cleaner = vtk.vtkCleanPolyData()
+      cleaner.SetInputData(polydata)
+      cleaner.Update()
+      edges = vtk.vtkExtractEdges()
+      edges.SetInputData(cleaner.GetOutput())
+      edges.Update()
+      vtkEuler = cleaner.GetOutput().GetNumberOfPoints() - edges.GetOutput().GetNumberOfLines() + cleaner.GetOutput().GetNumberOfPolys()
+      self.assertEqual(properties['euler'], vtkEuler)
+      self.assertEqual(cleanData.GetNumberOfPoints(), cleaner.GetOutput().GetNumberOfPoints())
+
+    logging.info('-- test_computeSurfaceTopology passed! --')
+
+  def test_metricOutliers(self):
+    """
+    Test the geometric metrics of computeTopologyFromArrays and the robust z-score outliers of the cohort.
+    """
+    logging.info('-- Starting test_metricOutliers --')
+    logic = DataImporterLogic()
+
+    # Unit cube with 12 outward triangles, and the same with a fin: a third triangle on one of its edges
+    points = np.array([[x, y, z] for x in [0., 1.] for y in [0., 1.] for z in [0., 1.]])
+    triangles = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                          [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]])
+    properties = logic.computeTopologyFromArrays(points, triangles)[0]
+    self.assertEqual(properties['euler'], logic.TOPOLOGY_SPHERE_TYPE)
+    self.assertAlmostEqual(properties['volume'], 1.0)
+    self.assertAlmostEqual(properties['area'], 6.0)
+    self.assertEqual(properties['bounds'], [0.0, 1.0, 0.0, 1.0, 0.0, 1.0])
+    np.testing.assert_allclose(properties['centroid'], [0.5, 0.5, 0.5])
+    self.assertEqual(properties['nonManifoldEdges'], 0)
+    # The geometric metrics cover all the components, the topology only the largest one
+    tetrahedronPoints = np.array([[10., 10., 10.], [11., 10., 10.], [10., 11., 10.], [10., 10., 11.]])
+    tetrahedronTriangles = np.array([[8, 10, 9], [8, 9, 11], [8, 11, 10], [9, 10, 11]])
+    properties, cleanPoints, cleanTriangles = logic.computeTopologyFromArrays(
+      np.concatenate([points, tetrahedronPoints]), np.concatenate([triangles, tetrahedronTriangles]))
+    self.assertEqual(properties['euler'], logic.TOPOLOGY_SPHERE_TYPE)
+    self.assertEqual(properties['components'], 2)
+    self.assertEqual((len(cleanPoints), len(cleanTriangles)), (8, 12))
+    self.assertAlmostEqual(properties['volume'], 1.0 + 1.0 / 6.0)
+    self.assertAlmostEqual(properties['area'], 6.0 + 1.5 + np.sqrt(3.0) / 2.0)
+    self.assertEqual(properties['bounds'], [0.0, 11.0, 0.0, 11.0, 0.0, 11.0])
+    # Area weighted centroids of the cube and of the faces of the tetrahedron
+    tetrahedronFaceAreas = np.array([0.5, 0.5, 0.5, np.sqrt(3.0) / 2.0])
+    tetrahedronFaceCentroids = tetrahedronPoints[tetrahedronTriangles - 8].mean(axis=1)
+    expectedCentroid = ((6.0 * np.array([0.5, 0.5, 0.5]) + tetrahedronFaceAreas.dot(tetrahedronFaceCentroids))
+                        / (6.0 + tetrahedronFaceAreas.sum()))
+    np.testing.assert_allclose(properties['centroid'], expectedCentroid)
+    properties = logic.computeTopologyFromArrays(np.concatenate([points, [[0.5, 0.5, -1.0]]]),
+                                                 np.concatenate([triangles, [[0, 4, 8]]]))[0]
+    self.assertEqual(properties['nonManifoldEdges'], 1)
+
+    def cubeProperties(size, components=1):
+      return {'volume': size ** 3, 'area': 6 * size ** 2, 'components': components, 'nonManifoldEdges': 0,
+              'bounds': [0.0, size, 0.0, size, 0.0, size], 'centroid': [size / 2.0] * 3}
+
+    sizes = [1.0, 1.02, 0.98, 1.01, 0.99, 1.03, 2.0]
+    for index, size in enumerate(sizes):
+      logic.topologyPropertiesDict['name{}'.format(index)] = {'a': cubeProperties(size, 3 if index == 1 else 1),
+                                                               'b': cubeProperties(1.0)}
+    rows, values = logic.getMetricsTable()
+    self.assertEqual(rows[:2], [('name0', 'a'), ('name0', 'b')])
+    self.assertEqual(values.shape, (2 * len(sizes), len(logic.QC_METRICS)))
+    outliers = logic.computeMetricOutliers()
+    self.assertEqual(sorted(outliers), ['name1', 'name6'])
+    self.assertEqual(list(outliers['name1']['a']), ['components'])
+    self.assertIn('volume', outliers['name6']['a'])
+    # The centroids of name6 are far from the cohort, but they only depend on its position
+    self.assertFalse(set(outliers['name6']['a']) & set(logic.QC_POSITION_METRICS))
+    self.assertGreater(outliers['name6']['a']['volume'], logic.QC_OUTLIER_THRESHOLD)
+    self.assertNotIn('b', outliers['name6'])
+    subjectsModel = DataImporterSubjectsTableModel(logic)
+    subjectsModel.setNames(sorted(logic.topologyPropertiesDict))
+    index = subjectsModel.index(1, DataImporterSubjectsTableModel.COLUMN_QC)
+    self.assertEqual(subjectsModel.data(index, qt.Qt.DisplayRole), '# Outliers: 1')
+    self.assertEqual(subjectsModel.data(index, qt.Qt.ToolTipRole),
+                     'a: components (z = {:.1f})'.format(outliers['name1']['a']['components']))
+    # Missing metrics and small cohorts are not flagged
+    logic.topologyPropertiesDict['name0']['a'] = {'components': 1}
+    self.assertNotIn('name0', logic.computeMetricOutliers())
+    logic.topologyPropertiesDict = {'name0': {'a': cubeProperties(1.0)}, 'name1': {'a': cubeProperties(9.0)}}
+    self.assertEqual(logic.computeMetricOutliers(), {})
+    logging.info('-- test_metricOutliers passed! --')
+
+  def test_computeVoxelTopology(self):
+    """
+    Test computeVoxelTopology on synthetic label maps of known topology, and against the surface backend.
+    """
+    logging.info('-- Starting test_computeVoxelTopology --')
+    logic = DataImporterLogic()
+    shape = (40, 40, 40)
+    k, j, i = np.indices(shape)
+    labelArray = np.zeros(shape, dtype=np.int16)
+    labelArray[(k - 10) ** 2 + (j - 10) ** 2 + (i - 10) ** 2 <= 36] = 1 # ball
+    radius = np.sqrt((k - 28) ** 2 + (j - 28) ** 2 + (i - 28) ** 2)
+    labelArray[(radius <= 9) & (radius > 4)] = 2 # hollow ball
+    labelArray[((np.sqrt((i - 20) ** 2 + (j - 20) ** 2) - 8) ** 2 + (k - 5) ** 2 <= 4) & (labelArray == 0)] = 3 # torus
+    labelArray[35, 2, 2] = 4 # two voxels sharing an edge
+    labelArray[36, 3, 3] = 4
+
+    for connectivity in [6, 26]:
+      topologies = logic.computeVoxelTopology(labelArray, connectivity)
+      self.assertEqual(topologies[1]['euler'], logic.TOPOLOGY_SPHERE_TYPE)
+      self.assertEqual(topologies[2]['euler'], logic.TOPOLOGY_SPHERE_TYPE)
+      self.assertEqual(topologies[2]['cavities'], 1)
+      self.assertEqual(topologies[3]['euler'], logic.TOPOLOGY_STRIP_TYPE)
+      self.assertEqual(topologies[3]['genus'], 1)
+    self.assertEqual(logic.computeVoxelTopology(labelArray, 26)[4]['components'], 1)
+    self.assertEqual(logic.computeVoxelTopology(labelArray, 6)[4]['components'], 2)
+
+    # Same topologies than the surface backend on the test label map
+    filePath = os.path.join(self.testDir, self.casesLabelMap[0])
+    surfaceLogic = DataImporterLogic()
+    surfaceLogic.importFiles([filePath])
+    surfaceLogic.populateTopologyDictionary()
+    voxelLogic = DataImporterLogic()
+    voxelLogic.setTopologyBackend(DataImporterLogic.TOPOLOGY_BACKEND_VOXEL)
+    voxelLogic.importFiles([filePath])
+    voxelLogic.populateTopologyDictionary()
+    self.assertEqual(voxelLogic.polyDataDict[self.casesLabelMap[0]], dict())
+    self.check_case01(surfaceLogic, self.casesLabelMap[0])
+    for segmentName in ["2"]: # Sphere
+      self.assertEqual(voxelLogic.topologyDict[self.casesLabelMap[0]][segmentName],
+                       surfaceLogic.topologyDict[self.casesLabelMap[0]][segmentName])
+
+    logging.info('-- test_computeVoxelTopology passed! --')
+
+  def test_filePathsFromDirectory(self):
+    """
+    Test the classification of files by extension and the recursive listing of a directory with patterns.
+    """
+    logging.info('-- Starting test_filePathsFromDirectory --')
+    self.assertEqual(DataImporterLogic.fileTypeOf('a/b.seg.nrrd'), 'SegmentationFile')
+    self.assertEqual(DataImporterLogic.fileTypeOf('a/b.nii.gz'), 'VolumeFile')
+    self.assertEqual(DataImporterLogic.fileTypeOf('a/b.json'), 'NoFile')
+    self.assertEqual(DataImporterLogic.fileTypeOf(os.path.join(self.testDir, self.casesModel[0])), 'ModelFile')
+
+    treeDir = os.path.join(self.testDir, 'Tree')
+    if os.path.isdir(treeDir):
+      shutil.rmtree(treeDir)
+    for siteName in ['site1', 'site2']:
+      os.makedirs(os.path.join(treeDir, siteName, 'derivatives'))
+      shutil.copy(os.path.join(self.testDir, self.casesLabelMap[0]), os.path.join(treeDir, siteName, siteName + '.nrrd'))
+      shutil.copy(os.path.join(self.testDir, self.casesLabelMap[0]), os.path.join(treeDir, siteName, 'derivatives', 'mask.nrrd'))
+      with open(os.path.join(treeDir, siteName, siteName + '.json'), 'w') as f:
+        f.write('{}')
+
+    logic = DataImporterLogic()
+    self.assertEqual(logic.filePathsFromDirectory(treeDir), [])
+    self.assertEqual(logic.filePathsFromDirectory(treeDir, recursive=True, excludePatterns=['derivatives']),
+                     [os.path.join(treeDir, 'site1', 'site1.nrrd'), os.path.join(treeDir, 'site2', 'site2.nrrd')])
+    self.assertEqual(logic.filePathsFromDirectory(treeDir, recursive=True, includePatterns=['site2*']),
+                     [os.path.join(treeDir, 'site2', 'derivatives', 'mask.nrrd'), os.path.join(treeDir, 'site2', 'site2.nrrd')])
+    logging.info('-- test_filePathsFromDirectory passed! --')
+
   def test_filenamesFromCSVFile(self):
     # Create the file:
     csvFilePath = ''
@@ -2146,3 +6154,458 @@ class DataImporterTest(ScriptedLoadableModuleTest):
     self.assertTrue(len(filePaths), 2)
     self.assertTrue(self.casesLabelMap[0] in filePaths[0])
     self.assertTrue(self.casesLabelMap[1] in filePaths[1])
+
+    # Manifest with named columns, a checksum and a missing file
+    filePath = os.path.join(self.testDir, self.casesLabelMap[0])
+    missingFilePath = os.path.join(self.testDir, 'missing.nrrd')
+    fileHash = DataImporterResultStore.computeFileHash(filePath)
+    with open(os.path.join(self.testDir, 'manifest.csv'), 'w') as fileCsv:
+      fileCsv.write('subject,Path,group,SHA256\n')
+      fileCsv.write('s1,{},control,{}\n'.format(filePath, fileHash.upper()))
+      fileCsv.write('s2,{},patient,\n'.format(missingFilePath))
+      csvFilePath = fileCsv.name
+    self.assertEqual(logic.filePathsFromCSVFile(csvFilePath), [filePath, missingFilePath])
+    self.assertEqual(logic.sourceChecksums, {filePath: fileHash})
+    self.assertEqual(list(logic.sourceMetadata[missingFilePath].items()), [('subject', 's2'), ('group', 'patient')])
+
+    storePath = os.path.join(self.testDir, 'manifestStore.sqlite')
+    if os.path.exists(storePath):
+      os.remove(storePath)
+    logic.setResultStorePath(storePath)
+    logic.importFiles(iter(logic.filterFilePaths([filePath, missingFilePath])))
+    logic.populateTopologyDictionary()
+    self.assertEqual(list(logic.importErrors), [missingFilePath])
+    self.assertEqual(logic.resultStore.fileHash(filePath), fileHash)
+    report = logic.getTopologyReport()
+    self.assertEqual(list(report['subjects'].values())[0]['metadata'], {'subject': 's1', 'group': 'control'})
+    logic.setResultStorePath('')
+
+  def test_freesurferLabelCensus(self):
+    """
+    Test the label census on synthetic MGZ files, one of them missing a label.
+    """
+    logging.info('-- Starting test_freesurferLabelCensus --')
+    labelArrays = {'subject1': [0, 17, 53], 'subject2': [0, 17, 17], 'subject3': [53, 17, 0]}
+    filePaths = []
+    for subjectName, labels in labelArrays.items():
+      filePath = os.path.join(self.testDir, 'FreeSurfer', subjectName, 'mri', 'aseg.mgz')
+      if not os.path.isdir(os.path.dirname(filePath)):
+        os.makedirs(os.path.dirname(filePath))
+      # version, width, height, depth, frames, type (int)
+      header = np.array([1, len(labels), 1, 1, 1, 1], dtype='>i4').tobytes()
+      with gzip.open(filePath, 'wb') as f:
+        f.write(header.ljust(DataImporterLogic.MGH_HEADER_SIZE, b'\0') + np.array(labels, dtype='>i4').tobytes())
+      filePaths.append(filePath)
+
+    logic = DataImporterLogic()
+    logic.setNumberOfWorkers(2)
+    census = logic.computeFreeSurferLabelCensus(filePaths)
+    self.assertEqual(census['labelIds'], ['17', '53'])
+    self.assertEqual(census['presence'].tolist(), [[True, True], [True, False], [True, True]])
+    self.assertEqual(logic.getFreeSurferAvailableSegmentIds(filePaths[1]), ['17'])
+    self.assertEqual(list(logic.getFilesMissingLabels(census, ['17', '53']).items()), [(filePaths[1], ['53'])])
+
+    logic.setFreeSurferimport(True)
+    logic.freesurfer_wanted_segments = ['Label_17', 'Label_53']
+    self.assertEqual(logic.excludeFilesMissingWantedLabels(filePaths), [filePaths[0], filePaths[2]])
+    self.assertIn(filePaths[1], logic.importErrors)
+    logging.info('-- test_freesurferLabelCensus passed! --')
+
+  def test_keepFreeSurferWantedLabels(self):
+    """
+    Test that the unwanted FreeSurfer labels are removed from the label map before the segmentation is created.
+    """
+    logging.info('-- Starting test_keepFreeSurferWantedLabels --')
+    logic = DataImporterLogic()
+    labelMapNode = slicer.util.loadLabelVolume(os.path.join(self.testDir, self.casesLabelMap[0]), returnNode=True)[1]
+    labelValues = [labelValue for labelValue in np.unique(slicer.util.arrayFromVolume(labelMapNode)) if labelValue != 0]
+    logic.freesurfer_wanted_segments = ['Label_{}'.format(labelValues[0])]
+    logic._keepFreeSurferWantedLabels(labelMapNode)
+    self.assertEqual(np.unique(slicer.util.arrayFromVolume(labelMapNode)).tolist(), [0, labelValues[0]])
+    slicer.mrmlScene.RemoveNode(labelMapNode)
+
+    # FreeSurfer subject with an unwanted label between the wanted ones
+    lutPath = os.path.join(self.testDir, 'FreeSurferColorLUT.txt')
+    with open(lutPath, 'w') as f:
+      f.write('#No. Label Name: R G B A\n')
+      f.write('2 Left-Cerebral-White-Matter 245 245 245 0\n')
+      f.write('17 Left-Hippocampus 220 216 20 0\n')
+      f.write('53 Right-Hippocampus 220 216 20 0\n')
+    filePath = os.path.join(self.testDir, 'FreeSurferMasked', 'subject1', 'mri', 'aseg.mgz')
+    if not os.path.isdir(os.path.dirname(filePath)):
+      os.makedirs(os.path.dirname(filePath))
+    labels = np.zeros((8, 8, 8), dtype='>i4')
+    labels[1:3, 1:3, 1:3] = 17
+    labels[3:5, 3:5, 3:5] = 2
+    labels[5:7, 5:7, 5:7] = 53
+    # version, width, height, depth, frames, type (int)
+    header = np.array([1, 8, 8, 8, 1, 1], dtype='>i4').tobytes()
+    with gzip.open(filePath, 'wb') as f:
+      f.write(header.ljust(DataImporterLogic.MGH_HEADER_SIZE, b'\0') + labels.tobytes(order='F'))
+
+    logic.initFreeSurferLUT(lutPath)
+    logic.setFreeSurferimport(True)
+    logic.freesurfer_wanted_segments = ['Label_17', 'Label_53']
+    self.assertTrue(logic.importLabelMap(filePath, createClosedSurface=False))
+    name = next(iter(logic.segmentationDict.keys()))
+    segmentation = logic.segmentationDict[name].GetSegmentation()
+    segmentNames = sorted(segmentation.GetSegment(segmentation.GetNthSegmentID(index)).GetName()
+                          for index in range(segmentation.GetNumberOfSegments()))
+    self.assertEqual(segmentNames, ['Left-Hippocampus', 'Right-Hippocampus'])
+    self.assertEqual(np.unique(slicer.util.arrayFromVolume(logic.labelMapDict[name])).tolist(), [0, 17, 53])
+    logic.cleanup()
+    logging.info('-- test_keepFreeSurferWantedLabels passed! --')
+
+  def test_freesurferSubjectsIndex(self):
+    """
+    Test that the subjects index only reports the subjects added or removed since the last scan.
+    Uses the subjects created by test_freesurferLabelCensus.
+    """
+    logging.info('-- Starting test_freesurferSubjectsIndex --')
+    subjectsPath = os.path.join(self.testDir, 'FreeSurfer')
+    relativeFilePath = os.path.join('mri', 'aseg.mgz')
+    logic = DataImporterLogic()
+    indexPath = logic.freeSurferSubjectsIndexPath(subjectsPath)
+    if os.path.isfile(indexPath):
+      os.remove(indexPath)
+    filePaths = logic.filePathsFromFreeSurferSubjectsDirectory(subjectsPath, relativeFilePath)
+    self.assertEqual([os.path.basename(os.path.dirname(os.path.dirname(path))) for path in filePaths],
+                     ['subject1', 'subject2', 'subject3'])
+    self.assertTrue(os.path.isfile(indexPath))
+
+    index = logic.loadFreeSurferSubjectsIndex(subjectsPath)
+    self.assertEqual(logic.updateFreeSurferSubjectsIndex(index, [relativeFilePath]), [])
+    newSubjectPath = os.path.join(subjectsPath, 'subject4')
+    if os.path.isdir(newSubjectPath):
+      shutil.rmtree(newSubjectPath)
+    shutil.copytree(os.path.join(subjectsPath, 'subject1'), newSubjectPath)
+    self.assertEqual(logic.updateFreeSurferSubjectsIndex(index, [relativeFilePath]), ['subject4'])
+    shutil.rmtree(newSubjectPath)
+    self.assertEqual(logic.updateFreeSurferSubjectsIndex(index, [relativeFilePath]), ['subject4'])
+    self.assertEqual(len(logic.filePathsFromFreeSurferSubjectsIndex(index, relativeFilePath)), 3)
+    logging.info('-- test_freesurferSubjectsIndex passed! --')
+
+  def test_main(self):
+    """
+    Test the headless entry point on the CSV file of test_filenamesFromCSVFile.
+    """
+    logging.info('-- Starting test_main --')
+    csvFilePath = os.path.join(self.testDir, 'filePaths.csv')
+    reportPath = os.path.join(self.testDir, 'report.json')
+
+    exitCode = main(['--csv', csvFilePath, '--report', reportPath])
+    self.assertIn(exitCode, [EXIT_CONSISTENT, EXIT_INCONSISTENT])
+    with open(reportPath) as f:
+      report = json.load(f)
+    self.assertEqual(set(report['subjects'].keys()), set(self.casesLabelMap))
+    self.assertEqual(report['template'], self.casesLabelMap[0])
+    self.assertEqual(exitCode == EXIT_CONSISTENT, report['consistent'])
+
+    # Expecting a triple torus makes the cohort inconsistent
+    segmentName = sorted(report['expectedTopologies'].keys())[0]
+    exitCode = main(['--csv', csvFilePath, '--report', reportPath, '--expected', segmentName + '=Triple Torus'])
+    self.assertEqual(exitCode, EXIT_INCONSISTENT)
+    with open(reportPath) as f:
+      report = json.load(f)
+    self.assertEqual(report['expectedTopologies'][segmentName], DataImporterLogic.TOPOLOGY_TRIPLE_TORUS_TYPE)
+
+    self.assertEqual(main(['--csv', csvFilePath, '--expected', segmentName + '=Klein Bottle']), EXIT_ERROR)
+
+    logging.info('-- test_main passed! --')
+
+  def test_mergeShardReports(self):
+    """
+    Test that merging the reports of the shards of a cohort, processed by concurrent Slicer processes,
+    gives the report of a single process.
+    """
+    logging.info('-- Starting test_mergeShardReports --')
+    csvFilePath = os.path.join(self.testDir, 'filePaths.csv')
+    reportPath = os.path.join(self.testDir, 'report.json')
+    shardReportPaths = [os.path.join(self.testDir, 'report_{}.json'.format(index)) for index in range(2)]
+
+    def runShardsConcurrently(csvFilePath):
+      processes = []
+      for index, shardReportPath in enumerate(shardReportPaths):
+        if os.path.exists(shardReportPath):
+          os.remove(shardReportPath)
+        with open(os.path.join(self.testDir, 'shard_{}.log'.format(index)), 'w') as logFile:
+          processes.append(subprocess.Popen(
+            [slicer.app.applicationFilePath(), '--no-main-window', '--ignore-slicerrc',
+             '--python-script', os.path.abspath(__file__),
+             '--csv', csvFilePath, '--shard-count', str(len(shardReportPaths)), '--shard-index', str(index),
+             '--report', shardReportPath], stdout=logFile, stderr=subprocess.STDOUT))
+      return [process.wait(timeout=600) for process in processes]
+
+    for arguments in [['--mode'], []]:
+      exitCode = main(['--csv', csvFilePath, '--report', reportPath] + arguments)
+      self.assertEqual(runShardsConcurrently(csvFilePath), [EXIT_CONSISTENT] * len(shardReportPaths))
+      mergeReportPath = os.path.join(self.testDir, 'report_merged.json')
+      self.assertEqual(main(['--merge'] + shardReportPaths + ['--report', mergeReportPath] + arguments), exitCode)
+
+      with open(reportPath) as f:
+        report = json.load(f, object_pairs_hook=OrderedDict)
+      with open(mergeReportPath) as f:
+        mergedReport = json.load(f, object_pairs_hook=OrderedDict)
+      self.assertEqual(list(mergedReport['subjects'].keys()), list(report['subjects'].keys()))
+      for key in ['consistent', 'template', 'expectedTopologies', 'segmentNamesWithIntegers', 'labelRange']:
+        self.assertEqual(mergedReport[key], report[key])
+      for nodeName, subject in report['subjects'].items():
+        self.assertEqual(mergedReport['subjects'][nodeName]['topologies'], subject['topologies'])
+        self.assertEqual(mergedReport['subjects'][nodeName]['inconsistencies'], subject['inconsistencies'])
+
+    # All the shards are required
+    self.assertEqual(main(['--merge', shardReportPaths[0], '--report', mergeReportPath]), EXIT_ERROR)
+
+    # Cohort with mixed label ranges: the range of its first subject, in shard 0, rejects the subjects
+    # of both shards, even case02 imported by shard 0 after it
+    labelMapNode = slicer.util.loadLabelVolume(os.path.join(self.testDir, self.casesLabelMap[0]), returnNode=True)[1]
+    labelArray = slicer.util.arrayFromVolume(labelMapNode)
+    labelArray[:2, :2, :2] = labelArray.max() + 1
+    slicer.util.arrayFromVolumeModified(labelMapNode)
+    mixedPath = os.path.join(self.testDir, 'mixed.nrrd')
+    slicer.util.saveNode(labelMapNode, mixedPath)
+    slicer.mrmlScene.RemoveNode(labelMapNode)
+    mixedCSVFilePath = os.path.join(self.testDir, 'mixedFilePaths.csv')
+    with open(mixedCSVFilePath, 'w') as fileCsv:
+      fileCsv.write('\n'.join([mixedPath] + [os.path.join(self.testDir, fileName) for fileName in self.casesLabelMap]))
+    self.assertEqual(main(['--csv', mixedCSVFilePath, '--report', reportPath]), EXIT_ERROR)
+    self.assertEqual(runShardsConcurrently(mixedCSVFilePath), [EXIT_CONSISTENT] * len(shardReportPaths))
+    self.assertEqual(main(['--merge'] + shardReportPaths + ['--report', mergeReportPath]), EXIT_ERROR)
+    with open(reportPath) as f:
+      report = json.load(f, object_pairs_hook=OrderedDict)
+    with open(mergeReportPath) as f:
+      mergedReport = json.load(f, object_pairs_hook=OrderedDict)
+    self.assertEqual(list(report['subjects'].keys()), ['mixed.nrrd'])
+    self.assertEqual(list(mergedReport['subjects'].keys()), list(report['subjects'].keys()))
+    self.assertEqual(mergedReport['labelRange'], report['labelRange'])
+    self.assertEqual(sorted(mergedReport['importErrors']), sorted(report['importErrors']))
+    os.remove(mixedPath)
+    os.remove(mixedCSVFilePath)
+
+    logging.info('-- test_mergeShardReports passed! --')
+
+#
+# Headless entry point
+#
+
+EXIT_CONSISTENT = 0
+EXIT_INCONSISTENT = 1
+EXIT_ERROR = 2
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(
+    prog='DataImporter',
+    description='Import a cohort, compute the topology of its segments and check their consistency. '
+                'Run with: Slicer --no-main-window --python-script DataImporter.py [options]. '
+                'Exit code is {} if consistent, {} if inconsistent, {} on errors.'.format(EXIT_CONSISTENT, EXIT_INCONSISTENT, EXIT_ERROR),
+    epilog='Large cohorts can be split in shards processed by independent processes, for example: '
+           'run with --shard-count 4 --shard-index I --report part_I.json for I in 0..3, '
+           'then with --merge part_0.json part_1.json part_2.json part_3.json.')
+  inputGroup = parser.add_mutually_exclusive_group(required=True)
+  inputGroup.add_argument('--directory', help='Directory with the files of the cohort.')
+  inputGroup.add_argument('--csv', help='CSV file with one file path per row.')
+  inputGroup.add_argument('--freesurfer-subjects', help='FreeSurfer SUBJECTS_DIR.')
+  inputGroup.add_argument('--merge', nargs='+', metavar='REPORT', help='Merge the partial reports of all the shards of a cohort.')
+  parser.add_argument('--freesurfer-home', default=os.environ.get('FREESURFER_HOME', ''),
+                      help='FreeSurfer home, containing FreeSurferColorLUT.txt. Default: $FREESURFER_HOME.')
+  parser.add_argument('--freesurfer-file', default=os.path.normpath('mri/aseg.mgz'),
+                      help='Label map of each FreeSurfer subject. Default: mri/aseg.mgz.')
+  parser.add_argument('--freesurfer-labels', nargs='+', default=[],
+                      help='FreeSurfer label ids to import. Default: the labels of the first subject.')
+  parser.add_argument('--recursive', action='store_true', help='Also import the files of the subdirectories of --directory.')
+  parser.add_argument('--include', nargs='+', default=[], metavar='PATTERN',
+                      help='Only import the files of --directory matching one of these glob patterns.')
+  parser.add_argument('--exclude', nargs='+', default=[], metavar='PATTERN',
+                      help='Do not import the files and subdirectories of --directory matching one of these glob patterns.')
+  parser.add_argument('--file-type', choices=['VolumeFile', 'SegmentationFile', 'ModelFile', 'None'], default='VolumeFile',
+                      help='Type of the files to import from --directory. Default: VolumeFile.')
+  parser.add_argument('--color-table', default='None', help='Name of the color table naming the labels.')
+  parser.add_argument('--template', default='', help='Subject used as template of the expected topologies. Default: the first one.')
+  parser.add_argument('--mode', action='store_true', help='Use the mode of each segment as expected topology instead of a template.')
+  parser.add_argument('--expected', nargs='+', default=[], metavar='SEGMENT=TOPOLOGY',
+                      help='Expected topology of segments, as type number or name, for example 1=Sphere.')
+  parser.add_argument('--no-clean-data', action='store_true', help='Do not keep the largest component of the surfaces.')
+  parser.add_argument('--workers', type=int, default=1, help='Number of worker processes. Default: 1.')
+  parser.add_argument('--topology-backend', choices=[DataImporterLogic.TOPOLOGY_BACKEND_SURFACE, DataImporterLogic.TOPOLOGY_BACKEND_VOXEL],
+                      default=DataImporterLogic.TOPOLOGY_BACKEND_SURFACE, help='Compute topologies of label maps from surfaces or voxels.')
+  parser.add_argument('--voxel-connectivity', type=int, choices=[6, 26], default=26)
+  parser.add_argument('--cache', action='store_true', help='Keep results in a result store next to the cohort.')
+  parser.add_argument('--lazy-closed-surfaces', action='store_true', help='Only create the closed surfaces to export them.')
+  parser.add_argument('--compact-surfaces', action='store_true', help='Only keep float32 points and triangles of the clean data in memory.')
+  parser.add_argument('--memory-budget', type=int, default=0, help='Memory budget in MB. Default: unlimited.')
+  parser.add_argument('--shard-count', type=int, default=1, help='Number of shards the cohort is split in. Default: 1.')
+  parser.add_argument('--shard-index', type=int, default=0,
+                      help='Shard processed by this process, its report is partial and has to be merged with --merge.')
+  parser.add_argument('--export', default='', help='Directory where to generate the shape analysis structure.')
+  parser.add_argument('--model-format', choices=[DataImporterLogic.MODEL_FORMAT_VTK, DataImporterLogic.MODEL_FORMAT_VTP],
+                      default=DataImporterLogic.MODEL_FORMAT_VTK, help='Format of the exported models. Default: vtk.')
+  parser.add_argument('--dry-run', action='store_true', help='Only log the number of files --export would write.')
+  parser.add_argument('--report', default='-', help='Path of the JSON report. Default: standard output.')
+  return parser.parse_args(argv)
+
+def _parseExpectedTopology(text):
+  """ Return tuple (segmentName, topologyType) from 'segmentName=topology'. """
+  segmentName, _, topology = text.rpartition('=')
+  if not segmentName:
+    raise ValueError('Expected topology {} is not SEGMENT=TOPOLOGY'.format(text))
+  topologyTypesByName = {name.lower(): topologyType for topologyType, name in DataImporterLogic.TOPOLOGY_TYPES.items()}
+  if topology.lower() in topologyTypesByName:
+    return segmentName, topologyTypesByName[topology.lower()]
+  if topology.lstrip('-').isdigit() and int(topology) in DataImporterLogic.TOPOLOGY_TYPES:
+    return segmentName, int(topology)
+  raise ValueError('Unknown topology {}, use one of {}'.format(topology, DataImporterLogic.TOPOLOGY_TYPES))
+
+def _writeReport(report, reportPath):
+  if reportPath == '-':
+    print(json.dumps(report, indent=2))
+  else:
+    with open(reportPath, 'w') as f:
+      json.dump(report, f, indent=2)
+
+def main(argv=None):
+  """
+  Run import, topology, consistency and optional shape analysis structure export without the widget.
+  Return the exit code: EXIT_CONSISTENT, EXIT_INCONSISTENT or EXIT_ERROR.
+  A shard (--shard-count > 1) only writes its partial report, and returns EXIT_CONSISTENT if it has no import error.
+  """
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  try:
+    expectedTopologies = dict(_parseExpectedTopology(text) for text in args.expected)
+  except ValueError as e:
+    logging.error(e)
+    return EXIT_ERROR
+
+  logic = DataImporterLogic()
+  try:
+    if args.merge:
+      if args.export:
+        logging.error('--export requires the nodes of the subjects, export from each shard instead.')
+        return EXIT_ERROR
+      reports = []
+      for reportPath in args.merge:
+        with open(reportPath) as f:
+          reports.append(json.load(f, object_pairs_hook=OrderedDict))
+      try:
+        logic.mergeTopologyReports(reports)
+      except (ValueError, KeyError) as e:
+        logging.error('Unable to merge reports: {}'.format(e))
+        return EXIT_ERROR
+    else:
+      exitCode = _importHeadless(logic, args)
+      if exitCode is not None:
+        return exitCode
+      if args.shard_count > 1:
+        return _writeShardReport(logic, args)
+    return _checkConsistencyHeadless(logic, args, expectedTopologies)
+  finally:
+    logic.cleanup()
+
+def _importHeadless(logic, args):
+  """
+  Import the files of the cohort (or of the shard) and compute their topology.
+  Return None on success, the exit code otherwise.
+  """
+  logic.setSaveCleanData(not args.no_clean_data)
+  logic.setNumberOfWorkers(args.workers)
+  logic.setTopologyBackend(args.topology_backend, args.voxel_connectivity)
+  logic.setLazyClosedSurfaces(args.lazy_closed_surfaces)
+  logic.setCompactPolyData(args.compact_surfaces)
+  logic.setMemoryBudget(args.memory_budget)
+  logic.setColorTableId(args.color_table)
+  logic.setModelFormat(args.model_format)
+  # The label range of the cohort is checked when the shards are merged
+  logic.setCheckLabelRange(args.shard_count == 1)
+
+  if args.directory:
+    cohortDirectory = args.directory
+    logic.setExpectedFileType(args.file_type)
+    filePaths = logic.filePathsFromDirectory(args.directory, recursive=args.recursive,
+                                             includePatterns=args.include, excludePatterns=args.exclude)
+  elif args.csv:
+    cohortDirectory = os.path.dirname(args.csv)
+    logic.setExpectedFileType('None')
+    filePaths = logic.filterFilePaths(logic.filePathsFromCSVFile(args.csv))
+  else:
+    cohortDirectory = args.freesurfer_subjects
+    lutPath = os.path.join(args.freesurfer_home, 'FreeSurferColorLUT.txt')
+    if not os.path.isfile(lutPath):
+      logging.error('Impossible to find {}, set --freesurfer-home.'.format(lutPath))
+      return EXIT_ERROR
+    logic.initFreeSurferLUT(lutPath)
+    logic.setFreeSurferimport(True)
+    logic.setExpectedFileType('VolumeFile')
+    filePaths = logic.filePathsFromFreeSurferSubjectsDirectory(args.freesurfer_subjects, args.freesurfer_file)
+    # All the shards use the labels of the first subject of the cohort
+    labelIds = args.freesurfer_labels or (logic.getFreeSurferAvailableSegmentIds(filePaths[0]) if filePaths else []) or []
+    logic.freesurfer_wanted_segments = ['Label_' + labelId for labelId in labelIds]
+
+  if not filePaths:
+    logging.error('No file to import.')
+    return EXIT_ERROR
+  args.manifestIndexes = {filePath: index for index, filePath in enumerate(filePaths)}
+  try:
+    filePaths = logic.shardFilePaths(filePaths, args.shard_count, args.shard_index)
+  except ValueError as e:
+    logging.error(e)
+    return EXIT_ERROR
+  if args.cache:
+    logic.setResultStorePath(os.path.join(cohortDirectory, DataImporterResultStore.DEFAULT_FILE_NAME))
+  filePaths = logic.excludeFilesMissingWantedLabels(filePaths)
+
+  # Missing files of the manifest are reported in importErrors
+  logic.importFiles(iter(filePaths))
+  logic.populateTopologyDictionary()
+  if not logic.topologyDict and args.shard_count == 1:
+    logging.error('No file has been imported.')
+    return EXIT_ERROR
+
+  if args.export:
+    if not os.path.isdir(args.export) and not args.dry_run:
+      os.makedirs(args.export)
+    summary = logic.generateShapeAnlaysisStructure(args.export, dryRun=args.dry_run)
+    logging.info('Shape analysis structure: {files} files of {subjects} subjects {verb}, '
+                 '{skippedFiles} files of {skippedSubjects} subjects up to date.'.format(
+                   verb='to write' if args.dry_run else 'written', **summary))
+  return None
+
+def _writeShardReport(logic, args):
+  """
+  Write the partial report of the shard, with the position in the manifest of each subject, see mergeTopologyReports.
+  """
+  report = logic.getTopologyReport()
+  report['shard'] = {'index': args.shard_index, 'count': args.shard_count}
+  for subject in report['subjects'].values():
+    subject['index'] = args.manifestIndexes[subject['path']]
+  _writeReport(report, args.report)
+  return EXIT_ERROR if logic.importErrors else EXIT_CONSISTENT
+
+def _checkConsistencyHeadless(logic, args, expectedTopologies):
+  """
+  Compute the expected topologies, consistency and dictSegmentNamesWithIntegers, and write the report.
+  Return the exit code.
+  """
+  if not logic.topologyDict:
+    logging.error('No subject to check.')
+    return EXIT_ERROR
+  if args.mode:
+    logic.initExpectedTopologyBySegmentWithModes(logic.topologyDict)
+  else:
+    if args.template and args.template not in logic.topologyDict:
+      logging.error('Template {} has not been imported.'.format(args.template))
+      return EXIT_ERROR
+    logic.TemplateName = args.template or next(iter(logic.topologyDict))
+    logic.initExpectedTopologyBySubjectTemplate(logic.topologyDict, logic.TemplateName)
+  for segmentName, topologyType in expectedTopologies.items():
+    logic.setExpectedTopology(segmentName, topologyType)
+  logic.populateInconsistentTopologyDict()
+  logic.populateDictSegmentNamesWithIntegers()
+
+  report = logic.getTopologyReport()
+  _writeReport(report, args.report)
+
+  if logic.importErrors:
+    return EXIT_ERROR
+  return EXIT_CONSISTENT if report['consistent'] else EXIT_INCONSISTENT
+
+if __name__ == '__main__':
+  slicer.util.exit(main())